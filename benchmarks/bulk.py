@@ -0,0 +1,88 @@
+# Copyright (C) 2013, 2014, 2017 by Kevin L. Mitchell <klmitch@mit.edu>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the registration of a large number of generated arguments,
+one at a time as the @argument() decorator does, and in a single call
+to ``add_arguments()``:
+
+    PYTHONPATH=. python benchmarks/bulk.py
+"""
+
+import argparse
+import sys
+import time
+
+import cli_tools
+
+
+def specs(count):
+    """
+    Generate argument specifications.
+
+    :param count: The number of arguments.
+
+    :returns: A list of tuples of the positional arguments and the
+              keyword arguments of each argument.
+    """
+
+    return [(('--opt%d' % i,), {'help': 'Option %d.' % i})
+            for i in range(count)]
+
+
+def one_at_a_time(adaptor, arguments):
+    """
+    Register arguments one at a time.
+
+    :param adaptor: The ``ScriptAdaptor`` to register them with.
+    :param arguments: The argument specifications.
+    """
+
+    for args, kwargs in arguments:
+        adaptor._add_argument(args, kwargs, None)
+
+
+def bulk(adaptor, arguments):
+    """
+    Register arguments in a single call.
+
+    :param adaptor: The ``ScriptAdaptor`` to register them with.
+    :param arguments: The argument specifications.
+    """
+
+    adaptor.add_arguments(arguments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--arguments', type=int, default=50000,
+                        help='The number of arguments.')
+    args = parser.parse_args()
+
+    arguments = specs(args.arguments)
+    for name, register in (('_add_argument()', one_at_a_time),
+                           ('add_arguments()', bulk)):
+        def func():
+            pass
+        adaptor = cli_tools.ScriptAdaptor._get_adaptor(func)
+
+        start = time.time()
+        register(adaptor, arguments)
+        elapsed = time.time() - start
+
+        print('%s: %.2f s' % (name, elapsed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
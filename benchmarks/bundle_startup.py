@@ -0,0 +1,139 @@
+# Copyright (C) 2013, 2014, 2017 by Kevin L. Mitchell <klmitch@mit.edu>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the startup time of a console script run from its installed
+layout and from a bundle built with ``bundle()``.  A tool with one
+entrypoint group and two plugins, one of them broken, is written to a
+temporary directory, and the median wall time of running one plugin
+subcommand is reported, next to that of "python -c pass":
+
+    PYTHONPATH=. python benchmarks/bundle_startup.py
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cli_tools
+
+
+# The files of the tool, relative to the directory on its path
+files = {
+    'bench_tool/__init__.py': '',
+    'bench_tool/cli.py': (
+        'import cli_tools\n'
+        '\n'
+        '\n'
+        '@cli_tools.console\n'
+        '@cli_tools.load_subcommands("bench.commands")\n'
+        'def main():\n'
+        '    "Benchmark tool."\n'
+    ),
+    'bench_plugins/__init__.py': '',
+    'bench_plugins/cmds.py': (
+        'import cli_tools\n'
+        '\n'
+        '\n'
+        '@cli_tools.argument("--n", type=int, default=1)\n'
+        'def plug(n):\n'
+        '    "Run the plugin."\n'
+        '    return None\n'
+    ),
+    'bench_plugins-1.0.egg-info/PKG-INFO': (
+        'Metadata-Version: 1.0\n'
+        'Name: bench-plugins\n'
+        'Version: 1.0\n'
+    ),
+    'bench_plugins-1.0.egg-info/entry_points.txt': (
+        '[bench.commands]\n'
+        'plug = bench_plugins.cmds:plug\n'
+        'broken = bench_missing:func\n'
+    ),
+}
+
+
+def median_time(cmd, env, runs):
+    """
+    Time a command.
+
+    :param cmd: The command to run, as a list.
+    :param env: The environment to run it in.
+    :param runs: The number of timed runs.
+
+    :returns: The median wall time, in seconds.
+    """
+
+    # Warm the caches first
+    subprocess.check_output(cmd, env=env)
+
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_output(cmd, env=env)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=40,
+                        help='The number of timed runs of each command.')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        site = os.path.join(tmpdir, 'site')
+        for name, content in files.items():
+            path = os.path.join(site, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+
+        # The tool finds cli_tools, six and its plugins on the path
+        lib = os.path.dirname(os.path.abspath(cli_tools.__file__))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([site, lib]))
+
+        # Build the bundle in a process which can see the plugins
+        bundle = os.path.join(tmpdir, 'bench.pyz')
+        subprocess.check_call([
+            sys.executable, '-c',
+            'import sys; from bench_tool.cli import main; '
+            'main.bundle(sys.argv[1])', bundle,
+        ], env=env)
+
+        cmds = [
+            ('python -c pass', [sys.executable, '-c', 'pass']),
+            ('installed layout', [
+                sys.executable, '-c',
+                'import sys; from bench_tool.cli import main; '
+                'sys.exit(main.console())', 'plug',
+            ]),
+            ('bundle (.pyz)', [sys.executable, bundle, 'plug']),
+        ]
+        for name, cmd in cmds:
+            print('%-20s %6.1f ms' % (
+                name, median_time(cmd, env, args.runs) * 1000))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# Copyright (C) 2013, 2014, 2017 by Kevin L. Mitchell <klmitch@mit.edu>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the resident set size seen by a command run from a large
+command tree, with and without @low_memory().  The command reports
+the resident set size after a garbage collection.  Each mode runs in a
+fresh process, and the "/proc" filesystem is required:
+
+    PYTHONPATH=. python benchmarks/low_memory.py
+"""
+
+import argparse
+import gc
+import subprocess
+import sys
+
+import cli_tools
+
+
+def rss():
+    """
+    Retrieve the resident set size of the process.
+
+    :returns: The resident set size, in MiB.
+    """
+
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096 / 1024.0 / 1024
+
+
+def build(low, commands, options):
+    """
+    Declare a command tree whose commands report the resident set
+    size.
+
+    :param low: If ``True``, the tree runs in low memory mode.
+    :param commands: The number of subcommands.
+    :param options: The number of options of each subcommand.
+
+    :returns: The decorated function at the root of the tree.
+    """
+
+    @cli_tools.argument('--debug', action='store_true')
+    def main():
+        pass
+
+    if low:
+        main = cli_tools.low_memory()(main)
+
+    for i in range(commands):
+        def cmd(**kwargs):
+            gc.collect()
+            return '%.1f MiB' % rss()
+        cmd.__name__ = 'cmd%d' % i
+        cmd.__doc__ = 'Run command %d. ' % i * 20
+        for j in range(options):
+            cmd = cli_tools.argument(
+                '--opt%d' % j, help='Option %d of %d. ' % (j, i) * 10
+            )(cmd)
+        main.subcommand(cmd)
+
+    return main
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--commands', type=int, default=3000,
+                        help='The number of subcommands.')
+    parser.add_argument('--options', type=int, default=10,
+                        help='The number of options of each subcommand.')
+    parser.add_argument('--mode', choices=('normal', 'low'),
+                        help='Measure only this mode, in this process.')
+    args = parser.parse_args()
+
+    if args.mode:
+        tree = build(args.mode == 'low', args.commands, args.options)
+        print('%s: %s' % (args.mode, tree.console(
+            argv=['cmd%d' % (args.commands // 2), '--opt1', 'x'])))
+        return
+
+    for mode in ('normal', 'low'):
+        subprocess.check_call([
+            sys.executable, __file__, '--mode', mode,
+            '--commands', str(args.commands),
+            '--options', str(args.options),
+        ])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
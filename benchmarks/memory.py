@@ -0,0 +1,111 @@
+# Copyright (C) 2013, 2014, 2017 by Kevin L. Mitchell <klmitch@mit.edu>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the memory taken by a large command tree.  A synthetic tree of
+commands, each with a number of options, is declared with the
+decorators, and the growth of the resident set size, the memory
+allocated while declaring it (with --trace), and the time spent
+declaring each command are reported.  To compare two versions of
+``cli_tools``, run the script with each on ``PYTHONPATH``:
+
+    PYTHONPATH=. python benchmarks/memory.py
+    PYTHONPATH=. python benchmarks/memory.py --trace
+"""
+
+import argparse
+import gc
+import sys
+import time
+
+import cli_tools
+
+
+def rss():
+    """
+    Retrieve the resident set size of the process.  This requires the
+    "/proc" filesystem.
+
+    :returns: The resident set size, in MiB.
+    """
+
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096 / 1024.0 / 1024
+
+
+def build(commands, options):
+    """
+    Declare a command tree.
+
+    :param commands: The number of subcommands.
+    :param options: The number of options of each subcommand.
+
+    :returns: The decorated function at the root of the tree.
+    """
+
+    @cli_tools.argument('--debug', action='store_true')
+    def main():
+        pass
+
+    for i in range(commands):
+        def cmd(**kwargs):
+            pass
+        cmd.__name__ = 'cmd%d' % i
+        cmd.__doc__ = 'Run command %d.' % i
+        for j in range(options):
+            cmd = cli_tools.argument(
+                '--opt%d' % j, help='Option %d of command %d.' % (j, i)
+            )(cmd)
+        main.subcommand(cmd)
+
+    return main
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--commands', type=int, default=10000,
+                        help='The number of subcommands.')
+    parser.add_argument('--options', type=int, default=5,
+                        help='The number of options of each subcommand.')
+    parser.add_argument('--trace', action='store_true',
+                        help='Report the memory allocated while building '
+                        'the tree, using tracemalloc.')
+    args = parser.parse_args()
+
+    if args.trace:
+        import tracemalloc
+        tracemalloc.start()
+
+    gc.collect()
+    before = rss()
+    start = time.time()
+    tree = build(args.commands, args.options)
+    elapsed = time.time() - start
+    gc.collect()
+    after = rss()
+
+    print('RSS growth: %.1f MiB' % (after - before))
+    if args.trace:
+        current, peak = tracemalloc.get_traced_memory()
+        print('Traced allocations: %.1f MiB' % (current / 1024.0 / 1024))
+    else:
+        print('Declaration: %.1f us per command' %
+              (elapsed / args.commands * 1e6))
+
+    # Keep the tree alive until it has been measured
+    del tree
+
+
+if __name__ == '__main__':
+    sys.exit(main())
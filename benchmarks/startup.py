@@ -0,0 +1,128 @@
+# Copyright (C) 2013, 2014, 2017 by Kevin L. Mitchell <klmitch@mit.edu>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the startup of a command with many subcommands sharing the
+same options: the time to declare the tree, build the argument parser
+and parse one command line, and the peak memory allocated while doing
+so.  In the "repeated" mode, each subcommand declares the options
+itself and the sub-parsers are set up eagerly, as before option sets
+existed; in the "shared" mode, the options are declared once as an
+option set, and only the parser of the selected subcommand is set up.
+Each mode runs in a fresh process:
+
+    PYTHONPATH=. python benchmarks/startup.py
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+import cli_tools
+
+
+def build(mode, commands, options):
+    """
+    Declare a command tree.
+
+    :param mode: Either "shared" or "repeated".
+    :param commands: The number of subcommands.
+    :param options: The number of options shared by the subcommands.
+
+    :returns: The decorated function at the root of the tree.
+    """
+
+    def main():
+        pass
+
+    if mode == 'shared':
+        for j in range(options):
+            main = cli_tools.option_argument(
+                'common', '--opt%d' % j, help='Shared option %d.' % j
+            )(main)
+    else:
+        main = cli_tools.subparsers(action=argparse._SubParsersAction)(main)
+
+    for i in range(commands):
+        def cmd(**kwargs):
+            return kwargs
+        cmd.__name__ = 'cmd%d' % i
+        cmd.__doc__ = 'Run command %d.' % i
+        if mode == 'shared':
+            cmd = cli_tools.use_options('common')(cmd)
+        else:
+            for j in range(options):
+                cmd = cli_tools.argument(
+                    '--opt%d' % j, help='Shared option %d.' % j
+                )(cmd)
+        main.subcommand(cmd)
+
+    return main
+
+
+def run(mode, commands, options, trace):
+    """
+    Measure one mode in this process.
+
+    :param mode: Either "shared" or "repeated".
+    :param commands: The number of subcommands.
+    :param options: The number of options shared by the subcommands.
+    :param trace: If ``True``, report the peak memory allocated.
+    """
+
+    if trace:
+        import tracemalloc
+        tracemalloc.start()
+
+    start = time.time()
+    tree = build(mode, commands, options)
+    tree.console(argv=['cmd%d' % (commands // 2), '--opt1', 'x'])
+    elapsed = time.time() - start
+
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        print('%s: peak traced memory %.1f MiB' %
+              (mode, peak / 1024.0 / 1024))
+    else:
+        print('%s: %.0f ms' % (mode, elapsed * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--commands', type=int, default=400,
+                        help='The number of subcommands.')
+    parser.add_argument('--options', type=int, default=15,
+                        help='The number of options shared by the '
+                        'subcommands.')
+    parser.add_argument('--mode', choices=('shared', 'repeated'),
+                        help='Measure only this mode, in this process.')
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.commands, args.options, False)
+        if sys.version_info >= (3, 4):
+            run(args.mode, args.commands, args.options, True)
+        return
+
+    for mode in ('repeated', 'shared'):
+        subprocess.check_call([
+            sys.executable, __file__, '--mode', mode,
+            '--commands', str(args.commands),
+            '--options', str(args.options),
+        ])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
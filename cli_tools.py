@@ -13,16 +13,143 @@
 #    under the License.
 
 import argparse
+import collections
+import contextlib
+import copy
+import errno
+import functools
+import gc
+import hashlib
+import importlib
 import inspect
+import itertools
+import multiprocessing
+import os
+import py_compile
+import re
+import shlex
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import traceback
+import zipfile
+import zlib
 
-import pkg_resources
 import six
+from six.moves import cPickle as pickle
+from six.moves import queue
+
+try:
+    import asyncio
+except ImportError:  # pragma: no cover
+    asyncio = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import sqlite3
+except ImportError:  # pragma: no cover
+    sqlite3 = None
 
 
 __all__ = ['console', 'prog', 'usage', 'description', 'epilog',
-           'formatter_class', 'argument', 'argument_group',
-           'mutually_exclusive_group', 'subparsers', 'load_subcommands']
+           'formatter_class', 'argument', 'option_argument', 'use_options',
+           'argument_group', 'mutually_exclusive_group', 'subparsers',
+           'load_subcommands', 'quarantine_plugins', 'plugin_report',
+           'record_mapper', 'Shard', 'shard', 'Journal', 'checkpoint',
+           'pipeline', 'pipe_input', 'ShortCircuit', 'ResultCache',
+           'cached', 'singleflight', 'limit_concurrency', 'LazyDefault',
+           'LazyValue', 'lazy_type', 'ConverterCache', 'cached_converter',
+           'cache_help', 'low_memory']
+
+
+# Compatibility helpers for coroutine support
+_isawaitable = getattr(inspect, 'isawaitable', lambda obj: False)
+_isasyncgenfunction = getattr(inspect, 'isasyncgenfunction',
+                              lambda obj: False)
+_StopAsyncIteration = getattr(six.moves.builtins, 'StopAsyncIteration',
+                              StopIteration)
+
+# Per-thread event loops used by _run_steps()
+_loops = threading.local()
+
+# The attribute of the parsed arguments recording the path of adaptors
+# of the selected subcommands
+_path_attr = '_cli_tools_path'
+
+# The entrypoints frozen into a bundle built by ScriptAdaptor.bundle();
+# if set, entrypoints are looked up here rather than by scanning the
+# installed distributions
+_frozen_entrypoints = None
+
+# The number of seconds after which the lock and result files of
+# @singleflight() which have not been used are removed
+_flight_expiry = 10 * 60
+
+# Memory addresses in the representations of objects, which differ
+# from one process to the next
+_address_re = re.compile(r' at 0x[0-9a-fA-F]+')
+
+# Compact records of argument specifications: an entry in the list of
+# argument specifications, which is either an argument or a group; an
+# argument of a group; and a group
+_Spec = collections.namedtuple('_Spec', ['type', 'args', 'kwargs'])
+_ArgSpec = collections.namedtuple('_ArgSpec', ['args', 'kwargs'])
+_GroupSpec = collections.namedtuple('_GroupSpec', ['type', 'arguments'])
+
+# The outcome of loading a subcommand from an entrypoint
+_PluginLoad = collections.namedtuple(
+    '_PluginLoad', ['group', 'name', 'dist', 'seconds', 'error'])
+
+# Construct records without calling the Python-level __new__() of the
+# named tuple, which is noticeably slower when adding many arguments
+_make_spec = functools.partial(tuple.__new__, _Spec)
+_make_argspec = functools.partial(tuple.__new__, _ArgSpec)
+
+
+def _noop(arg):
+    """
+    A hook which does nothing.  This is the default arguments hook and
+    processor, shared by all ``ScriptAdaptor`` instances.
+
+    :param arg: The hook argument; ignored.
+    """
+
+    pass
+
+
+def _subcommand_group():
+    """
+    The function of a subcommand grouping node.  Grouping nodes are
+    created for the intermediate levels of entrypoints having dotted
+    names; the function is only called if none of the subcommands of
+    the node is selected.
+
+    :returns: An error message.
+    """
+
+    return 'a subcommand is required'
+
+
+def _intern(value):
+    """
+    Intern a string, so that equal strings used by many commands--such
+    as common subcommand names--are stored only once.
+
+    :param value: The value to intern.  Values other than native
+                  strings are returned unchanged.
+
+    :returns: The interned value.
+    """
+
+    if type(value) is str:
+        return six.moves.intern(value)
+    return value
 
 
 def _clean_text(text):
@@ -52,6 +179,652 @@ def _clean_text(text):
     return ' '.join(desc)
 
 
+def _edit_distance(a, b):
+    """
+    Compute the Levenshtein distance between two strings: the number
+    of single character insertions, deletions and substitutions needed
+    to turn one into the other.
+
+    :param a: The first string.
+    :param b: The second string.
+
+    :returns: The edit distance.
+    """
+
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+    for i, a_char in enumerate(a, 1):
+        current = [i]
+        for j, b_char in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (a_char != b_char)))
+        previous = current
+
+    return previous[-1]
+
+
+def _suggest(word, words, limit=3):
+    """
+    Suggest the words closest to a misspelled word.  Words within an
+    edit distance of half the length of the word (but at least 1) are
+    considered.  The words are scanned once; a word whose length
+    differs by more than that can't be in range, so its edit distance
+    isn't computed.
+
+    :param word: The misspelled word.
+    :param words: An iterable of the candidate words.
+    :param limit: The maximum number of suggestions.
+
+    :returns: A list of at most ``limit`` suggested words, beginning
+              with the closest; words at the same distance are
+              sorted.
+    """
+
+    max_distance = max(1, len(word) // 2)
+    found = []
+    for candidate in words:
+        if abs(len(candidate) - len(word)) > max_distance:
+            continue
+
+        distance = _edit_distance(word, candidate)
+        if distance <= max_distance:
+            found.append((distance, candidate))
+
+    return [candidate for _distance, candidate in sorted(found)[:limit]]
+
+
+def _key_bytes(key):
+    """
+    Convert an item key to bytes.  Text is encoded as UTF-8; keys
+    other than text or bytes are converted to text first.
+
+    :param key: The item key.
+
+    :returns: The key as bytes.
+    """
+
+    if isinstance(key, six.binary_type):
+        return key
+    if not isinstance(key, six.text_type):
+        key = six.text_type(key)
+    return key.encode('utf-8')
+
+
+def _cache_dir(name):
+    """
+    Compute the path of a cache directory.  The directory is placed
+    in the directory named by the ``XDG_CACHE_HOME`` environment
+    variable, or in "~/.cache".
+
+    :param name: The name of the cache directory.
+
+    :returns: The path of the cache directory.
+    """
+
+    base = (os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'cli_tools', name)
+
+
+def _fingerprint(path, content=False):
+    """
+    Compute a fingerprint of a file, which changes when the file does.
+
+    :param path: The path of the file.
+    :param content: If ``True``, the fingerprint is a digest of the
+                    file contents.  Otherwise, it is derived from the
+                    size and modification time of the file.
+
+    :returns: The fingerprint, as text.  A file which does not exist
+              has the fingerprint "-".
+    """
+
+    try:
+        if not content:
+            stat = os.stat(path)
+            return '%d:%r' % (stat.st_size, stat.st_mtime)
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    except (IOError, OSError):
+        return '-'
+
+
+def _terminal_width():
+    """
+    Determine the width of the terminal, as used by
+    ``argparse.HelpFormatter``.
+
+    :returns: The number of columns.
+    """
+
+    get_terminal_size = getattr(shutil, 'get_terminal_size', None)
+    if get_terminal_size:
+        return get_terminal_size().columns
+
+    try:
+        return int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        return 80
+
+
+def _import_target(target):
+    """
+    Import an object given its import path.
+
+    :param target: The import path, in the form "module:attribute".
+                   The attribute may be a dotted path; if it is
+                   omitted, the module itself is returned.
+
+    :returns: The object.
+    """
+
+    module, _sep, attr = target.partition(':')
+    obj = importlib.import_module(module)
+    for part in attr.split('.') if attr else []:
+        obj = getattr(obj, part)
+    return obj
+
+
+def _unknown_extra():
+    """
+    Determine the exception raised when loading an entrypoint requires
+    an unknown extra.  The exception is defined by ``pkg_resources``,
+    which is imported only when needed; if it has not been imported,
+    the exception cannot have been raised.
+
+    :returns: An exception class.
+    """
+
+    pkg_resources = sys.modules.get('pkg_resources')
+    return getattr(pkg_resources, 'UnknownExtra', ImportError)
+
+
+def _iter_entry_points(group):
+    """
+    Iterate over the entrypoints of a group.  In a bundle built by
+    ``ScriptAdaptor.bundle()``, the entrypoints are taken from the
+    index frozen into the bundle; otherwise, the installed
+    distributions are scanned using ``pkg_resources``.
+
+    :param group: The entrypoint group name.
+
+    :returns: An iterable of entrypoint objects.
+    """
+
+    if _frozen_entrypoints is not None:
+        return [_FrozenEntryPoint(*entry)
+                for entry in _frozen_entrypoints.get(group, ())]
+
+    import pkg_resources
+    return pkg_resources.iter_entry_points(group)
+
+
+def _module_files(name):
+    """
+    Find the source files to bundle for a module.  The whole top-level
+    package containing the module is included, so that the modules it
+    imports are available.  Only Python source files are included.
+
+    :param name: The name of the module.
+
+    :returns: A list of tuples of the path of each file and its name
+              within the bundle.
+
+    :raises ImportError: The module could not be imported.
+    :raises ValueError: The module is not a Python source file.
+    """
+
+    top_name = name.partition('.')[0]
+    top = importlib.import_module(top_name)
+    path = getattr(top, '__file__', None)
+    if not path:
+        raise ValueError('module %s has no source file' % top_name)
+
+    # For a package, walk its directory; note that a module may have a
+    # __path__ without being a package
+    if os.path.splitext(os.path.basename(path))[0] == '__init__':
+        package = os.path.dirname(path)
+        base = os.path.dirname(package)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(package):
+            dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+            for filename in sorted(filenames):
+                if filename.endswith('.py'):
+                    src = os.path.join(dirpath, filename)
+                    files.append(
+                        (src, os.path.relpath(src, base).replace(os.sep, '/'))
+                    )
+        return files
+
+    # Python 2 reports the compiled file
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    if not path.endswith('.py'):
+        raise ValueError('module %s cannot be bundled: %s' %
+                         (top_name, path))
+    return [(path, os.path.basename(path))]
+
+
+def _compile_source(src, arcname):
+    """
+    Compile a source file to bytecode, for inclusion in a bundle.
+
+    :param src: The path of the source file.
+    :param arcname: The name of the source file within the bundle,
+                    which is reported in tracebacks.
+
+    :returns: The contents of the compiled file.
+    """
+
+    fd, tmp = tempfile.mkstemp(suffix='.pyc')
+    os.close(fd)
+    try:
+        py_compile.compile(src, cfile=tmp, dfile=arcname, doraise=True)
+        with open(tmp, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(tmp)
+
+
+def _run_bundle(index, target):
+    """
+    Run the console script of a bundle built by
+    ``ScriptAdaptor.bundle()``.  This is called from the
+    "__main__.py" of the bundle.
+
+    :param index: A dictionary mapping entrypoint group names to lists
+                  of tuples of the name, import path and distribution
+                  of each entrypoint.
+    :param target: The import path of the decorated function.
+
+    :returns: The value returned by ``console()``.
+    """
+
+    global _frozen_entrypoints
+    _frozen_entrypoints = index
+
+    return _import_target(target).cli_tools.console()
+
+
+def _func_ident(func):
+    """
+    Compute a string identifying a function, for use in keys.
+
+    :param func: The function.
+
+    :returns: The module and name of the function.
+    """
+
+    return '%s.%s' % (getattr(func, '__module__', None),
+                      getattr(func, '__name__', None))
+
+
+def _digest_call(ident, kwargs, paths=(), content=False):
+    """
+    Compute a digest identifying a call of a function.
+
+    :param ident: A string identifying the function.
+    :param kwargs: A dictionary of the keyword arguments of the
+                   function.  The ``repr()`` of each value is used, so
+                   values must have a stable representation.
+    :param paths: A list of the paths of input files.
+    :param content: If ``True``, input files are fingerprinted using a
+                    digest of their contents; otherwise, their sizes
+                    and modification times are used.
+
+    :returns: The digest, as hexadecimal text.
+    """
+
+    digest = hashlib.sha256(_key_bytes(ident))
+    digest.update(b'\0')
+    digest.update(_key_bytes(repr(sorted(kwargs.items()))))
+    for path in paths:
+        digest.update(b'\0')
+        digest.update(_key_bytes(path))
+        digest.update(b'\0')
+        digest.update(_key_bytes(_fingerprint(path, content)))
+    return digest.hexdigest()
+
+
+def _makedirs(path):
+    """
+    Create a directory and its parents, if it does not exist.
+
+    :param path: The path of the directory.
+    """
+
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _write_atomic(path, data):
+    """
+    Write a file atomically, so that concurrent readers never see a
+    partial file.  The directory containing the file must exist.
+
+    :param path: The path of the file.
+    :param data: The bytes to write.
+    """
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def _acquire(lock, timeout=None, interval=0.1):
+    """
+    Acquire an exclusive lock on an open file.  The lock is released
+    when the file is closed.
+
+    :param lock: The open file.
+    :param timeout: The maximum number of seconds to wait for the
+                    lock.  If 0, the lock is only tried; if ``None``,
+                    the wait is unbounded.
+    :param interval: The number of seconds between attempts to take
+                     the lock, when ``timeout`` is not ``None``.
+
+    :returns: ``True`` if the lock was acquired.
+    """
+
+    if timeout is None:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return True
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+
+
+def _expire_flights(directory, expiry, now=None):
+    """
+    Remove the lock and result files of ``@singleflight()`` which have
+    not been used recently.  A result is only needed by the invocations
+    waiting when it was written, which read it as soon as the lock is
+    released.  A lock file is removed only if it is not held; an
+    invocation which opened it just before it was removed is merely
+    not coalesced with later ones.
+
+    :param directory: The directory holding the lock and result files.
+    :param expiry: The number of seconds since its last use after
+                   which a file is removed.
+    :param now: The current time.  Defaults to ``time.time()``.
+    """
+
+    cutoff = (time.time() if now is None else now) - expiry
+    for name in os.listdir(directory):
+        if not name.endswith(('.lock', '.result')):
+            continue
+
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            if name.endswith('.result'):
+                os.remove(path)
+                continue
+            with open(path, 'ab') as lock:
+                if _acquire(lock, 0):
+                    os.remove(path)
+        except EnvironmentError:
+            # Another invocation may have removed it first
+            pass
+
+
+def _acquire_slot(directory, name, slots, timeout=None, interval=0.1):
+    """
+    Acquire one of a fixed number of slots, implemented as lock files,
+    so that at most that many holders run at once across all the
+    processes on the host.
+
+    :param directory: The directory holding the slot lock files.
+    :param name: The name of the set of slots.
+    :param slots: The number of slots.
+    :param timeout: The maximum number of seconds to wait for a slot.
+                    If 0, each slot is only tried once; if ``None``,
+                    the wait is unbounded.
+    :param interval: The number of seconds between attempts to take a
+                     slot.
+
+    :returns: The open lock file of the acquired slot, which must be
+              closed to release the slot, or ``None`` if no slot was
+              acquired.
+    """
+
+    _makedirs(directory)
+    paths = [os.path.join(directory, '%s.%d.lock' % (name, i))
+             for i in six.moves.range(slots)]
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        for path in paths:
+            lock = open(path, 'ab')
+            if _acquire(lock, 0):
+                return lock
+            lock.close()
+
+        delay = interval
+        if deadline is not None:
+            delay = min(delay, deadline - time.time())
+            if delay <= 0:
+                return None
+        time.sleep(delay)
+
+
+class _Session(object):
+    """
+    Hold the state of a running session.  See
+    ``ScriptAdaptor.session_processor()``.
+    """
+
+    def __init__(self, values, post, post_async):
+        """
+        Initialize a ``_Session`` object.
+
+        :param values: A dictionary of attributes to set on the parsed
+                       arguments of each call in the session, or
+                       ``None``.
+        :param post: The session processor generator, if it has a post
+                     phase, or ``None``.
+        :param post_async: A boolean indicating whether ``post`` is an
+                           asynchronous generator.
+        """
+
+        self.values = values or {}
+        self.post = post
+        self.post_async = post_async
+
+
+class _Done(object):
+    """
+    Wrap the final value of a step generator.  Step generators, such
+    as ``ScriptAdaptor._call_steps()``, yield awaitables to be awaited
+    by a driver, then yield an instance of this class to signal
+    completion.
+    """
+
+    def __init__(self, value):
+        """
+        Initialize a ``_Done`` object.
+
+        :param value: The final value of the step generator.
+        """
+
+        self.value = value
+
+
+def _event_loop():
+    """
+    Retrieve the event loop used to run awaitables from synchronous
+    code.  One loop is created per thread and kept open, so that
+    resources bound to the loop may be used across calls.
+
+    :returns: An ``asyncio`` event loop.
+    """
+
+    loop = getattr(_loops, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        _loops.loop = loop
+
+    return loop
+
+
+def _run_steps(steps):
+    """
+    Drive a step generator to completion from synchronous code.
+    Awaitables yielded by the generator are run to completion on the
+    event loop returned by ``_event_loop()``.
+
+    :param steps: The step generator.
+
+    :returns: The final value of the step generator.
+    """
+
+    def throw(exc_info):
+        return steps.throw(*exc_info)
+
+    send = steps.send
+    value = None
+    try:
+        while True:
+            step = send(value)
+            if isinstance(step, _Done):
+                return step.value
+
+            try:
+                value = _event_loop().run_until_complete(step)
+                send = steps.send
+            except Exception:
+                value = sys.exc_info()
+                send = throw
+    finally:
+        steps.close()
+
+
+def _schedule_steps(steps):
+    """
+    Drive a step generator from within a running event loop.
+    Awaitables yielded by the generator are scheduled on the running
+    loop.
+
+    :param steps: The step generator.
+
+    :returns: An ``asyncio.Future`` whose result will be the final
+              value of the step generator.
+    """
+
+    if asyncio is None:
+        raise RuntimeError('asyncio is not available')
+
+    future = asyncio.Future()
+    current = [None]
+
+    def throw(exc):
+        return steps.throw(type(exc), exc, exc.__traceback__)
+
+    def step(send, value):
+        try:
+            item = send(value)
+        except Exception as exc:
+            steps.close()
+            future.set_exception(exc)
+            return
+
+        if isinstance(item, _Done):
+            steps.close()
+            future.set_result(item.value)
+            return
+
+        current[0] = asyncio.ensure_future(item)
+        current[0].add_done_callback(done)
+
+    def done(task):
+        if future.cancelled():
+            steps.close()
+        elif task.cancelled():
+            steps.close()
+            future.cancel()
+        elif task.exception() is not None:
+            step(throw, task.exception())
+        else:
+            step(steps.send, task.result())
+
+    def cancel(fut):
+        if fut.cancelled() and current[0] is not None:
+            current[0].cancel()
+
+    future.add_done_callback(cancel)
+    step(steps.send, None)
+    return future
+
+
+def _then(future, func):
+    """
+    Chain a function onto the result of a future.
+
+    :param future: An ``asyncio.Future``.
+    :param func: A function to apply to the result of the future.
+
+    :returns: An ``asyncio.Future`` whose result will be the result of
+              ``func``.
+    """
+
+    result = asyncio.Future()
+
+    def done(fut):
+        if fut.cancelled():
+            result.cancel()
+        elif fut.exception() is not None:
+            result.set_exception(fut.exception())
+        else:
+            result.set_result(func(fut.result()))
+
+    future.add_done_callback(done)
+    return result
+
+
+def _console_result(call_result):
+    """
+    Convert the result of ``ScriptAdaptor.safe_call()`` into the
+    return value of ``ScriptAdaptor.console()``.
+
+    :param call_result: A tuple of the function return value and
+                        exception information.
+
+    :returns: The function return value, or the string value of the
+              exception.
+    """
+
+    result, exc_info = call_result
+    if exc_info:
+        return str(exc_info[1])
+    return result
+
+
 def expose(func):
     """
     A decorator for ``ScriptAdaptor`` methods.  Methods so decorated
@@ -108,6 +881,17 @@ class ScriptAdaptor(object):
     calling the function from the console.
     """
 
+    # Large command trees may have many thousands of adaptors
+    __slots__ = (
+        '_func', '_is_class', '_run', '_args_hook', '_processor',
+        '_arguments', '_groups', '_subcommands', '_entrypoints', '_mapper',
+        '_parent', '_session_processor', '_session', '_session_depth',
+        '_middleware', '_timings', '_option_sets', '_help_cache',
+        '_low_memory', '_plugin_loads', '_quarantine', '_loaded_groups',
+        'do_subs', 'pipe_separator', 'pipe_input', 'subkwargs', 'prog',
+        'usage', 'description', 'epilog', 'formatter_class', '__weakref__',
+    )
+
     @classmethod
     def _get_adaptor(cls, func):
         """
@@ -146,13 +930,28 @@ class ScriptAdaptor(object):
         self._is_class = (is_class if is_class is not None
                           else inspect.isclass(func))
         self._run = 'run' if self._is_class else None
-        self._args_hook = lambda x: None
-        self._processor = lambda x: None
+        self._args_hook = _noop
+        self._processor = _noop
         self._arguments = []
         self._groups = {}
         self._subcommands = {}
-        self._entrypoints = set()
+        self._entrypoints = frozenset()
+        self._mapper = None
+        self._parent = None
+        self._session_processor = None
+        self._session = None
+        self._session_depth = 0
+        self._middleware = ()
+        self._timings = ()
+        self._option_sets = {}
+        self._help_cache = None
+        self._low_memory = None
+        self._plugin_loads = ()
+        self._quarantine = None
+        self._loaded_groups = frozenset()
         self.do_subs = False
+        self.pipe_separator = None
+        self.pipe_input = None
         self.subkwargs = {}
         self.prog = None
         self.usage = None
@@ -160,11 +959,6 @@ class ScriptAdaptor(object):
         self.epilog = None
         self.formatter_class = argparse.HelpFormatter
 
-        # This will be an attribute name for the adaptor implementing
-        # the subcommand; this allows for the potential of arbitrary
-        # depth on subcommands
-        self._subcmd_attr = '_script_adaptor_%x' % id(self)
-
     def _add_argument(self, args, kwargs, group):
         """
         Add an argument specification to the list of argument
@@ -183,10 +977,10 @@ class ScriptAdaptor(object):
         """
 
         if group:
-            self._groups.setdefault(group, dict(arguments=[]))
-            self._groups[group]['arguments'].insert(0, (args, kwargs))
+            group_spec = self._groups.setdefault(group, _GroupSpec(None, []))
+            group_spec.arguments.insert(0, _make_argspec((args, kwargs)))
         else:
-            self._arguments.insert(0, ('argument', args, kwargs))
+            self._arguments.insert(0, _make_spec(('argument', args, kwargs)))
 
     def _add_group(self, group, type, kwargs):
         """
@@ -205,18 +999,71 @@ class ScriptAdaptor(object):
         """
 
         # Make sure the group exists
-        self._groups.setdefault(group, dict(arguments=[]))
+        group_spec = self._groups.setdefault(group, _GroupSpec(None, []))
 
         # Look out for the pre-existence of the group
-        if 'type' in self._groups[group]:
+        if group_spec.type is not None:
             raise argparse.ArgumentError(None, "group %s: conflicting groups" %
                                          group)
 
         # Save the data
-        self._groups[group]['type'] = type
+        self._groups[group] = group_spec._replace(type=type)
 
         # Add the group to the argument specification list
-        self._arguments.insert(0, ('group', group, kwargs))
+        self._arguments.insert(0, _Spec('group', group, kwargs))
+
+    def _add_option(self, option_set, args, kwargs):
+        """
+        Add an argument specification to a named option set.  The
+        argument specification is inserted at the beginning of the
+        option set, so that the decorators may be added in natural
+        order.
+
+        :param option_set: The name of the option set.
+        :param args: The positional arguments of the argument
+                     specification.
+        :param kwargs: The keyword arguments of the argument
+                       specification.
+        """
+
+        options = self._option_sets.setdefault(option_set, [])
+        options.insert(0, _make_argspec((args, kwargs)))
+
+    def _use_options(self, option_set, kwargs):
+        """
+        Add a reference to a named option set to the list of argument
+        specifications.  The reference is inserted at the beginning of
+        the list of argument specifications, so that the decorators
+        may be added in natural order.
+
+        :param option_set: The name of the option set.
+        :param kwargs: The keyword arguments of an argument group to
+                       place the options in.  If empty, the options
+                       are added directly to the parser.
+        """
+
+        self._arguments.insert(0, _Spec('options', option_set, kwargs))
+
+    def _find_options(self, option_set):
+        """
+        Look up a named option set.  The option set is searched for on
+        the adaptor itself, then on the adaptors of which it is a
+        subcommand, beginning with the innermost.
+
+        :param option_set: The name of the option set.
+
+        :returns: The list of argument specifications of the option
+                  set.
+        """
+
+        adaptor = self
+        while adaptor is not None:
+            if option_set in adaptor._option_sets:
+                return adaptor._option_sets[option_set]
+            adaptor = adaptor._parent
+
+        raise argparse.ArgumentError(None, "option set %s: not defined" %
+                                     option_set)
 
     def _add_subcommand(self, name, adaptor):
         """
@@ -226,7 +1073,8 @@ class ScriptAdaptor(object):
         :param adaptor: The corresponding ScriptAdaptor instance.
         """
 
-        self._subcommands[name] = adaptor
+        self._subcommands[_intern(name)] = adaptor
+        adaptor._parent = self
         self.do_subs = True
 
     def _add_extensions(self, group):
@@ -241,11 +1089,47 @@ class ScriptAdaptor(object):
         :param group: The entrypoint group name.
         """
 
-        self._entrypoints.add(group)
+        self._entrypoints |= frozenset([group])
 
         # We are now in subparsers mode
         self.do_subs = True
 
+    def _lineage(self):
+        """
+        Compute the lineage of the adaptor: the adaptors of which it is
+        a subcommand, and the adaptor itself.
+
+        :returns: A list of adaptors, beginning with the outermost.
+        """
+
+        lineage = []
+        adaptor = self
+        while adaptor is not None:
+            lineage.append(adaptor)
+            adaptor = adaptor._parent
+        lineage.reverse()
+        return lineage
+
+    def _stages(self):
+        """
+        Compute the stages wrapping a call of the function: the
+        processor, followed by the middleware of the adaptors of which
+        the adaptor is a subcommand, and finally the middleware of the
+        adaptor itself.  Only middleware registered as inheritable is
+        included from the other adaptors.
+
+        :returns: A list of tuples of the stage name and the stage
+                  function, beginning with the outermost.
+        """
+
+        stages = [('processor', self._processor)]
+        for adaptor in self._lineage():
+            for func, inherit in adaptor._middleware:
+                if inherit or adaptor is self:
+                    stages.append((getattr(func, '__name__', repr(func)),
+                                   func))
+        return stages
+
     def _process_entrypoints(self):
         """
         Perform a walk of all entrypoint groups declared using
@@ -253,25 +1137,155 @@ class ScriptAdaptor(object):
         building the subcommand processor.
         """
 
-        # Walk the set of all declared entrypoints
+        # Walk the set of all declared entrypoints; those with dotted
+        # names are added last, so they may extend the others
+        dotted = []
+        loads = []
         for group in self._entrypoints:
-            for ep in pkg_resources.iter_entry_points(group):
-                try:
-                    func = ep.load()
-                    self._add_subcommand(ep.name, func.cli_tools)
-                except (ImportError, AttributeError,
-                        pkg_resources.UnknownExtra):
-                    # Ignore any expected errors
-                    pass
+            for ep in _iter_entry_points(group):
+                if '.' in ep.name:
+                    dotted.append((group, ep))
+                    continue
+
+                loads.append(self._load_entrypoint(group, ep))
+
+        for group, ep in dotted:
+            load = self._add_nested_entrypoint(group, ep)
+            if load is not None:
+                loads.append(load)
 
         # We've processed these entrypoints; avoid double-processing
-        self._entrypoints = set()
+        self._loaded_groups |= self._entrypoints
+        self._entrypoints = frozenset()
+        self._plugin_loads += tuple(loads)
 
-    @expose
-    def args_hook(self, func):
+    def _load_entrypoint(self, group, ep):
         """
-        Sets a hook for constructing the arguments.  This hook could
-        be used to allow, for instance, a set of authentication
+        Load an entrypoint and add its function as a subcommand.  The
+        expected errors are recorded rather than raised.  If a
+        quarantine has been set up with ``@quarantine_plugins()``, an
+        entrypoint which failed to load is not loaded again until its
+        distribution changes.
+
+        :param group: The entrypoint group name.
+        :param ep: The ``pkg_resources.EntryPoint``.
+
+        :returns: A ``_PluginLoad`` describing the outcome.
+        """
+
+        key, load = self._check_quarantine(group, ep)
+        if load is not None:
+            return load
+
+        start = time.time()
+        error = None
+        try:
+            func = ep.load()
+            self._add_subcommand(ep.name, func.cli_tools)
+        except (ImportError, AttributeError, _unknown_extra()) as exc:
+            # Record any expected errors
+            error = self._plugin_failed(key, exc)
+
+        return _PluginLoad(group, ep.name, str(ep.dist),
+                           time.time() - start, error)
+
+    def _check_quarantine(self, group, ep):
+        """
+        Look up an entrypoint in the quarantine set up with
+        ``@quarantine_plugins()``.
+
+        :param group: The entrypoint group name.
+        :param ep: The ``pkg_resources.EntryPoint``.
+
+        :returns: A tuple of the quarantine key of the entrypoint, or
+                  ``None`` if there is no quarantine, and a
+                  ``_PluginLoad`` recording that the entrypoint was
+                  skipped, or ``None`` if it should be loaded.
+        """
+
+        if self._quarantine is None:
+            return None, None
+
+        metadata = getattr(ep.dist, 'egg_info', None)
+        key = self._quarantine.key(str(ep), {
+            'group': group,
+            'dist': str(ep.dist),
+        }, [metadata] if metadata else [])
+        hit, error = self._quarantine.get(key)
+        if hit:
+            return key, _PluginLoad(group, ep.name, str(ep.dist), None,
+                                    error)
+        return key, None
+
+    def _plugin_failed(self, key, exc):
+        """
+        Quarantine an entrypoint which failed to load.
+
+        :param key: The quarantine key of the entrypoint, or ``None``
+                    if there is no quarantine.
+        :param exc: The exception raised when loading the entrypoint.
+
+        :returns: The reason the entrypoint failed to load.
+        """
+
+        error = '%s: %s' % (exc.__class__.__name__, exc)
+        if key is not None:
+            try:
+                self._quarantine.put(key, error)
+            except EnvironmentError:
+                # We'll just try again next time
+                pass
+        return error
+
+    def _add_nested_entrypoint(self, group, ep):
+        """
+        Add a subcommand for an entrypoint having a dotted name, such
+        as "db.migrate.up".  Each component but the last names a level
+        of subcommands; levels which do not already exist are created
+        as grouping nodes, and a level declared with
+        ``lazy_subcommand()`` is imported so it can be extended.  The
+        entrypoint itself is not loaded until its subcommand is
+        selected; the outcome is then recorded as by
+        ``_load_entrypoint()``.
+
+        :param group: The entrypoint group name.
+        :param ep: The ``pkg_resources.EntryPoint``.
+
+        :returns: A ``_PluginLoad`` recording that the entrypoint was
+                  skipped, if it is quarantined or a level cannot be
+                  imported, or ``None``.
+        """
+
+        key, load = self._check_quarantine(group, ep)
+        if load is not None:
+            return load
+
+        path = ep.name.split('.')
+        adaptor = self
+        for name in path[:-1]:
+            node = adaptor._subcommands.get(name)
+            if isinstance(node, _LazySubcommand):
+                try:
+                    node = node.load()
+                except argparse.ArgumentError as exc:
+                    # Keep the placeholder to report the error
+                    return _PluginLoad(group, ep.name, str(ep.dist), 0.0,
+                                       'cannot extend %s' % exc)
+            elif node is None:
+                node = ScriptAdaptor(_subcommand_group, False)
+                node.description = None
+                adaptor._add_subcommand(name, node)
+            adaptor = node
+
+        adaptor._add_subcommand(path[-1], _LazySubcommand(
+            path[-1], _TrackedEntryPoint(self, group, ep, key)))
+        return None
+
+    @expose
+    def args_hook(self, func):
+        """
+        Sets a hook for constructing the arguments.  This hook could
+        be used to allow, for instance, a set of authentication
         plugins to add their configuration options to the argument
         parser.  This method may be used as a decorator, e.g.:
 
@@ -337,6 +1351,209 @@ class ScriptAdaptor(object):
         self._processor = func
         return func
 
+    @expose
+    def middleware(self, func, inherit=True):
+        """
+        Adds a middleware stage for the underlying function.  A
+        middleware stage is a processor, but any number of them may be
+        added; they are run in the order added, wrapped around the
+        underlying function like the layers of an onion, within the
+        processor.  That is, the pre phases run from the first stage
+        added to the last, and the post phases in the reverse order.
+        This method may be used as a decorator, e.g.:
+
+            @console
+            def func():
+                pass
+
+            @func.middleware
+            def _auth(args):
+                authenticate(args)
+
+        A stage may provide the result itself, skipping the underlying
+        function and any stages inside it, by returning (or
+        ``yield``ing, from the first ``yield`` statement) a
+        ``ShortCircuit`` instance; the post phases of the stages
+        outside it still run.  Middleware of a function also applies
+        to its subcommands, unless ``inherit`` is ``False``.
+
+        :param func: The function to be added as a middleware stage.
+        :param inherit: A boolean indicating whether the stage applies
+                        to subcommands of the function.  Defaults to
+                        ``True``.
+
+        :returns: The function, allowing this method to be used as a
+                  decorator.
+        """
+
+        self._middleware += ((func, inherit),)
+        return func
+
+    @expose
+    def session_processor(self, func):
+        """
+        Sets a session processor for the underlying function.  A
+        session processor is like a processor, except that it runs
+        once per session, rather than once per call, allowing
+        expensive resources to be shared by all the calls in a
+        session.  A session begins with the first call of the function
+        (or of one of its subcommands), and ends when
+        ``close_session()`` is called; ``console()`` and ``shell()``
+        each run in a session, and ``session()`` may be used to run
+        several calls in one session.  This method may be used as a
+        decorator, e.g.:
+
+            @console
+            def func(conn):
+                pass
+
+            @func.session_processor
+            def _session(args):
+                conn = connect(args.dsn)
+                yield {'conn': conn}
+                conn.close()
+
+        If the session processor is a regular function, it will be
+        called at the beginning of the session, and it will be passed
+        the parsed arguments of the first call.  It may return a
+        dictionary, which will be used to set attributes of the parsed
+        arguments of every call in the session.
+
+        If the session processor is a generator, the value yielded by
+        the first ``yield`` statement is used in the same way, and the
+        remainder will be executed at the end of the session.
+
+        :param func: The function to be installed as a session
+                     processor.
+
+        :returns: The function, allowing this method to be used as a
+                  decorator.
+        """
+
+        self._session_processor = func
+        return func
+
+    @expose
+    @contextlib.contextmanager
+    def session(self):
+        """
+        A context manager which runs the calls within it in a single
+        session.  Session processors of the function and its
+        subcommands run when first needed, and their post phases run
+        when the outermost ``session()`` exits.  So do those of the
+        functions of which it is a subcommand, if they were started
+        within the session.
+
+        :returns: A context manager.
+        """
+
+        running = self._running_ancestors()
+        self._session_depth += 1
+        try:
+            yield self
+        finally:
+            self._session_depth -= 1
+            if not self._session_depth:
+                self.close_session()
+                _run_steps(self._close_steps(
+                    self._end_ancestor_sessions(running)))
+
+    @expose
+    def close_session(self):
+        """
+        End the session.  The post phases of any running session
+        processors of the function and its subcommands are run,
+        beginning with the innermost subcommands.
+        """
+
+        return _run_steps(self._close_steps())
+
+    def _end_sessions(self):
+        """
+        Detach the running sessions of the function and its
+        subcommands.
+
+        :returns: A list of the ``_Session`` objects which have a post
+                  phase, beginning with the innermost subcommands.
+        """
+
+        sessions = []
+        for adaptor in self._subcommands.values():
+            sessions.extend(adaptor._end_sessions())
+
+        session, self._session = self._session, None
+        if session and session.post:
+            sessions.append(session)
+        return sessions
+
+    def _running_ancestors(self):
+        """
+        Find the adaptors of which this adaptor is a subcommand which
+        have a running session.
+
+        :returns: A list of the adaptors.
+        """
+
+        return [adaptor for adaptor in self._lineage()[:-1]
+                if adaptor._session is not None]
+
+    def _end_ancestor_sessions(self, running):
+        """
+        Detach the sessions of the adaptors of which this adaptor is a
+        subcommand which were started within a session of this
+        adaptor.  Calling a subcommand starts the session processors
+        of its whole lineage, but only this adaptor's session ends
+        them.  Sessions which were already running, and those of
+        adaptors within a ``session()`` of their own, are left alone.
+
+        :param running: The adaptors returned by
+                        ``_running_ancestors()`` when the session of
+                        this adaptor began.
+
+        :returns: A list of the ``_Session`` objects which have a post
+                  phase, beginning with the innermost.
+        """
+
+        sessions = []
+        for adaptor in reversed(self._lineage()[:-1]):
+            if (adaptor._session is None or adaptor._session_depth or
+                    any(adaptor is other for other in running)):
+                continue
+
+            session, adaptor._session = adaptor._session, None
+            if session.post:
+                sessions.append(session)
+        return sessions
+
+    def _close_steps(self, sessions=None):
+        """
+        End the session.  This is a step generator implementing
+        ``close_session()``; see ``_call_steps()``.
+
+        :param sessions: The ``_Session`` objects to end.  Defaults to
+                         those detached by ``_end_sessions()``.
+        """
+
+        if sessions is None:
+            sessions = self._end_sessions()
+
+        for session in sessions:
+            post = session.post
+            if session.post_async:
+                try:
+                    yield post.__anext__()
+                except _StopAsyncIteration:
+                    pass
+                yield post.aclose()
+            else:
+                try:
+                    six.next(post)
+                except StopIteration:
+                    pass
+                post.close()
+
+        yield _Done(None)
+
     @expose
     def subcommand(self, name=None):
         """
@@ -387,6 +1604,116 @@ class ScriptAdaptor(object):
 
         return decorator
 
+    @expose
+    def lazy_subcommand(self, name, target, help=None):
+        """
+        Declare a subcommand by the import path of the function
+        implementing it, rather than by the function itself.  The
+        function is imported only when the subcommand is selected on
+        the command line, so large command trees need not import every
+        subcommand on every invocation:
+
+            function.lazy_subcommand('migrate', 'tool.db:migrate',
+                                     help='Migrate the database.')
+
+        :param name: The name of the subcommand.
+        :param target: The import path of the function implementing
+                       the subcommand, in the form "module:function".
+        :param help: The description of the subcommand to use until
+                     the function is imported.
+        """
+
+        self._add_subcommand(name, _LazySubcommand(name, target, help))
+
+    @expose
+    def add_arguments(self, specs):
+        """
+        Add a list of argument specifications in a single call.  This
+        is intended for console scripts whose arguments are generated
+        rather than written out as decorators, and runs in time linear
+        in the number of arguments.  The result is the same as applying
+        the @argument() decorator for each argument specification, in
+        the order given, above the decorators already applied.
+
+        :param specs: An iterable of tuples of the positional arguments
+                      and the keyword arguments of each argument
+                      specification.  As for @argument(), a ``group``
+                      keyword argument places the argument in the named
+                      argument group.
+        """
+
+        arguments = []
+        groups = {}
+        for args, kwargs in specs:
+            group = kwargs.get('group')
+            if 'group' in kwargs:
+                kwargs = dict(kwargs)
+                del kwargs['group']
+
+            if group:
+                groups.setdefault(group, []).append(
+                    _make_argspec((args, kwargs)))
+            else:
+                arguments.append(_make_spec(('argument', args, kwargs)))
+
+        # Prepend the arguments, preserving their order
+        for group, group_args in groups.items():
+            group_spec = self._groups.setdefault(group, _GroupSpec(None, []))
+            group_spec.arguments[:0] = group_args
+        self._arguments[:0] = arguments
+
+    @expose
+    def add_groups(self, specs):
+        """
+        Add a list of argument group specifications in a single call.
+        This runs in time linear in the number of groups, and the
+        result is the same as applying the @argument_group() or
+        @mutually_exclusive_group() decorator for each group
+        specification, in the order given, above the decorators
+        already applied.  If any of the groups is already defined, an
+        ``argparse.ArgumentError`` is raised and no groups are added.
+
+        :param specs: An iterable of tuples of the group name, the
+                      group type--either "group" or "exclusive"--and
+                      the keyword arguments of each group
+                      specification.
+        """
+
+        specs = list(specs)
+
+        # Look out for the pre-existence of the groups
+        seen = set()
+        for group, type, kwargs in specs:
+            group_spec = self._groups.get(group)
+            if group in seen or (group_spec and group_spec.type is not None):
+                raise argparse.ArgumentError(
+                    None, "group %s: conflicting groups" % group)
+            seen.add(group)
+
+        # Save the data and prepend the groups, preserving their order
+        for group, type, kwargs in specs:
+            group_spec = self._groups.setdefault(group, _GroupSpec(None, []))
+            self._groups[group] = group_spec._replace(type=type)
+        self._arguments[:0] = [_Spec('group', group, kwargs)
+                               for group, type, kwargs in specs]
+
+    @expose
+    def add_subcommands(self, subcommands):
+        """
+        Add several subcommands in a single call.  This is equivalent
+        to applying the @subcommand() decorator to each function.
+
+        :param subcommands: A dictionary, or an iterable of tuples,
+                            mapping subcommand names to the
+                            implementing functions.
+        """
+
+        if hasattr(subcommands, 'items'):
+            subcommands = subcommands.items()
+
+        for name, func in subcommands:
+            self._add_subcommand(name, self._get_adaptor(func))
+
     @expose
     def setup_args(self, parser):
         """
@@ -414,8 +1741,8 @@ class ScriptAdaptor(object):
                 parser.add_argument(*args, **kwargs)
             elif arg_type == 'group':
                 # Get the group information
-                arguments = self._groups[args]['arguments']
-                type = self._groups[args]['type']
+                arguments = self._groups[args].arguments
+                type = self._groups[args].type
 
                 # Create the group in the parser
                 if type == 'group':
@@ -429,12 +1756,25 @@ class ScriptAdaptor(object):
                 # Set up all the arguments
                 for a_args, a_kwargs in arguments:
                     group.add_argument(*a_args, **a_kwargs)
+            elif arg_type == 'options':
+                # Options are shared with other subcommands
+                options = self._find_options(args)
+                group = (parser.add_argument_group(**kwargs) if kwargs
+                         else parser)
+                for a_args, a_kwargs in options:
+                    group.add_argument(*a_args, **a_kwargs)
 
         # If we have subcommands, set up the parser appropriately
         if self.do_subs:
             self._process_entrypoints()
-            subparsers = parser.add_subparsers(**self.subkwargs)
-            for cmd, adaptor in self._subcommands.items():
+            subkwargs = dict(self.subkwargs)
+            action = subkwargs.setdefault('action', _LazySubParsersAction)
+            lazy = (isinstance(action, six.class_types) and
+                    issubclass(action, _LazySubParsersAction))
+            subparsers = parser.add_subparsers(**subkwargs)
+            for cmd, adaptor in list(self._subcommands.items()):
+                if not lazy and isinstance(adaptor, _LazySubcommand):
+                    adaptor = adaptor.load()
                 cmd_parser = subparsers.add_parser(
                     cmd,
                     prog=adaptor.prog,
@@ -443,11 +1783,17 @@ class ScriptAdaptor(object):
                     epilog=adaptor.epilog,
                     formatter_class=adaptor.formatter_class,
                 )
-                adaptor.setup_args(cmd_parser)
 
-                # Remember which adaptor implements the subcommand
-                defaults = {self._subcmd_attr: adaptor}
-                cmd_parser.set_defaults(**defaults)
+                if lazy:
+                    # Remember which adaptor implements the
+                    # subcommand; its arguments are set up only if
+                    # it's selected
+                    subparsers.bind(cmd_parser, adaptor)
+                else:
+                    # Some other action; set up the arguments now, and
+                    # record the adaptor as the path
+                    adaptor.setup_args(cmd_parser)
+                    cmd_parser.set_defaults(**{_path_attr: (adaptor,)})
 
         # If the hook has a post phase, run it
         if post:
@@ -522,167 +1868,2425 @@ class ScriptAdaptor(object):
         # remains
         if argspec.keywords:
             for key, value in args.__dict__.items():
-                if key in kwargs:
-                    # Already handled
+                if key in kwargs or key == _path_attr:
+                    # Already handled, or internal to cli_tools
                     continue
                 kwargs[key] = value
 
         return kwargs
 
-    @expose
-    def safe_call(self, args):
+    def _call_steps(self, args):
         """
-        Call the processor and the underlying function.  If the
-        ``debug`` attribute of ``args`` exists and is ``True``, any
-        exceptions raised by the underlying function will be
-        re-raised.
+        Call the processor and the underlying function.  This is a
+        generator implementing both ``safe_call()`` and
+        ``safe_call_async()``: each awaitable it yields (such as the
+        coroutine returned by an ``async def`` function) must be
+        awaited by the driver, which sends the result back in (or
+        throws the exception raised).  The final value yielded is a
+        ``_Done`` instance wrapping the tuple of the function return
+        value and exception information.
 
         :param args: This should be an ``argparse.Namespace`` object;
                      the keyword arguments for the function will be
                      derived from it.
-
-        :returns: A tuple of the function return value and exception
-                  information.  Only one of these values will be
-                  non-``None``.
         """
 
-        # Run the processor
-        post = None
-        if inspect.isgeneratorfunction(self._processor):
-            post = self._processor(args)
+        # Compute the lazy defaults of arguments which were not given
+        if args is not None:
             try:
-                six.next(post)
-            except StopIteration:
-                # Won't be doing any post-processing anyway
-                post = None
-        else:
-            self._processor(args)
+                LazyDefault.resolve(args)
+            except Exception:
+                if getattr(args, 'debug', False):
+                    # Re-raise if desired
+                    raise
+                yield _Done((None, sys.exc_info()))
+                return
 
-        # Initialize the results
+        # Start any sessions which have not yet been started, and
+        # apply their values to the arguments
+        for adaptor in self._lineage():
+            proc = adaptor._session_processor
+            if proc is None:
+                continue
+
+            if adaptor._session is None:
+                post = None
+                post_async = False
+                if inspect.isgeneratorfunction(proc):
+                    post = proc(args)
+                    try:
+                        values = six.next(post)
+                    except StopIteration:
+                        post = values = None
+                elif _isasyncgenfunction(proc):
+                    post = proc(args)
+                    post_async = True
+                    try:
+                        values = yield post.__anext__()
+                    except _StopAsyncIteration:
+                        post = values = None
+                else:
+                    values = proc(args)
+                    if _isawaitable(values):
+                        values = yield values
+                adaptor._session = _Session(values, post, post_async)
+
+            for key, value in adaptor._session.values.items():
+                setattr(args, key, value)
+
+        # Make sure there's a value for the pipeline input
+        if (self.pipe_input and args is not None and
+                not hasattr(args, self.pipe_input)):
+            setattr(args, self.pipe_input, None)
+
+        # Run the pre phases of the processor and middleware, from
+        # the outermost in
+        timings = []
+        posts = []
         result = None
         exc_info = None
-
-        try:
-            # Call the function
-            result = self._func(**self.get_kwargs(self._func, args))
-        except Exception:
-            if args and getattr(args, 'debug', False):
-                # Re-raise if desired
-                raise
-            exc_info = sys.exc_info()
-
-        if self._is_class:
-            # All we've done so far is initialize the class; now we
-            # need to actually run it
+        short_circuit = None
+        for name, func in self._stages():
+            start = time.time()
+            post = None
+            post_async = False
             try:
-                meth = getattr(result, self._run)
-                result = meth(**self.get_kwargs(meth, args))
+                if inspect.isgeneratorfunction(func):
+                    post = func(args)
+                    try:
+                        pre = six.next(post)
+                    except StopIteration:
+                        # Won't be doing any post-processing anyway
+                        post = pre = None
+                elif _isasyncgenfunction(func):
+                    post = func(args)
+                    post_async = True
+                    try:
+                        pre = yield post.__anext__()
+                    except _StopAsyncIteration:
+                        # Won't be doing any post-processing anyway
+                        post = pre = None
+                else:
+                    pre = func(args)
+                    if _isawaitable(pre):
+                        pre = yield pre
             except Exception:
                 if args and getattr(args, 'debug', False):
                     # Re-raise if desired
                     raise
-                result = None  # must clear result
                 exc_info = sys.exc_info()
+                post = pre = None
+
+            if isinstance(pre, ShortCircuit):
+                # The stage supplied the result; skip its post phase
+                # and everything inside it
+                short_circuit = pre
+                if post and post_async:
+                    yield post.aclose()
+                elif post:
+                    post.close()
+                post = None
 
-        # If the processor has a post phase, run it
-        if post:
+            timings.append([name, time.time() - start])
+            if post:
+                posts.append((len(timings) - 1, post, post_async))
+
+            if exc_info or short_circuit:
+                break
+
+        if short_circuit:
+            result = short_circuit.result
+        elif not exc_info:
             try:
-                if exc_info:
-                    # Overwrite the result and exception information
-                    result = post.throw(*exc_info)
-                    exc_info = None
+                # Call the function, or stream records through it
+                if self._mapper:
+                    result = self._mapper(self, args)
                 else:
-                    result = post.send(result)
-            except StopIteration:
-                # No result replacement...
-                pass
+                    result = self._func(**self.get_kwargs(self._func, args))
+                    if _isawaitable(result):
+                        result = yield result
             except Exception:
-                # Overwrite the result and exception information
+                if args and getattr(args, 'debug', False):
+                    # Re-raise if desired
+                    raise
+                result = None  # must clear result
                 exc_info = sys.exc_info()
-                result = None
 
-            post.close()
+            if self._is_class and not exc_info:
+                # All we've done so far is initialize the class; now
+                # we need to actually run it
+                try:
+                    meth = getattr(result, self._run)
+                    result = meth(**self.get_kwargs(meth, args))
+                    if _isawaitable(result):
+                        result = yield result
+                except Exception:
+                    if args and getattr(args, 'debug', False):
+                        # Re-raise if desired
+                        raise
+                    result = None  # must clear result
+                    exc_info = sys.exc_info()
+
+        # Run the post phases, from the innermost out
+        for index, post, post_async in reversed(posts):
+            start = time.time()
+            if post_async:
+                try:
+                    if exc_info:
+                        # Overwrite the result and exception information
+                        result = yield post.athrow(*exc_info)
+                        exc_info = None
+                    else:
+                        result = yield post.asend(result)
+                except _StopAsyncIteration:
+                    # No result replacement...
+                    pass
+                except Exception:
+                    # Overwrite the result and exception information
+                    exc_info = sys.exc_info()
+                    result = None
+
+                yield post.aclose()
+            else:
+                try:
+                    if exc_info:
+                        # Overwrite the result and exception information
+                        result = post.throw(*exc_info)
+                        exc_info = None
+                    else:
+                        result = post.send(result)
+                except StopIteration:
+                    # No result replacement...
+                    pass
+                except Exception:
+                    # Overwrite the result and exception information
+                    exc_info = sys.exc_info()
+                    result = None
+
+                post.close()
+            timings[index][1] += time.time() - start
+
+        self._timings = tuple(tuple(timing) for timing in timings)
 
-        return result, exc_info
+        yield _Done((result, exc_info))
 
     @expose
-    def console(self, args=None, argv=None):
+    def safe_call(self, args):
         """
-        Call the function as a console script.  Command line arguments
-        are parsed (unless ``args`` is passed), the processor (if any)
-        is called, then the underlying function is called.  If a
-        ``debug`` attribute is set by the command line arguments, and
-        if it is ``True``, any exception raised by the underlying
-        function will be re-raised; otherwise, the return value will
-        be either the return value of the function or the string value
-        of the exception (unless overwritten by the processor).
+        Call the processor and the underlying function.  If the
+        ``debug`` attribute of ``args`` exists and is ``True``, any
+        exceptions raised by the underlying function will be
+        re-raised.  Coroutine functions, asynchronous ``run()``
+        methods, and asynchronous generator processors are run to
+        completion on an event loop.
 
-        :param args: If provided, should be an ``argparse.Namespace``
-                     containing the required argument values for the
-                     function.  This can be used to parse the
-                     parameters separately.
-        :param argv: If provided, should be a list of argument strings
-                     to be parsed by the argument parser, in
-                     preference to ``sys.argv[1:]``.
+        :param args: This should be an ``argparse.Namespace`` object;
+                     the keyword arguments for the function will be
+                     derived from it.
 
-        :returns: The function return value, the string value of any
-                  exception raised by the function, or a value yielded
-                  by the processor to replace the function value.
+        :returns: A tuple of the function return value and exception
+                  information.  Only one of these values will be
+                  non-``None``.
         """
 
-        # First, let's parse the arguments
-        if not args:
-            parser = argparse.ArgumentParser(
-                prog=self.prog,
-                usage=self.usage,
-                description=self.description,
-                epilog=self.epilog,
-                formatter_class=self.formatter_class,
-            )
-            self.setup_args(parser)
-            args = parser.parse_args(args=argv)
+        return _run_steps(self._call_steps(args))
 
-        # Get the adaptor
-        if self.do_subs:
-            # If the subcommand attribute isn't set, we'll call our
-            # underlying function
-            adaptor = getattr(args, self._subcmd_attr, self)
-        else:
-            adaptor = self
+    @expose
+    def safe_call_async(self, args):
+        """
+        Call the processor and the underlying function from within a
+        running event loop.  This is the same as ``safe_call()``,
+        except that awaitables are awaited on the running loop rather
+        than on a private one.
 
-        # Call the function
-        result, exc_info = adaptor.safe_call(args)
+        :param args: This should be an ``argparse.Namespace`` object;
+                     the keyword arguments for the function will be
+                     derived from it.
 
-        if exc_info:
-            return str(exc_info[1])
-        return result
+        :returns: An ``asyncio.Future`` whose result will be the tuple
+                  returned by ``safe_call()``.
+        """
+
+        return _schedule_steps(self._call_steps(args))
 
     @expose
-    def get_subcommands(self):
+    def get_timings(self):
+        """
+        Retrieve the time spent in each stage of the most recent call
+        of the function.  The time recorded for a stage includes both
+        its pre and post phases, but not the time spent in the stages
+        inside it or in the underlying function.  Stages which were
+        not reached, due to an exception or a ``ShortCircuit``, are
+        omitted.
+
+        :returns: A list of tuples of the stage name and the time
+                  spent in the stage, in seconds, beginning with the
+                  outermost stage.  The processor is named
+                  "processor".
         """
-        Retrieve a dictionary of the recognized subcommands.
 
-        :returns: A dictionary mapping subcommand names to the
-                  implementing functions.
+        return list(self._timings)
+
+    @expose
+    def get_plugin_loads(self):
+        """
+        Retrieve the outcome of loading each subcommand from the
+        entrypoint groups declared with ``@load_subcommands()``.
+        Entrypoints are loaded when the argument parser is built, or
+        when ``get_subcommands()`` is called.  Entrypoints with dotted
+        names are loaded only when selected, and are recorded once
+        loaded, or if they are quarantined.
+
+        :returns: A list of named tuples of the entrypoint group, the
+                  entrypoint name, the distribution, the time spent
+                  loading the entrypoint in seconds, and the reason the
+                  entrypoint failed to load, if it did.  The time is
+                  ``None`` if the entrypoint was skipped because it is
+                  quarantined.
         """
 
-        # We only have a return value if we're in subparsers mode
-        if not self.do_subs:
-            return {}
+        return list(self._plugin_loads)
 
-        # Process any declared entrypoints
-        self._process_entrypoints()
+    def _make_parser(self):
+        """
+        Build the argument parser.
 
-        # Return the subcommands dictionary
-        return dict((k, v._func) for k, v in self._subcommands.items())
+        :returns: An ``argparse.ArgumentParser`` object.
+        """
 
+        parser = argparse.ArgumentParser(
+            prog=self.prog,
+            usage=self.usage,
+            description=self.description,
+            epilog=self.epilog,
+            formatter_class=self.formatter_class,
+        )
+        self.setup_args(parser)
+        return parser
+
+    def _parse_args(self, argv):
+        """
+        Build the argument parser and parse the command line arguments.
 
-def console(func):
-    """
-    Decorator to mark a script as a console script.  This decorator is
-    optional, but can be used if no arguments other than the default
-    ``argparse`` arguments (such as "--help") are specified.
-    """
+        :param argv: A list of argument strings to be parsed by the
+                     argument parser, or ``None`` to parse
+                     ``sys.argv[1:]``.
+
+        :returns: An ``argparse.Namespace`` object containing the
+                  argument values.
+        """
+
+        if self._help_cache is not None:
+            self._cached_help(sys.argv[1:] if argv is None else argv)
+
+        return self._make_parser().parse_args(args=argv)
+
+    def _help_key(self, path):
+        """
+        Compute the help cache key for a path of subcommands.  The key
+        covers the command, the path, the adaptors along the path, the
+        program name, the terminal width and formatter class, the
+        entrypoints from which subcommands are loaded, and the source
+        files of the command and of ``cli_tools``.  Entrypoints are
+        identified from their metadata, without loading them.
+
+        :param path: A list of subcommand names.
+
+        :returns: The cache key.
+        """
+
+        entrypoints = []
+        adaptors = [self]
+        while adaptors:
+            adaptor = adaptors.pop()
+            for group in sorted(adaptor._entrypoints):
+                for ep in _iter_entry_points(group):
+                    entrypoints.append((group, str(ep), str(ep.dist)))
+            adaptors.extend(sub for sub in adaptor._subcommands.values()
+                            if isinstance(sub, ScriptAdaptor))
+
+        # Describe the adaptors along the path, so the key changes
+        # when the command tree does, even if no source file has
+        tree = []
+        node = self
+        for name in list(path) + [None]:
+            if isinstance(node, _LazySubcommand):
+                tree.append('%s: %s' % (node._target, node.description))
+                break
+            tree.append(node._help_spec())
+            node = node._subcommands.get(name)
+            if node is None:
+                break
+
+        module = sys.modules.get(self._func.__module__)
+        paths = [getattr(module, '__file__', None), __file__]
+
+        return self._help_cache.key(_func_ident(self._func), {
+            'path': tuple(path),
+            'tree': tuple(tree),
+            'prog': os.path.basename(sys.argv[0]),
+            'width': _terminal_width(),
+            'formatter_class': _func_ident(self.formatter_class),
+            'entrypoints': tuple(entrypoints),
+        }, [p for p in paths if p])
+
+    def _help_spec(self):
+        """
+        Describe what the help text of the adaptor is rendered from:
+        its argument specifications, the names of its subcommands, and
+        the details of its parser.  Memory addresses are omitted, so
+        the description is the same in every process.
+
+        :returns: The description, as text.
+        """
+
+        options = [(args, self._find_options(args))
+                   for arg_type, args, _kwargs in self._arguments
+                   if arg_type == 'options']
+        return _address_re.sub('', repr((
+            self._arguments, sorted(self._groups.items()), options,
+            sorted(self._subcommands), sorted(self.subkwargs.items()),
+            self.prog, self.usage, self.description, self.epilog,
+            self.formatter_class,
+        )))
+
+    def _cached_help(self, argv):
+        """
+        Serve a request for help from the help cache.  A request for
+        help is a path of subcommand names followed by "-h" or
+        "--help".  The help text is cached along with fingerprints of
+        the source files of the modules imported to render it, so a
+        cached help text is only used if none of them has changed.  If
+        the help text is not cached, it is rendered and cached.
+
+        :param argv: A list of argument strings.
+
+        :raises SystemExit: The help text was written to standard
+                            output.
+        """
+
+        # Is this a request for help only?
+        if not argv or argv[-1] not in ('-h', '--help'):
+            return
+        path = argv[:-1]
+        if any(word.startswith('-') for word in path):
+            return
+
+        key = self._help_key(path)
+        hit, value = self._help_cache.get(key)
+        if hit:
+            deps, text = value
+            if all(_fingerprint(dep) == fprint for dep, fprint in deps):
+                sys.stdout.write(text)
+                sys.exit(0)
+
+        # Build the parser along the path, noting what gets imported
+        before = set(sys.modules)
+        parser = self._make_parser()
+        modules = set([self._func.__module__])
+        for name in path:
+            for action in parser._actions:
+                if isinstance(action, _LazySubParsersAction):
+                    break
+            else:
+                return
+            if name not in action._name_parser_map:
+                return
+            try:
+                parser = action.materialize(action._name_parser_map[name])
+            except argparse.ArgumentError:
+                # Let the normal parse report the broken subcommand
+                return
+            modules.add(action._adaptors[parser]._func.__module__)
+
+        # Make sure the flag actually requests help
+        flag = parser._option_string_actions.get(argv[-1])
+        if not isinstance(flag, argparse._HelpAction):
+            return
+
+        text = parser.format_help()
+        modules |= set(sys.modules) - before
+        deps = set(getattr(sys.modules.get(name), '__file__', None)
+                   for name in modules)
+        try:
+            self._help_cache.put(key, (
+                [(dep, _fingerprint(dep)) for dep in sorted(deps - {None})],
+                text,
+            ))
+        except EnvironmentError:
+            # Help is still available without the cache
+            pass
+
+        sys.stdout.write(text)
+        sys.exit(0)
+
+    def _pipe_stages(self, argv):
+        """
+        Split an argument list into the stages of a pipeline.  The list
+        is split at each occurrence of the pipe separator which is
+        followed by the name of a subcommand; any other occurrence is
+        left to the argument parser, so that "--" still ends the
+        options of a stage.
+
+        :param argv: A list of argument strings.
+
+        :returns: A list of the argument lists of the stages.
+        """
+
+        # The subcommands declared by entrypoints must be known
+        if self._entrypoints:
+            self._process_entrypoints()
+
+        stages = [[]]
+        for idx, arg in enumerate(argv):
+            if (arg == self.pipe_separator and idx + 1 < len(argv) and
+                    argv[idx + 1] in self._subcommands):
+                stages.append([])
+            else:
+                stages[-1].append(arg)
+
+        return stages
+
+    def _pipeline(self, argv, parser=None):
+        """
+        Run a pipeline of commands.  The argument list is split into
+        stages by ``_pipe_stages()``, and each stage is parsed and
+        called in turn.  The return value of each stage
+        is passed to the next stage as the argument named by the
+        ``pipe_input`` of the next stage's adaptor.
+
+        :param argv: A list of argument strings.
+        :param parser: The argument parser to use.  If not provided,
+                       one will be built.
+
+        :returns: The return value of the last stage, or the string
+                  value of the first exception raised by a stage.
+        """
+
+        parser = parser or self._make_parser()
+        result = None
+        for idx, stage in enumerate(self._pipe_stages(argv)):
+            args = parser.parse_args(args=stage)
+            adaptor = self._select(args)
+
+            # Pass along the result of the previous stage
+            if adaptor.pipe_input:
+                setattr(args, adaptor.pipe_input, result)
+            elif idx:
+                return 'stage %d does not accept piped input' % (idx + 1)
+
+            result, exc_info = adaptor.safe_call(args)
+            if exc_info:
+                return _console_result((result, exc_info))
+
+        return result
+
+    def _select(self, args):
+        """
+        Select the adaptor which will be called for the parsed
+        arguments.
+
+        :param args: An ``argparse.Namespace`` object containing the
+                     argument values.
+
+        :returns: The selected ``ScriptAdaptor``.
+        """
+
+        if self.do_subs:
+            # The last adaptor on the path implements the selected
+            # subcommand; if no subcommand was selected, we'll call
+            # our underlying function
+            path = getattr(args, _path_attr, None)
+            if path:
+                return path[-1]
+
+        return self
+
+    @expose
+    def console(self, args=None, argv=None):
+        """
+        Call the function as a console script.  Command line arguments
+        are parsed (unless ``args`` is passed), the processor (if any)
+        is called, then the underlying function is called.  If a
+        ``debug`` attribute is set by the command line arguments, and
+        if it is ``True``, any exception raised by the underlying
+        function will be re-raised; otherwise, the return value will
+        be either the return value of the function or the string value
+        of the exception (unless overwritten by the processor).
+
+        :param args: If provided, should be an ``argparse.Namespace``
+                     containing the required argument values for the
+                     function.  This can be used to parse the
+                     parameters separately.
+        :param argv: If provided, should be a list of argument strings
+                     to be parsed by the argument parser, in
+                     preference to ``sys.argv[1:]``.
+
+        :returns: The function return value, the string value of any
+                  exception raised by the function, or a value yielded
+                  by the processor to replace the function value.
+        """
+
+        with self.session():
+            # First, let's parse the arguments
+            if not args:
+                if self.pipe_separator:
+                    # Check for a pipeline of commands
+                    argv = sys.argv[1:] if argv is None else argv
+                    if len(self._pipe_stages(argv)) > 1:
+                        return self._pipeline(argv)
+
+                args = self._parse_args(argv)
+
+            # Release what's only needed for parsing
+            if self._low_memory is not None:
+                self._release(args)
+
+            # Call the function
+            return _console_result(self._select(args).safe_call(args))
+
+    def _release(self, args):
+        """
+        Release the parts of the command tree which are only needed to
+        parse the command line, then run a garbage collection.  Only
+        the part of the command tree below this adaptor is released:
+        the adaptors on the path of the selected subcommand are kept,
+        and their argument specifications are discarded, so the
+        command may not be parsed again in this process.  The adaptors
+        of which this adaptor is a subcommand are left alone.
+
+        :param args: An ``argparse.Namespace`` object containing the
+                     argument values.
+        """
+
+        # Walk up from the selected adaptor to this one, keeping only
+        # the path
+        lineage = self._select(args)._lineage()
+        child = None
+        for adaptor in reversed(lineage[lineage.index(self):]):
+            adaptor._subcommands = dict(
+                (name, sub) for name, sub in adaptor._subcommands.items()
+                if sub is child
+            )
+            adaptor._arguments = []
+            adaptor._groups = {}
+            adaptor._option_sets = {}
+            adaptor._entrypoints = frozenset()
+            adaptor._help_cache = None
+            child = adaptor
+
+        gc.collect()
+
+        # Keep the collector from touching the survivors, so forked
+        # workers share their pages with the parent
+        if self._low_memory and hasattr(gc, 'freeze'):
+            gc.freeze()
+
+    @expose
+    def console_async(self, args=None, argv=None):
+        """
+        Call the function as a console script from within a running
+        event loop.  This is the same as ``console()``, except that the
+        function is called using ``safe_call_async()``; the result
+        must be awaited.
+
+        :param args: If provided, should be an ``argparse.Namespace``
+                     containing the required argument values for the
+                     function.  This can be used to parse the
+                     parameters separately.
+        :param argv: If provided, should be a list of argument strings
+                     to be parsed by the argument parser, in
+                     preference to ``sys.argv[1:]``.
+
+        :returns: An ``asyncio.Future`` whose result will be the value
+                  returned by ``console()``.
+        """
+
+        # First, let's parse the arguments
+        if not args:
+            args = self._parse_args(argv)
+
+        # Release what's only needed for parsing
+        if self._low_memory is not None:
+            self._release(args)
+
+        # Call the function in a session, closing it when done
+        running = self._running_ancestors()
+        self._session_depth += 1
+        try:
+            future = self._select(args).safe_call_async(args)
+        except BaseException:
+            self._session_depth -= 1
+            if not self._session_depth:
+                self.close_session()
+                _run_steps(self._close_steps(
+                    self._end_ancestor_sessions(running)))
+            raise
+
+        result = asyncio.Future()
+
+        def finish(closed):
+            if closed.cancelled():
+                result.cancel()
+            elif closed.exception() is not None:
+                result.set_exception(closed.exception())
+            elif future.cancelled():
+                result.cancel()
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(_console_result(future.result()))
+
+        def close(fut):
+            self._session_depth -= 1
+            if self._session_depth:
+                finish(fut)
+            else:
+                sessions = (self._end_sessions() +
+                            self._end_ancestor_sessions(running))
+                _schedule_steps(self._close_steps(sessions)).add_done_callback(
+                    finish)
+
+        future.add_done_callback(close)
+        return result
+
+    @expose
+    def shell(self, prompt=None, stdin=None, stdout=None, stderr=None):
+        """
+        Run an interactive shell.  Each line entered is split into
+        arguments using shell quoting rules, parsed, and the selected
+        function is called, as by ``console()``.  The argument parser
+        is built only once, and modules, caches, and other resources
+        remain loaded between commands.  The shell exits at end of
+        file, or when "exit" or "quit" is entered.
+
+        :param prompt: The prompt to display.  Defaults to the program
+                       name followed by "> ".  The prompt is only
+                       displayed when reading from a terminal.
+        :param stdin: The stream from which to read commands.  Defaults
+                      to ``sys.stdin``.
+        :param stdout: The stream to which to write results.  Defaults
+                       to ``sys.stdout``.
+        :param stderr: The stream to which to write errors.  Defaults to
+                       ``sys.stderr``.
+        """
+
+        stdin = stdin or sys.stdin
+        stdout = stdout or sys.stdout
+        stderr = stderr or sys.stderr
+
+        parser = self._make_parser()
+        if prompt is None:
+            prompt = '%s> ' % parser.prog
+
+        # Use input() for its line editing when talking to a terminal
+        interactive = stdin is sys.stdin and stdin.isatty()
+
+        with self.session():
+            self._shell(parser, prompt, interactive, stdin, stdout, stderr)
+
+    def _shell(self, parser, prompt, interactive, stdin, stdout, stderr):
+        """
+        Run the command loop of an interactive shell.
+
+        :param parser: The argument parser.
+        :param prompt: The prompt to display.
+        :param interactive: If ``True``, commands are read using
+                            ``input()``; otherwise, they are read from
+                            ``stdin``.
+        :param stdin: The stream from which to read commands.
+        :param stdout: The stream to which to write results.
+        :param stderr: The stream to which to write errors.
+        """
+
+        while True:
+            try:
+                if interactive:
+                    line = six.moves.input(prompt)
+                else:
+                    line = stdin.readline()
+                    if not line:
+                        break
+            except EOFError:
+                stdout.write('\n')
+                break
+            except KeyboardInterrupt:
+                stdout.write('\n')
+                continue
+
+            try:
+                argv = shlex.split(line)
+            except ValueError as exc:
+                stderr.write('%s\n' % exc)
+                continue
+
+            if not argv:
+                continue
+            elif argv[0] in ('exit', 'quit'):
+                break
+
+            try:
+                if (self.pipe_separator and
+                        len(self._pipe_stages(argv)) > 1):
+                    result = self._pipeline(argv, parser)
+                    exc_info = None
+                else:
+                    args = parser.parse_args(args=argv)
+                    result, exc_info = self._select(args).safe_call(args)
+            except SystemExit:
+                # The parser has already reported the problem (or
+                # displayed the help)
+                continue
+            except KeyboardInterrupt:
+                stdout.write('\n')
+                continue
+            except Exception:
+                # Debug mode re-raises exceptions; report them, but
+                # keep the shell running
+                traceback.print_exc(file=stderr)
+                continue
+
+            if exc_info:
+                stderr.write('%s\n' % exc_info[1])
+            elif result is not None:
+                stdout.write('%s\n' % result)
+
+    @expose
+    def get_subcommands(self):
+        """
+        Retrieve a dictionary of the recognized subcommands.  Lazily
+        declared subcommands are imported; one which cannot be
+        imported is omitted, and the error is reported only if it is
+        selected on the command line.
+
+        :returns: A dictionary mapping subcommand names to the
+                  implementing functions.
+        """
+
+        # We only have a return value if we're in subparsers mode
+        if not self.do_subs:
+            return {}
+
+        # Process any declared entrypoints
+        self._process_entrypoints()
+
+        # Import any lazily declared subcommands; a placeholder which
+        # fails to load stays, to report the error if it's selected
+        for cmd, adaptor in list(self._subcommands.items()):
+            if isinstance(adaptor, _LazySubcommand):
+                try:
+                    adaptor.load()
+                except argparse.ArgumentError:
+                    pass
+
+        # Return the subcommands dictionary
+        return dict((k, v._func) for k, v in self._subcommands.items()
+                    if not isinstance(v, _LazySubcommand))
+
+    @expose
+    def bundle(self, path, modules=(), interpreter=None, compiled=True):
+        """
+        Build a single-file application--a "zipapp"--which runs the
+        function as a console script.  The bundle contains the
+        top-level packages of the function and of its subcommands and
+        plugins, ``cli_tools``, and ``six``.  The entrypoints of the
+        groups declared with ``@load_subcommands()`` are frozen into
+        the bundle, so that the installed distributions need not be
+        scanned when it runs.
+
+        :param path: The path of the bundle to write.
+        :param modules: A list of the names of additional modules to
+                        include; the top-level package of each is
+                        included.
+        :param interpreter: If provided, the bundle starts with a "#!"
+                            line naming the interpreter, and is made
+                            executable.
+        :param compiled: If ``True`` (the default), the bundle includes
+                         bytecode compiled by the running Python
+                         version, so that modules need not be compiled
+                         each time the bundle runs.
+
+        :raises ValueError: The function or one of the listed modules
+                            cannot be bundled.
+        """
+
+        if self._func.__module__ == '__main__':
+            raise ValueError('cannot bundle a function defined in __main__')
+
+        # Freeze the entrypoints and find the modules of the command
+        # tree; a plugin which can't be imported is left out
+        index = {}
+        names = set([self._func.__module__, __name__, 'six'])
+        names.update(modules)
+        plugins = set()
+        adaptors = [self]
+        while adaptors:
+            adaptor = adaptors.pop()
+            names.add(adaptor._func.__module__)
+            for group in adaptor._entrypoints | adaptor._loaded_groups:
+                entries = []
+                for ep in _iter_entry_points(group):
+                    target = ep.module_name
+                    if ep.attrs:
+                        target += ':' + '.'.join(ep.attrs)
+                    entries.append((ep.name, target, str(ep.dist)))
+                    plugins.add(ep.module_name)
+                index[group] = sorted(set(index.get(group, []) + entries))
+            for sub in adaptor._subcommands.values():
+                if isinstance(sub, ScriptAdaptor):
+                    adaptors.append(sub)
+                elif isinstance(sub._target, six.string_types):
+                    plugins.add(sub._target.partition(':')[0])
+
+        files = {}
+        for name in sorted(names | plugins):
+            try:
+                files.update((arcname, src)
+                             for src, arcname in _module_files(name))
+            except (ImportError, ValueError) as exc:
+                if name in names:
+                    raise ValueError('module %s cannot be bundled: %s' %
+                                     (name, exc))
+
+        # Build the archive
+        buf = six.BytesIO()
+        if interpreter:
+            buf.write(b'#!' + interpreter.encode('utf-8') + b'\n')
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for arcname, src in sorted(files.items()):
+                archive.write(src, arcname)
+                if compiled:
+                    archive.writestr(arcname + 'c',
+                                     _compile_source(src, arcname))
+            archive.writestr('__main__.py', (
+                '# Generated by cli_tools\n'
+                'import sys\n'
+                '\n'
+                'import cli_tools\n'
+                '\n'
+                'sys.exit(cli_tools._run_bundle(%r, %r))\n'
+            ) % (index, '%s:%s' % (self._func.__module__,
+                                   self._func.__name__)))
+
+        path = os.path.abspath(path)
+        _write_atomic(path, buf.getvalue())
+        os.chmod(path, 0o755 if interpreter else 0o644)
+
+
+class _FrozenEntryPoint(object):
+    """
+    An entrypoint frozen into a bundle built by
+    ``ScriptAdaptor.bundle()``.  This provides the parts of the
+    ``pkg_resources.EntryPoint`` interface used by ``cli_tools``.
+    """
+
+    __slots__ = ('name', 'module_name', 'attrs', 'dist')
+
+    def __init__(self, name, target, dist):
+        """
+        Initialize a ``_FrozenEntryPoint``.
+
+        :param name: The name of the entrypoint.
+        :param target: The import path of the entrypoint, in the form
+                       "module:attribute".
+        :param dist: The name and version of the distribution
+                     declaring the entrypoint.
+        """
+
+        module, _sep, attr = target.partition(':')
+        self.name = name
+        self.module_name = module
+        self.attrs = tuple(attr.split('.')) if attr else ()
+        self.dist = dist
+
+    def __str__(self):
+        """
+        Return the entrypoint in the form used to declare it.
+
+        :returns: The entrypoint declaration.
+        """
+
+        if self.attrs:
+            return '%s = %s:%s' % (self.name, self.module_name,
+                                   '.'.join(self.attrs))
+        return '%s = %s' % (self.name, self.module_name)
+
+    def load(self):
+        """
+        Import the object named by the entrypoint.
+
+        :returns: The object.
+        """
+
+        return _import_target(
+            '%s:%s' % (self.module_name, '.'.join(self.attrs)))
+
+
+class _TrackedEntryPoint(object):
+    """
+    Wrap an entrypoint with a dotted name, which is loaded only when
+    its subcommand is selected, so that the outcome of loading it is
+    recorded by the adaptor which declared its group.
+    """
+
+    __slots__ = ('_owner', '_group', '_ep', '_key', 'name')
+
+    def __init__(self, owner, group, ep, key):
+        """
+        Initialize a ``_TrackedEntryPoint``.
+
+        :param owner: The ``ScriptAdaptor`` which declared the group.
+        :param group: The entrypoint group name.
+        :param ep: The ``pkg_resources.EntryPoint``.
+        :param key: The quarantine key of the entrypoint, or ``None``
+                    if there is no quarantine.
+        """
+
+        self._owner = owner
+        self._group = group
+        self._ep = ep
+        self._key = key
+        self.name = ep.name
+
+    def __str__(self):
+        """
+        Describe the entrypoint.
+
+        :returns: The string form of the entrypoint.
+        """
+
+        return str(self._ep)
+
+    def load(self):
+        """
+        Load the entrypoint, recording the outcome with the adaptor
+        which declared the group.  An entrypoint which fails to load
+        is quarantined.
+
+        :returns: The loaded function.
+        """
+
+        start = time.time()
+        try:
+            func = self._ep.load()
+        except (ImportError, AttributeError, _unknown_extra()) as exc:
+            self._record(start, self._owner._plugin_failed(self._key, exc))
+            raise
+
+        self._record(start, None)
+        return func
+
+    def _record(self, start, error):
+        """
+        Record the outcome of loading the entrypoint.
+
+        :param start: The time at which loading began.
+        :param error: The reason the entrypoint failed to load, or
+                      ``None``.
+        """
+
+        self._owner._plugin_loads += (_PluginLoad(
+            self._group, self.name, str(self._ep.dist),
+            time.time() - start, error),)
+
+
+class _LazySubcommand(object):
+    """
+    A placeholder for a subcommand declared using
+    ``lazy_subcommand()``.  The placeholder stands in for the adaptor
+    of the subcommand until the function implementing it is imported.
+    """
+
+    __slots__ = ('_name', '_target', '_parent', 'prog', 'usage',
+                 'description', 'epilog', 'formatter_class', 'error')
+
+    def __init__(self, name, target, help=None):
+        """
+        Initialize a ``_LazySubcommand``.
+
+        :param name: The name of the subcommand.
+        :param target: The import path of the function implementing
+                       the subcommand, in the form "module:function",
+                       or a ``pkg_resources.EntryPoint`` for the
+                       function.
+        :param help: The description of the subcommand to use until
+                     the function is imported.
+        """
+
+        self._name = name
+        self._target = target
+        self._parent = None
+        self.prog = None
+        self.usage = None
+        self.description = help
+        self.epilog = None
+        self.formatter_class = argparse.HelpFormatter
+        self.error = None
+
+    def close_session(self):
+        """
+        End the session.  A subcommand which has not been imported
+        has no session, so this does nothing.
+        """
+
+        pass
+
+    def _end_sessions(self):
+        """
+        Detach the running sessions of the subcommand.  A subcommand
+        which has not been imported has no session.
+
+        :returns: An empty list.
+        """
+
+        return []
+
+    def load(self, parser=None):
+        """
+        Import the function implementing the subcommand, and replace
+        the placeholder with its adaptor.
+
+        :param parser: The subcommand parser, if it has already been
+                       created.  The description and other details of
+                       the parser are updated from the adaptor.
+
+        :returns: The ``ScriptAdaptor`` of the function.
+
+        :raises argparse.ArgumentError: The function cannot be
+                                        imported.  The reason is also
+                                        recorded in ``error``.
+        """
+
+        try:
+            if isinstance(self._target, six.string_types):
+                func = _import_target(self._target)
+            else:
+                func = self._target.load()
+        except (ImportError, AttributeError, _unknown_extra()) as exc:
+            self.error = '%s: %s' % (exc.__class__.__name__, exc)
+            raise argparse.ArgumentError(
+                None, "subcommand %s: unable to load %s: %s" %
+                (self._name, self._target, exc))
+
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        self._parent._add_subcommand(self._name, adaptor)
+
+        if parser is not None:
+            if adaptor.prog:
+                parser.prog = adaptor.prog
+            if adaptor.description:
+                parser.description = adaptor.description
+            parser.usage = adaptor.usage
+            parser.epilog = adaptor.epilog
+            parser.formatter_class = adaptor.formatter_class
+
+        return adaptor
+
+
+class _SubcommandChoices(object):
+    """
+    The choices of a ``_LazySubParsersAction``.  This is a view of the
+    mapping of subcommand names to parsers, except that every name is
+    accepted as a choice; unknown subcommands are reported by the
+    action itself, which suggests the closest names rather than
+    listing all the choices.
+    """
+
+    def __init__(self, parsers):
+        """
+        Initialize a ``_SubcommandChoices``.
+
+        :param parsers: The dictionary mapping subcommand names to
+                        parsers.
+        """
+
+        self._parsers = parsers
+
+    def __contains__(self, name):
+        """
+        Determine whether a name is an acceptable choice.
+
+        :param name: The subcommand name.
+
+        :returns: ``True``; the action checks the name.
+        """
+
+        return True
+
+    def __iter__(self):
+        """
+        Iterate over the subcommand names.
+
+        :returns: An iterator over the subcommand names.
+        """
+
+        return iter(self._parsers)
+
+    def __len__(self):
+        """
+        Determine the number of subcommands.
+
+        :returns: The number of subcommands.
+        """
+
+        return len(self._parsers)
+
+    def __getitem__(self, name):
+        """
+        Retrieve the parser of a subcommand.
+
+        :param name: The subcommand name.
+
+        :returns: The subcommand parser.
+        """
+
+        return self._parsers[name]
+
+    def __getattr__(self, name):
+        """
+        Delegate other dictionary methods, such as ``items()``, to the
+        dictionary mapping subcommand names to parsers.
+
+        :param name: The name of the attribute.
+
+        :returns: The attribute of the dictionary.
+        """
+
+        return getattr(self._parsers, name)
+
+
+class _LazySubParsersAction(argparse._SubParsersAction):
+    """
+    An ``argparse`` subparsers action which sets up the arguments of a
+    subcommand parser only when the subcommand is selected.  With
+    large command trees, this avoids building the arguments of every
+    subcommand on every invocation.  The action also records the
+    adaptor implementing the selected subcommand, so that the path of
+    adaptors from the outermost subcommand to the innermost is
+    available from the parsed arguments.  Unknown subcommands are
+    reported with suggestions of the closest subcommand names, rather
+    than a list of all of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize a ``_LazySubParsersAction``.  All arguments are
+        passed to ``argparse._SubParsersAction``.
+        """
+
+        super(_LazySubParsersAction, self).__init__(*args, **kwargs)
+        self.choices = _SubcommandChoices(self._name_parser_map)
+        self._adaptors = {}
+        self._deferred = set()
+
+    def unknown(self, name):
+        """
+        Build the error message for an unknown subcommand, suggesting
+        the closest subcommand names.
+
+        :param name: The unknown subcommand name.
+
+        :returns: The error message.
+        """
+
+        msg = 'invalid choice: %r' % name
+        suggestions = _suggest(name, self._name_parser_map)
+        if suggestions:
+            msg += ' (did you mean %s?)' % ' or '.join(
+                repr(suggestion) for suggestion in suggestions)
+        return msg
+
+    def bind(self, parser, adaptor):
+        """
+        Bind a subcommand parser to the adaptor implementing the
+        subcommand.  Setting up the arguments of the parser is deferred
+        until the subcommand is selected.
+
+        :param parser: The subcommand parser.
+        :param adaptor: The ``ScriptAdaptor`` implementing the
+                        subcommand.
+        """
+
+        self._adaptors[parser] = adaptor
+        self._deferred.add(parser)
+
+    def materialize(self, parser):
+        """
+        Set up the arguments of a subcommand parser, if that has been
+        deferred.
+
+        :param parser: The subcommand parser.
+
+        :returns: The subcommand parser.
+        """
+
+        if parser in self._deferred:
+            self._deferred.discard(parser)
+            adaptor = self._adaptors[parser]
+            if isinstance(adaptor, _LazySubcommand):
+                adaptor = self._adaptors[parser] = adaptor.load(parser)
+            adaptor.setup_args(parser)
+        return parser
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        """
+        Select a subcommand parser and parse the remaining arguments.
+        The arguments of the subcommand parser are set up first, and
+        the adaptor implementing the subcommand is added to the
+        beginning of the recorded path; subcommands of the subcommand
+        have already been recorded by then.
+
+        :param parser: The parser invoking the action.
+        :param namespace: The ``argparse.Namespace`` object.
+        :param values: The subcommand name and its argument strings.
+        :param option_string: The option string; always ``None``.
+        """
+
+        cmd_parser = self._name_parser_map.get(values[0])
+        if cmd_parser is None:
+            raise argparse.ArgumentError(None, self.unknown(values[0]))
+        if cmd_parser in self._adaptors:
+            self.materialize(cmd_parser)
+        adaptor = self._adaptors.get(cmd_parser)
+
+        # Any path recorded so far is that of the enclosing
+        # subcommands, which is implied by the adaptors' lineage
+        setattr(namespace, _path_attr, None)
+
+        super(_LazySubParsersAction, self).__call__(
+            parser, namespace, values, option_string)
+
+        # Record the adaptor; a deque keeps this constant time at
+        # each level.  A path recorded by a subparsers action of
+        # another type is a tuple, shared by every parse
+        if adaptor is not None:
+            path = getattr(namespace, _path_attr, None)
+            if not isinstance(path, collections.deque):
+                path = collections.deque(path or ())
+                setattr(namespace, _path_attr, path)
+            path.appendleft(adaptor)
+
+
+class LazyDefault(object):
+    """
+    A default value for an argument which is computed only when it is
+    needed.  Pass an instance as the ``default`` of ``@argument()``;
+    if the argument is not given on the command line, the function
+    will be called to compute the value when the function being run
+    is called.  Defaults of subcommands which are not run are never
+    computed.  The value is computed at most once per process.
+    Note that the value is not passed to any ``type`` converter of the
+    argument.
+    """
+
+    def __init__(self, func, description=None):
+        """
+        Initialize a ``LazyDefault``.
+
+        :param func: A function, taking no arguments, which computes
+                     the default value.
+        :param description: A description of the default value, used
+                            when it is included in help text.
+                            Defaults to the name of the function.
+        """
+
+        self.func = func
+        self.description = (description or
+                            '<%s>' % getattr(func, '__name__', 'lazy'))
+
+        self._lock = threading.Lock()
+        self._computed = False
+        self._value = None
+
+    def __str__(self):
+        """
+        Describe the default value.
+
+        :returns: The description of the default value.
+        """
+
+        return self.description
+
+    __repr__ = __str__
+
+    @property
+    def value(self):
+        """
+        Retrieve the default value, computing it if necessary.
+        """
+
+        with self._lock:
+            if not self._computed:
+                self._value = self.func()
+                self._computed = True
+        return self._value
+
+    @staticmethod
+    def resolve(args):
+        """
+        Replace the ``LazyDefault`` values of the parsed arguments with
+        the values they compute.
+
+        :param args: An ``argparse.Namespace`` object.
+        """
+
+        for key, value in list(getattr(args, '__dict__', {}).items()):
+            if isinstance(value, LazyDefault):
+                setattr(args, key, value.value)
+
+
+class LazyValue(object):
+    """
+    An argument value whose conversion is deferred until it is used.
+    See ``lazy_type()``.  Call the ``LazyValue`` to obtain the
+    converted value; the conversion is performed at most once.
+    """
+
+    def __init__(self, converter, text):
+        """
+        Initialize a ``LazyValue``.
+
+        :param converter: The type converter, as would be passed as
+                          the ``type`` of ``@argument()``.
+        :param text: The argument text to convert.
+        """
+
+        self.converter = converter
+        self.text = text
+
+        self._converted = False
+        self._value = None
+
+    def __repr__(self):
+        """
+        Return a representation of the lazy value.
+
+        :returns: A representation of the lazy value.
+        """
+
+        return 'LazyValue(%r)' % (self.text,)
+
+    def __call__(self):
+        """
+        Convert the argument text, if it has not already been
+        converted.  As with ``argparse``, a ``ValueError`` or
+        ``TypeError`` raised by the converter is reported as an
+        invalid value, and the message of an
+        ``argparse.ArgumentTypeError`` is reported as is.
+
+        :returns: The converted value.
+        """
+
+        if not self._converted:
+            try:
+                self._value = self.converter(self.text)
+            except argparse.ArgumentTypeError as exc:
+                raise ValueError(str(exc))
+            except (TypeError, ValueError):
+                name = getattr(self.converter, '__name__',
+                               repr(self.converter))
+                raise ValueError('invalid %s value: %r' % (name, self.text))
+            self._converted = True
+
+        return self._value
+
+
+def lazy_type(converter):
+    """
+    Wrap a type converter so that arguments are converted only when
+    their values are used.  Pass the result as the ``type`` of
+    ``@argument()``; the function then receives a ``LazyValue``,
+    which must be called to obtain the converted value.  This is
+    useful for expensive conversions, such as parsing a large
+    configuration file, which are not needed on every code path.
+
+    :param converter: The type converter.
+
+    :returns: A type converter which returns ``LazyValue`` instances.
+    """
+
+    def convert(text):
+        return LazyValue(converter, text)
+
+    convert.__name__ = getattr(converter, '__name__', 'lazy_type')
+    return convert
+
+
+class ShortCircuit(object):
+    """
+    Returned by a processor or middleware stage to provide the result
+    of a call in place of the underlying function.  See
+    ``ScriptAdaptor.middleware()``.
+    """
+
+    def __init__(self, result=None):
+        """
+        Initialize a ``ShortCircuit`` object.
+
+        :param result: The result of the call.
+        """
+
+        self.result = result
+
+    def __repr__(self):
+        """
+        Return a representation of the short circuit.
+
+        :returns: A representation of the short circuit.
+        """
+
+        return 'ShortCircuit(%r)' % (self.result,)
+
+
+def _map_chunk(func, record, kwargs, seq, chunk):
+    """
+    Apply a per-record function to a chunk of records.  This runs in a
+    worker process of the ``RecordMapper`` process pool.  Exceptions
+    are captured and returned, rather than raised, so that the parent
+    process is always notified of the completion of the chunk.
+
+    :param func: The per-record function.
+    :param record: The name of the keyword argument that receives the
+                   record.
+    :param kwargs: The remaining keyword arguments for the function.
+    :param seq: The sequence number of the chunk.
+    :param chunk: A list of records.
+
+    :returns: A tuple of the sequence number, the list of results,
+              the elapsed time in seconds, and the exception raised
+              by the function, if any.
+    """
+
+    start = time.time()
+    results = []
+    try:
+        for rec in chunk:
+            kwargs[record] = rec
+            results.append(func(**kwargs))
+    except Exception as exc:
+        return seq, None, time.time() - start, exc
+
+    return seq, results, time.time() - start, None
+
+
+class RecordMapper(object):
+    """
+    Stream records through a per-record function using a process pool.
+    Records are read from the files named on the command line, or from
+    standard input if none are named, and are dispatched to the pool
+    in chunks.  The number of chunks in flight is bounded, and the
+    chunk size is tuned from the measured per-record latency so that
+    each chunk takes roughly ``target`` seconds to process.
+    """
+
+    def __init__(self, record='record', inputs='files', ordered=True,
+                 processes=None, max_inflight=None, target=0.1,
+                 max_chunksize=1024):
+        """
+        Initialize a ``RecordMapper``.
+
+        :param record: The name of the keyword argument of the
+                       function that receives each record.
+        :param inputs: The name of the argument containing the list of
+                       input files.
+        :param ordered: If ``True`` (the default), results are written
+                        in input order; otherwise, they are written as
+                        the chunks complete.
+        :param processes: The number of worker processes.  Defaults to
+                          the number of CPUs.  If 0, the records are
+                          processed in the calling process.
+        :param max_inflight: The maximum number of chunks dispatched
+                             to the pool but not yet written.  Defaults
+                             to twice the number of processes.
+        :param target: The desired processing time of one chunk, in
+                       seconds.
+        :param max_chunksize: The upper bound on the chunk size.
+        """
+
+        self.record = record
+        self.inputs = inputs
+        self.ordered = ordered
+        self.processes = (multiprocessing.cpu_count() if processes is None
+                          else processes)
+        self.max_inflight = max_inflight or 2 * max(self.processes, 1)
+        self.target = target
+        self.max_chunksize = max_chunksize
+
+    def __call__(self, adaptor, args):
+        """
+        Stream the records through the adaptor's function, writing the
+        results to standard output, one per line.  Results of ``None``
+        are not written.
+
+        :param adaptor: The ``ScriptAdaptor`` of the per-record
+                        function.
+        :param args: An ``argparse.Namespace`` object containing the
+                     argument values.
+        """
+
+        # Compute the keyword arguments common to all records
+        func = adaptor._func
+        ns = copy.copy(args)
+        setattr(ns, self.record, None)
+        kwargs = adaptor.get_kwargs(func, ns)
+        kwargs.pop(self.record, None)
+
+        records = self._read(getattr(args, self.inputs, None) or [])
+        for result in self.map(func, kwargs, records):
+            if result is not None:
+                sys.stdout.write('%s\n' % result)
+        sys.stdout.flush()
+
+    def _read(self, filenames):
+        """
+        Read records from a list of files.  Each line is a record, with
+        its line terminator removed.
+
+        :param filenames: A list of file names.  A name of "-" refers
+                          to standard input, which is also read if the
+                          list is empty.
+
+        :returns: An iterator over the records.
+        """
+
+        for filename in filenames or ['-']:
+            if filename == '-':
+                stream = sys.stdin
+            else:
+                stream = open(filename)
+
+            try:
+                for line in stream:
+                    yield line.rstrip('\r\n')
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+
+    def _tune(self, chunksize, latency, count, elapsed):
+        """
+        Compute a new chunk size from a completed chunk.
+
+        :param chunksize: The current chunk size.
+        :param latency: The current estimate of the per-record
+                        latency, or ``None`` if there is none yet.
+        :param count: The number of records in the completed chunk.
+        :param elapsed: The time taken to process the chunk.
+
+        :returns: A tuple of the new chunk size and the new per-record
+                  latency estimate.
+        """
+
+        sample = elapsed / count
+        latency = sample if latency is None else (latency + sample) / 2.0
+        if latency <= 0:
+            return self.max_chunksize, latency
+        return max(1, min(self.max_chunksize,
+                          int(self.target / latency))), latency
+
+    def map(self, func, kwargs, records):
+        """
+        Apply a function to each of a stream of records.
+
+        :param func: The per-record function.
+        :param kwargs: The keyword arguments to pass to the function in
+                       addition to the record.
+        :param records: An iterable of records.
+
+        :returns: An iterator over the function results.
+        """
+
+        records = iter(records)
+
+        # Processing in the calling process is handy for debugging
+        if not self.processes:
+            for rec in records:
+                kwargs[self.record] = rec
+                yield func(**kwargs)
+            return
+
+        pool = multiprocessing.Pool(self.processes)
+        completed = queue.Queue()
+        callbacks = dict(callback=completed.put)
+        if six.PY3:
+            callbacks['error_callback'] = (
+                lambda exc: completed.put((None, None, 0.0, exc)))
+
+        done = {}
+        chunksize = 1
+        latency = None
+        seq = 0
+        emit = 0
+        exhausted = False
+        try:
+            while not exhausted or seq > emit:
+                # Keep the pool fed, up to the in-flight limit
+                while not exhausted and seq - emit < self.max_inflight:
+                    chunk = list(itertools.islice(records, chunksize))
+                    if not chunk:
+                        exhausted = True
+                        break
+                    pool.apply_async(
+                        _map_chunk,
+                        (func, self.record, kwargs, seq, chunk),
+                        **callbacks
+                    )
+                    seq += 1
+
+                if seq == emit:
+                    break
+
+                # Wait for a chunk to complete
+                c_seq, results, elapsed, exc = completed.get()
+                if exc is not None:
+                    raise exc
+                if results:
+                    chunksize, latency = self._tune(
+                        chunksize, latency, len(results), elapsed)
+
+                if not self.ordered:
+                    emit += 1
+                    for result in results:
+                        yield result
+                    continue
+
+                # Emit the chunks that are now in order
+                done[c_seq] = results
+                while emit in done:
+                    for result in done.pop(emit):
+                        yield result
+                    emit += 1
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+
+class Shard(object):
+    """
+    Describe one slice of a body of work divided among several
+    processes or machines.  A ``Shard`` can be used as a predicate on
+    item keys, using a stable hash, or to compute a contiguous range of
+    a sequence.  The hash is the CRC-32 of the key, which is the same
+    on every platform and Python version, so every process agrees on
+    which shard owns each item.
+    """
+
+    def __init__(self, index=0, count=1):
+        """
+        Initialize a ``Shard``.
+
+        :param index: The index of this shard, counting from 0.
+        :param count: The total number of shards.
+        """
+
+        if count < 1 or not 0 <= index < count:
+            raise ValueError('invalid shard %d/%d' % (index, count))
+
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Parse a shard specification.  This is suitable for use as the
+        ``type`` of an argument.
+
+        :param text: The shard specification, in the form
+                     "INDEX/COUNT".
+
+        :returns: A ``Shard`` instance.
+        """
+
+        try:
+            index, count = text.split('/')
+            return cls(int(index), int(count))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'invalid shard %r: expected INDEX/COUNT, with '
+                '0 <= INDEX < COUNT' % text)
+
+    def __repr__(self):
+        """
+        Return a representation of the shard.
+
+        :returns: The shard specification, in the form "INDEX/COUNT".
+        """
+
+        return '%d/%d' % (self.index, self.count)
+
+    def __eq__(self, other):
+        """
+        Compare two shards for equality.
+
+        :param other: The other shard.
+
+        :returns: ``True`` if the shards are equal.
+        """
+
+        if not isinstance(other, Shard):
+            return NotImplemented
+        return (self.index, self.count) == (other.index, other.count)
+
+    def __ne__(self, other):
+        """
+        Compare two shards for inequality.
+
+        :param other: The other shard.
+
+        :returns: ``True`` if the shards are not equal.
+        """
+
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        """
+        Compute the hash of the shard.
+
+        :returns: The hash value.
+        """
+
+        return hash((self.index, self.count))
+
+    def owns(self, key):
+        """
+        Determine whether an item belongs to this shard.
+
+        :param key: The item key.  Text is encoded as UTF-8; keys other
+                    than text or bytes are converted to text first.
+
+        :returns: ``True`` if the item belongs to this shard.
+        """
+
+        if self.count == 1:
+            return True
+
+        return ((zlib.crc32(_key_bytes(key)) & 0xffffffff) % self.count ==
+                self.index)
+
+    __call__ = owns
+    __contains__ = owns
+
+    def filter(self, items, key=None):
+        """
+        Select the items belonging to this shard.
+
+        :param items: An iterable of items.
+        :param key: An optional function to compute the key of an item.
+                    By default, the item is its own key.
+
+        :returns: An iterator over the items belonging to this shard.
+        """
+
+        for item in items:
+            if self.owns(item if key is None else key(item)):
+                yield item
+
+    def range(self, total):
+        """
+        Compute the contiguous range of a sequence belonging to this
+        shard.  The ranges of all the shards cover the sequence, and
+        their sizes differ by at most one.
+
+        :param total: The length of the sequence.
+
+        :returns: A tuple of the start and stop indexes.
+        """
+
+        return (total * self.index // self.count,
+                total * (self.index + 1) // self.count)
+
+    def slice(self, seq):
+        """
+        Select the contiguous part of a sequence belonging to this
+        shard.
+
+        :param seq: The sequence.
+
+        :returns: The slice of the sequence belonging to this shard.
+        """
+
+        start, stop = self.range(len(seq))
+        return seq[start:stop]
+
+
+class Journal(object):
+    """
+    Record the keys of completed work items, so that an interrupted
+    command may be resumed.  The journal is an append-only file of
+    fixed-size records, each holding a 64-bit digest of an item key;
+    records are buffered, and are written and synchronized to disk in
+    batches.  A ``Journal`` with no path records nothing.
+
+    Note that the items completed since the last batch was written will
+    be processed again when the command is resumed.
+    """
+
+    # The size of a journal record
+    record_size = 8
+
+    def __init__(self, path=None, resume=False, batch=1000, interval=1.0):
+        """
+        Initialize a ``Journal``.  The journal file is not opened until
+        it is first used.
+
+        :param path: The path of the journal file.
+        :param resume: If ``True``, the keys recorded in an existing
+                       journal file are treated as completed.
+                       Otherwise, any existing journal file is
+                       truncated.
+        :param batch: The maximum number of records to buffer before
+                      writing them.
+        :param interval: The maximum number of seconds to buffer a
+                         record before writing it.
+        """
+
+        self.path = path
+        self.resume = resume
+        self.batch = batch
+        self.interval = interval
+
+        self._file = None
+        self._done = set()
+        self._pending = []
+        self._flushed = None
+
+    def __enter__(self):
+        """
+        Enter a context.  The journal is closed when the context is
+        exited.
+
+        :returns: The journal.
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Exit a context, closing the journal.
+
+        :param exc_type: The type of the exception, if any.
+        :param exc_value: The exception, if any.
+        :param exc_tb: The traceback, if any.
+        """
+
+        self.close()
+
+    def _open(self):
+        """
+        Open the journal file, if it is not already open.  When
+        resuming, the completed keys are read from the file, and any
+        partial record at the end of the file is discarded.
+        """
+
+        if self._file is not None or self.path is None:
+            return
+
+        if self.resume and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            size = len(data) - len(data) % self.record_size
+            self._done = set(
+                data[i:i + self.record_size]
+                for i in six.moves.range(0, size, self.record_size)
+            )
+            self._file = open(self.path, 'r+b')
+            self._file.truncate(size)
+            self._file.seek(size)
+        else:
+            self._file = open(self.path, 'wb')
+
+        self._flushed = time.time()
+
+    def _digest(self, key):
+        """
+        Compute the digest recorded for a key.
+
+        :param key: The item key.
+
+        :returns: The digest.
+        """
+
+        return hashlib.md5(_key_bytes(key)).digest()[:self.record_size]
+
+    def is_done(self, key):
+        """
+        Determine whether an item has been recorded as completed.
+
+        :param key: The item key.
+
+        :returns: ``True`` if the item has been recorded as completed.
+        """
+
+        if self.path is None:
+            return False
+
+        self._open()
+        return self._digest(key) in self._done
+
+    __contains__ = is_done
+
+    def done(self, key):
+        """
+        Record an item as completed.
+
+        :param key: The item key.
+        """
+
+        if self.path is None:
+            return
+
+        self._open()
+        digest = self._digest(key)
+        if digest in self._done:
+            return
+
+        self._done.add(digest)
+        self._pending.append(digest)
+        if (len(self._pending) >= self.batch or
+                time.time() - self._flushed >= self.interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records and synchronize them to disk.
+        """
+
+        if self._file is None:
+            return
+
+        if self._pending:
+            self._file.write(b''.join(self._pending))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = []
+
+        self._flushed = time.time()
+
+    def close(self):
+        """
+        Write the buffered records and close the journal file.
+        """
+
+        if self._file is None:
+            return
+
+        self.flush()
+        self._file.close()
+        self._file = None
+
+    def iterate(self, items, key=None):
+        """
+        Iterate over the items not yet completed.  An item is recorded
+        as completed when the next item is requested, or when the
+        iteration finishes; the buffered records are written when the
+        iteration ends.
+
+        :param items: An iterable of items.
+        :param key: An optional function to compute the key of an item.
+                    By default, the item is its own key.
+
+        :returns: An iterator over the items not yet completed.
+        """
+
+        try:
+            for item in items:
+                item_key = item if key is None else key(item)
+                if self.is_done(item_key):
+                    continue
+                yield item
+                self.done(item_key)
+        finally:
+            self.flush()
+
+
+class _JournalAction(argparse.Action):
+    """
+    An ``argparse`` action for the options added by ``@checkpoint()``.
+    Each option replaces the ``Journal`` in the namespace with one
+    combining the existing settings and the new one.
+    """
+
+    def __init__(self, option_strings, dest, resume=False, batch=1000,
+                 interval=1.0, **kwargs):
+        """
+        Initialize a ``_JournalAction``.
+
+        :param option_strings: The option strings.
+        :param dest: The attribute holding the ``Journal``.
+        :param resume: If ``True``, the option enables resuming;
+                       otherwise, it takes the path of the journal
+                       file.
+        :param batch: The batch size of the ``Journal``.
+        :param interval: The flush interval of the ``Journal``.
+
+        Remaining keyword arguments are passed to ``argparse.Action``.
+        """
+
+        if resume:
+            kwargs['nargs'] = 0
+        kwargs.setdefault('default', Journal(batch=batch, interval=interval))
+        super(_JournalAction, self).__init__(option_strings, dest, **kwargs)
+
+        self.resume = resume
+        self.batch = batch
+        self.interval = interval
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        """
+        Process the option.
+
+        :param parser: The argument parser.
+        :param namespace: The ``argparse.Namespace`` being built.
+        :param values: The option value.
+        :param option_string: The option string used.
+        """
+
+        journal = getattr(namespace, self.dest, None)
+        if journal is None:
+            journal = Journal()
+        setattr(namespace, self.dest, Journal(
+            journal.path if self.resume else values,
+            True if self.resume else journal.resume,
+            self.batch, self.interval,
+        ))
+
+
+class _PluginReportAction(argparse.Action):
+    """
+    An ``argparse`` action for the option added by ``@plugin_report()``.
+    The option writes a report of the subcommands loaded from
+    entrypoints, then exits.
+    """
+
+    def __init__(self, option_strings, dest, adaptor=None, **kwargs):
+        """
+        Initialize a ``_PluginReportAction``.
+
+        :param option_strings: The option strings.
+        :param dest: The destination attribute; unused.
+        :param adaptor: The ``ScriptAdaptor`` whose entrypoints are
+                        reported.
+
+        Remaining keyword arguments are passed to ``argparse.Action``.
+        """
+
+        kwargs['nargs'] = 0
+        kwargs.setdefault('default', argparse.SUPPRESS)
+        super(_PluginReportAction, self).__init__(
+            option_strings, dest, **kwargs)
+
+        self.adaptor = adaptor
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        """
+        Write the report and exit.
+
+        :param parser: The argument parser.
+        :param namespace: The ``argparse.Namespace`` being built.
+        :param values: The option value; unused.
+        :param option_string: The option string used.
+        """
+
+        lines = []
+        for load in self.adaptor.get_plugin_loads():
+            if load.seconds is None:
+                outcome = 'quarantined: %s' % load.error
+            elif load.error:
+                outcome = 'failed in %.3fs: %s' % (load.seconds, load.error)
+            else:
+                outcome = 'loaded in %.3fs' % load.seconds
+            lines.append('%s %s (%s): %s\n' %
+                         (load.group, load.name, load.dist, outcome))
+
+        parser.exit(message=''.join(lines) or 'no plugins loaded\n')
+
+
+class ResultCache(object):
+    """
+    A cache of function results, stored on disk.  Each result is
+    pickled into its own file in the cache directory.  The least
+    recently used results are evicted when the total size of the
+    cached results exceeds a limit, and results may optionally expire.
+    """
+
+    # The extension of the cache files
+    extension = '.pickle'
+
+    def __init__(self, directory=None, max_size=100 * 1024 * 1024,
+                 ttl=None):
+        """
+        Initialize a ``ResultCache``.
+
+        :param directory: The cache directory.  Defaults to the
+                          "results" directory in the user's cache
+                          directory.  It will be created if necessary.
+        :param max_size: The maximum total size, in bytes, of the
+                         cached results.
+        :param ttl: The number of seconds after which a cached result
+                    expires.  If ``None``, results do not expire.
+        """
+
+        self.directory = directory or _cache_dir('results')
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def _path(self, key):
+        """
+        Compute the path of the cache file for a key.
+
+        :param key: The cache key.
+
+        :returns: The path of the cache file.
+        """
+
+        return os.path.join(self.directory, key + self.extension)
+
+    def key(self, ident, kwargs, paths=(), content=False):
+        """
+        Compute a cache key.
+
+        :param ident: A string identifying the function.
+        :param kwargs: A dictionary of the keyword arguments of the
+                       function.  The ``repr()`` of each value is
+                       used, so values must have a stable
+                       representation.
+        :param paths: A list of the paths of input files.
+        :param content: If ``True``, input files are fingerprinted
+                        using a digest of their contents; otherwise,
+                        their sizes and modification times are used.
+
+        :returns: The cache key, as text.
+        """
+
+        return _digest_call(ident, kwargs, paths, content)
+
+    def get(self, key):
+        """
+        Retrieve a cached result.  An unreadable or expired cache file
+        is treated as a miss.
+
+        :param key: The cache key.
+
+        :returns: A tuple of a boolean indicating whether the result
+                  was found and the result.
+        """
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, result = pickle.load(f)
+        except Exception:
+            return False, None
+
+        if expires is not None and expires <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return False, None
+
+        # Mark the result as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return True, result
+
+    def put(self, key, result):
+        """
+        Cache a result, then evict results as needed.  Results which
+        cannot be pickled are not cached.
+
+        :param key: The cache key.
+        :param result: The result to cache.
+
+        :returns: ``True`` if the result was cached.
+        """
+
+        expires = None if self.ttl is None else time.time() + self.ttl
+        try:
+            data = pickle.dumps((expires, result), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+
+        _makedirs(self.directory)
+        _write_atomic(self._path(key), data)
+
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Evict the least recently used results until the total size of
+        the cached results is within the limit.
+        """
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.extension):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class ConverterCache(object):
+    """
+    A persistent cache of the values computed by type converters and
+    similar functions, stored in an SQLite database.  Entries expire
+    after a time, and the least recently used entries are evicted when
+    the number of entries exceeds a limit.  The database may be shared
+    by concurrent processes; if it cannot be used, values are simply
+    not cached.
+    """
+
+    def __init__(self, path=None, ttl=3600, max_entries=10000):
+        """
+        Initialize a ``ConverterCache``.  The database is not opened
+        until it is first used.
+
+        :param path: The path of the database.  Defaults to
+                     "converters.sqlite" in the user's cache directory.
+                     The containing directory will be created if
+                     necessary.
+        :param ttl: The number of seconds after which an entry
+                    expires.  If ``None``, entries do not expire.
+        :param max_entries: The maximum number of entries.
+        """
+
+        self.path = path or os.path.join(_cache_dir('converters'),
+                                         'converters.sqlite')
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        """
+        Open the database, if it is not already open in this process,
+        and create the table of entries if necessary.
+
+        :returns: An ``sqlite3`` connection.
+        """
+
+        if self._conn is None or self._pid != os.getpid():
+            _makedirs(os.path.dirname(self.path) or '.')
+            conn = sqlite3.connect(self.path, timeout=30.0)
+            with conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS entries ('
+                    'converter TEXT NOT NULL, input TEXT NOT NULL, '
+                    'value BLOB NOT NULL, expires REAL, used REAL NOT NULL, '
+                    'PRIMARY KEY (converter, input))'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS entries_used '
+                             'ON entries (used)')
+            self._conn = conn
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def get(self, converter, text):
+        """
+        Retrieve a cached value.
+
+        :param converter: A string identifying the converter.
+        :param text: The input of the converter, as text.
+
+        :returns: A tuple of a boolean indicating whether the value
+                  was found and the value.
+        """
+
+        if sqlite3 is None:
+            return False, None
+
+        now = time.time()
+        try:
+            conn = self._connect()
+            with conn:
+                row = conn.execute(
+                    'SELECT value FROM entries WHERE converter = ? AND '
+                    'input = ? AND (expires IS NULL OR expires > ?)',
+                    (converter, text, now),
+                ).fetchone()
+                if row is None:
+                    return False, None
+
+                # Mark the entry as recently used
+                conn.execute(
+                    'UPDATE entries SET used = ? WHERE converter = ? AND '
+                    'input = ?', (now, converter, text),
+                )
+            return True, pickle.loads(bytes(row[0]))
+        except Exception:
+            return False, None
+
+    def put(self, converter, text, value):
+        """
+        Cache a value, then evict expired and least recently used
+        entries as needed.  Values which cannot be pickled are not
+        cached.
+
+        :param converter: A string identifying the converter.
+        :param text: The input of the converter, as text.
+        :param value: The value to cache.
+
+        :returns: ``True`` if the value was cached.
+        """
+
+        if sqlite3 is None:
+            return False
+
+        now = time.time()
+        expires = None if self.ttl is None else now + self.ttl
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                    (converter, text, sqlite3.Binary(data), expires, now),
+                )
+                conn.execute('DELETE FROM entries WHERE expires <= ?',
+                             (now,))
+                conn.execute(
+                    'DELETE FROM entries WHERE rowid IN (SELECT rowid '
+                    'FROM entries ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,),
+                )
+        except Exception:
+            return False
+
+        return True
+
+
+def console(func):
+    """
+    Decorator to mark a script as a console script.  This decorator is
+    optional, but can be used if no arguments other than the default
+    ``argparse`` arguments (such as "--help") are specified.
+    """
 
     # This will ensure that the ScriptAdaptor is attached to the
     # function
@@ -781,6 +4385,46 @@ def argument(*args, **kwargs):
     return decorator
 
 
+def option_argument(option_set, *args, **kwargs):
+    """
+    Decorator used to add an argument to a named option set.  An option
+    set is typically declared on a command having subcommands, and
+    referenced by those subcommands using @use_options(); the argument
+    specifications are then shared by all the subcommands, and the
+    arguments are only set up on the parser of the subcommand actually
+    selected.  Positional and keyword arguments have the same meaning
+    as those given to ``argparse.ArgumentParser.add_argument()``.
+
+    :param option_set: The name of the option set.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._add_option(option_set, args, kwargs)
+        return func
+    return decorator
+
+
+def use_options(option_set, **kwargs):
+    """
+    Decorator used to add the arguments of a named option set to the
+    console script.  The option set is looked up on the console script
+    and on the commands of which it is a subcommand, beginning with the
+    innermost.  If keyword arguments are given, the arguments are
+    placed in an argument group, and the keyword arguments have the
+    same meaning as those given to
+    ``argparse.ArgumentParser.add_argument_group()``.
+
+    :param option_set: The name of the option set.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._use_options(option_set, kwargs)
+        return func
+    return decorator
+
+
 def argument_group(group, **kwargs):
     """
     Decorator used to specify an argument group.  Keyword arguments
@@ -847,3 +4491,508 @@ def load_subcommands(group):
         adaptor._add_extensions(group)
         return func
     return decorator
+
+
+def quarantine_plugins(directory=None, ttl=None):
+    """
+    Decorator used to quarantine the entrypoints of the groups declared
+    with ``@load_subcommands()`` which fail to load.  A quarantined
+    entrypoint is not loaded again until its distribution is upgraded
+    or reinstalled, or until the quarantine expires, so a broken plugin
+    does not slow down every invocation.
+
+    :param directory: The quarantine directory.  Defaults to the
+                      "plugins" directory in the user's cache
+                      directory.
+    :param ttl: The number of seconds after which an entrypoint is
+                released from quarantine.  If ``None``, entrypoints are
+                only released when their distribution changes.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._quarantine = ResultCache(
+            directory or _cache_dir('plugins'), ttl=ttl)
+        return func
+    return decorator
+
+
+def plugin_report(flag='--plugin-report'):
+    """
+    Decorator used to add an option which reports the subcommands
+    loaded from the entrypoint groups declared with
+    ``@load_subcommands()``: the time taken to load each, and why any
+    failed to load.  The report is written to standard error, and the
+    console script exits.
+
+    :param flag: The option string.  Defaults to "--plugin-report".
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._add_argument(
+            (flag,),
+            dict(action=_PluginReportAction, adaptor=adaptor,
+                 help='Report the time taken to load each plugin, and '
+                 'why any failed to load, then exit.'),
+            group=None,
+        )
+        return func
+    return decorator
+
+
+def record_mapper(**kwargs):
+    """
+    Decorator used to turn a per-record function into a streaming
+    console script.  When called as a console script, records are read
+    from the files named on the command line (or from standard input),
+    dispatched in chunks to a process pool running the function, and
+    the results are written to standard output.  The record is passed
+    to the function as the keyword argument named by ``record``; other
+    arguments are passed as usual.  Keyword arguments have the same
+    meaning as those given to ``RecordMapper``.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._mapper = RecordMapper(**kwargs)
+        adaptor._add_argument(
+            (adaptor._mapper.inputs,),
+            dict(metavar='FILE', nargs='*',
+                 help='Files to read records from.  Standard input is '
+                 'read if no files are given.'),
+            group=None,
+        )
+        return func
+    return decorator
+
+
+def shard(*args, **kwargs):
+    """
+    Decorator used to add a standard work sharding option to the
+    console script.  The option takes a value of the form
+    "INDEX/COUNT", and the function receives a ``Shard`` instance; if
+    the option is not given, the ``Shard`` owns all the work.
+    Positional and keyword arguments have the same meaning as those
+    given to ``argparse.ArgumentParser.add_argument()``, and override
+    the defaults: an option string of "--shard" and a ``dest`` of
+    "shard".
+    """
+
+    options = dict(dest='shard', type=Shard.parse, default=Shard(),
+                   metavar='INDEX/COUNT',
+                   help='Process only the given shard of the work, where '
+                   'INDEX counts from 0.  Defaults to all the work.')
+    options.update(kwargs)
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._add_argument(args or ('--shard',), options, group=None)
+        return func
+    return decorator
+
+
+def checkpoint(dest='journal', batch=1000, interval=1.0):
+    """
+    Decorator used to add checkpoint and resume options to the console
+    script.  The "--journal PATH" option names a journal file in which
+    the keys of completed work items are recorded, and the "--resume"
+    option causes the items recorded in an existing journal file to be
+    treated as completed.  The function receives a ``Journal``; if no
+    journal file is named, the ``Journal`` records nothing.
+
+    :param dest: The name of the function argument which receives the
+                 ``Journal``.  Defaults to "journal".
+    :param batch: The maximum number of records to buffer before
+                  writing them.
+    :param interval: The maximum number of seconds to buffer a record
+                     before writing it.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._add_argument(
+            ('--resume',),
+            dict(dest=dest, action=_JournalAction, resume=True,
+                 batch=batch, interval=interval,
+                 help='Skip the work items recorded as completed in the '
+                 'journal file.'),
+            group=None,
+        )
+        adaptor._add_argument(
+            ('--journal',),
+            dict(dest=dest, action=_JournalAction, metavar='PATH',
+                 batch=batch, interval=interval,
+                 help='Record completed work items in the journal file '
+                 'PATH.'),
+            group=None,
+        )
+        return func
+    return decorator
+
+
+def pipeline(separator='--'):
+    """
+    Decorator used to allow several subcommands to be run as a
+    pipeline in a single process.  The command line is split into
+    stages at each occurrence of the separator which is followed by
+    the name of a subcommand, and the return value
+    of each stage is passed to the next stage.  Stages which accept
+    the result of the previous stage must be marked using
+    ``@pipe_input()``.
+
+    :param separator: The argument separating the stages of the
+                      pipeline.  Defaults to "--".
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor.pipe_separator = separator
+        return func
+    return decorator
+
+
+def pipe_input(dest):
+    """
+    Decorator used to mark a function as accepting the result of the
+    previous stage of a pipeline.  See ``@pipeline()``.  When the
+    function is the first stage, or is not run in a pipeline, the
+    argument will be ``None``.
+
+    :param dest: The name of the function argument which receives the
+                 result of the previous stage.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor.pipe_input = dest
+        return func
+    return decorator
+
+
+def cached(directory=None, max_size=100 * 1024 * 1024, ttl=None, files=(),
+           content=False, flags=True):
+    """
+    Decorator used to cache the results of a console script which is
+    a pure function of its arguments and input files.  The cache key
+    is computed from the keyword arguments of the function and the
+    fingerprints of its input files; when a result is cached, it is
+    returned without calling the function.  Results are cached only
+    when the function succeeds.  Unless ``flags`` is ``False``, the
+    "--no-cache" option bypasses the cache, and the "--refresh-cache"
+    option recomputes and replaces the cached result.
+
+    :param directory: The cache directory.  See ``ResultCache``.
+    :param max_size: The maximum total size, in bytes, of the cached
+                     results.
+    :param ttl: The number of seconds after which a cached result
+                expires.  If ``None``, results do not expire.
+    :param files: A list of the names of function arguments holding
+                  the paths of input files; each argument may hold a
+                  path, a list of paths, or ``None``.
+    :param content: If ``True``, input files are fingerprinted using
+                    a digest of their contents, rather than their
+                    sizes and modification times.
+    :param flags: If ``True`` (the default), the "--no-cache" and
+                  "--refresh-cache" options are added.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        cache = ResultCache(directory, max_size, ttl)
+        ident = _func_ident(func)
+
+        def result_cache(args):
+            if getattr(args, 'no_cache', False):
+                return
+
+            kwargs = adaptor.get_kwargs(adaptor._func, args)
+            kwargs.pop('no_cache', None)
+            kwargs.pop('refresh_cache', None)
+            paths = []
+            for name in files:
+                value = getattr(args, name, None)
+                if isinstance(value, six.string_types):
+                    paths.append(value)
+                elif value is not None:
+                    paths.extend(value)
+            key = cache.key(ident, kwargs, paths, content)
+
+            if not getattr(args, 'refresh_cache', False):
+                hit, result = cache.get(key)
+                if hit:
+                    yield ShortCircuit(result)
+                    return
+
+            result = yield
+            try:
+                cache.put(key, result)
+            except EnvironmentError:
+                # The cache is only an optimization
+                pass
+
+        adaptor.middleware(result_cache, inherit=False)
+        if flags:
+            adaptor._add_argument(
+                ('--refresh-cache',),
+                dict(action='store_true',
+                     help='Recompute the result, replacing any cached '
+                     'result.'),
+                group=None,
+            )
+            adaptor._add_argument(
+                ('--no-cache',),
+                dict(action='store_true',
+                     help='Neither use nor update the cached result.'),
+                group=None,
+            )
+        return func
+    return decorator
+
+
+def low_memory(freeze=True):
+    """
+    Decorator used to run the console script in low memory mode.  Once
+    the command line has been parsed, and before the function is
+    called, the argument parser and the adaptors of the subcommands
+    which were not selected are released, and a garbage collection is
+    run.  This is intended for long-running commands; the command may
+    not be parsed again in the same process.
+
+    :param freeze: If ``True``, and if supported by the Python version,
+                   the objects remaining after the collection are
+                   moved to the permanent generation, so that the
+                   collector does not write to their pages in forked
+                   worker processes.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._low_memory = freeze
+        return func
+    return decorator
+
+
+def cache_help(directory=None, max_size=10 * 1024 * 1024):
+    """
+    Decorator used to cache the help text of the console script and its
+    subcommands.  When the command line consists only of a path of
+    subcommands followed by "-h" or "--help", the cached help text is
+    written without building the argument parser or importing any
+    subcommands.  The cached help text is replaced when the source
+    files of the modules used to render it change, when the installed
+    entrypoints change, or when the terminal width changes.
+
+    :param directory: The cache directory.  Defaults to the "help"
+                      directory in the user's cache directory.
+    :param max_size: The maximum total size, in bytes, of the cached
+                     help texts.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        adaptor._help_cache = ResultCache(directory or _cache_dir('help'),
+                                          max_size)
+        return func
+    return decorator
+
+
+def singleflight(directory=None, timeout=None):
+    """
+    Decorator used to coalesce identical invocations of a console
+    script running concurrently on one host.  The first invocation
+    takes a lock identified by the keyword arguments of the function
+    and runs the function; invocations with the same arguments which
+    start while it is running wait for it to finish, then return its
+    result--or raise its exception--without calling the function.  If
+    the first invocation dies, or its result or exception cannot be
+    pickled, a waiting invocation runs the function instead.  Locks
+    are taken using ``fcntl.flock()``; where that is not available, or
+    where the directory cannot be written, invocations are not
+    coalesced.  Lock and result files which have not been used for ten
+    minutes are removed.
+
+    :param directory: The directory holding the lock and result
+                      files.  Defaults to the "singleflight" directory
+                      in the user's cache directory.  To coalesce
+                      invocations by several users, this must be a
+                      directory all of them can write to.
+    :param timeout: The maximum number of seconds to wait for another
+                    invocation.  When it expires, the function is
+                    called anyway.  If ``None``, the wait is
+                    unbounded.
+    """
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        ident = _func_ident(func)
+
+        def coalesce(args):
+            if fcntl is None:
+                return
+
+            flight_dir = directory or _cache_dir('singleflight')
+            base = os.path.join(flight_dir, _digest_call(
+                ident, adaptor.get_kwargs(adaptor._func, args)))
+            try:
+                _makedirs(flight_dir)
+                lock = open(base + '.lock', 'ab')
+            except EnvironmentError:
+                # Coalescing is only an optimization; run uncoalesced
+                yield
+                return
+
+            with lock:
+                started = time.time()
+                if not _acquire(lock, 0):
+                    # Another invocation is running the function; wait
+                    # for it to finish
+                    if not _acquire(lock, timeout):
+                        yield
+                        return
+
+                    try:
+                        with open(base + '.result', 'rb') as f:
+                            finished, ok, value = pickle.load(f)
+                    except Exception:
+                        finished = None
+
+                    # Use its outcome only if it was produced while we
+                    # were waiting
+                    if finished is not None and finished >= started:
+                        if not ok:
+                            raise value
+                        yield ShortCircuit(value)
+                        return
+
+                # Mark the lock as in use, and clear out the files of
+                # invocations long gone
+                try:
+                    os.utime(base + '.lock', None)
+                    _expire_flights(flight_dir, _flight_expiry)
+                except EnvironmentError:
+                    pass
+
+                # Run the function, and publish the outcome before
+                # releasing the lock
+                outcome = None
+                try:
+                    result = yield
+                    outcome = (time.time(), True, result)
+                except Exception as exc:
+                    outcome = (time.time(), False, exc)
+                    raise
+                finally:
+                    try:
+                        data = pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+                    except Exception:
+                        data = None
+                    if outcome is not None and data is not None:
+                        try:
+                            _write_atomic(base + '.result', data)
+                        except EnvironmentError:
+                            # Waiting invocations will run the function
+                            pass
+
+        adaptor.middleware(coalesce, inherit=False)
+        return func
+    return decorator
+
+
+def limit_concurrency(slots, name=None, timeout=None, fail_fast=False,
+                      directory=None):
+    """
+    Decorator used to limit the number of instances of a console
+    script which may run at once on a host, across all processes.
+    When all the slots are taken, the function waits for one to be
+    released.  The limiter is implemented as middleware, so the time
+    spent waiting for a slot is reported by ``get_timings()``
+    separately from the time spent running the function.  Slots are
+    lock files taken using ``fcntl.flock()``; where that is not
+    available, the number of instances is not limited.
+
+    :param slots: The maximum number of instances which may run at
+                  once.
+    :param name: The name of the set of slots.  Functions decorated
+                 with the same name share the slots.  Defaults to the
+                 module and name of the function.
+    :param timeout: The maximum number of seconds to wait for a slot,
+                    after which the function fails.  If ``None``, the
+                    wait is unbounded.
+    :param fail_fast: If ``True``, fail immediately if no slot is
+                      available, rather than waiting.
+    :param directory: The directory holding the slot lock files.
+                      Defaults to the "slots" directory in the user's
+                      cache directory.  To limit instances run by
+                      several users, this must be a directory all of
+                      them can write to.
+
+    :raises ValueError: ``slots`` is less than 1.
+    """
+
+    if slots < 1:
+        raise ValueError('invalid number of slots %r' % (slots,))
+
+    def decorator(func):
+        adaptor = ScriptAdaptor._get_adaptor(func)
+        slot_name = (name or _func_ident(func)).replace(os.sep, '_')
+
+        def concurrency_limit(args):
+            if fcntl is None:
+                return
+
+            lock = _acquire_slot(directory or _cache_dir('slots'),
+                                 slot_name, slots,
+                                 0 if fail_fast else timeout)
+            if lock is None:
+                raise RuntimeError('%d instance(s) of %s already running' %
+                                   (slots, slot_name))
+
+            try:
+                yield
+            finally:
+                lock.close()
+
+        adaptor.middleware(concurrency_limit, inherit=False)
+        return func
+    return decorator
+
+
+def cached_converter(path=None, ttl=3600, max_entries=10000, key=None):
+    """
+    Decorator used to cache the values computed by an expensive type
+    converter, or a similar function such as a completion provider,
+    across invocations.  Values are cached in a ``ConverterCache``,
+    keyed by the module and name of the function and its input;
+    exceptions are not cached.
+
+    :param path: The path of the cache database.  See
+                 ``ConverterCache``.
+    :param ttl: The number of seconds after which a cached value
+                expires.  If ``None``, values do not expire.
+    :param max_entries: The maximum number of cached values.
+    :param key: A function computing the input from the arguments of
+                the decorated function.  By default, the input is the
+                first positional argument, converted to text.
+    """
+
+    cache = ConverterCache(path, ttl, max_entries)
+
+    def decorator(func):
+        ident = _func_ident(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            text = (key(*args, **kwargs) if key else
+                    six.text_type(args[0]))
+            found, value = cache.get(ident, text)
+            if found:
+                return value
+
+            value = func(*args, **kwargs)
+            cache.put(ident, text, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
@@ -13,11 +13,25 @@
 #    under the License.
 
 import argparse
+import collections
+import errno
+import hashlib
+import importlib
 import inspect
+import itertools
+import os
+import py_compile
+import subprocess
+import sys
+import time
+import weakref
+import zipfile
+import zlib
 
 import pkg_resources
 import pytest
 import six
+from six.moves import cPickle as pickle
 
 import cli_tools
 
@@ -26,6 +40,12 @@ class ExceptionForTest(Exception):
     pass
 
 
+def map_record(record, factor=1):
+    if record == 'boom':
+        raise ExceptionForTest(record)
+    return int(record) * factor
+
+
 class MockGen(six.Iterator):
     def __init__(self, generator):
         self.generator = generator
@@ -46,6 +66,64 @@ class MockGen(six.Iterator):
         return self.generator.close()
 
 
+class MockAsyncGen(object):
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __anext__(self):
+        return self.generator.anext()
+
+    def asend(self, value):
+        return self.generator.asend(value)
+
+    def athrow(self, exc_type, exc_value=None, exc_tb=None):
+        return self.generator.athrow(exc_type, exc_value, exc_tb)
+
+    def aclose(self):
+        return self.generator.aclose()
+
+
+class MockAsyncGenFunc(object):
+    def __init__(self, generator):
+        self.generator = generator
+
+    def __call__(self, *args, **kwargs):
+        # Log in the call, but ignore return value
+        self.generator.call(*args, **kwargs)
+
+        # It'll always be a MockAsyncGen object
+        return MockAsyncGen(self.generator)
+
+
+class AwaitableForTest(object):
+    def __init__(self, value=None, exc=None):
+        self.value = value
+        self.exc = exc
+        self.suspended = False
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Suspend once, so the event loop actually gets involved
+        if not self.suspended:
+            self.suspended = True
+            return None
+        if self.exc:
+            raise self.exc
+        raise StopIteration(self.value)
+
+
+requires_asyncio = pytest.mark.skipif(
+    cli_tools.asyncio is None, reason='asyncio is not available')
+
+requires_fcntl = pytest.mark.skipif(
+    cli_tools.fcntl is None, reason='fcntl is not available')
+
+
 class MockGenFunc(object):
     def __init__(self, generator):
         self.generator = generator
@@ -58,6 +136,43 @@ class MockGenFunc(object):
         return MockGen(self.generator)
 
 
+class TestNoop(object):
+    def test_noop(self):
+        assert cli_tools._noop('arg') is None
+
+
+class TestIntern(object):
+    def test_str(self):
+        value = ''.join(['--', 'region'])
+
+        result = cli_tools._intern(value)
+
+        assert result == '--region'
+        assert result is cli_tools._intern(''.join(['--', 'region']))
+
+    def test_other(self):
+        value = ('--', 'region')
+
+        assert cli_tools._intern(value) is value
+
+
+class TestSpecs(object):
+    def test_make_spec(self):
+        result = cli_tools._make_spec(('argument', ('--a',), {}))
+
+        assert isinstance(result, cli_tools._Spec)
+        assert result.type == 'argument'
+        assert result.args == ('--a',)
+        assert result.kwargs == {}
+
+    def test_make_argspec(self):
+        result = cli_tools._make_argspec((('--a',), {}))
+
+        assert isinstance(result, cli_tools._ArgSpec)
+        assert result.args == ('--a',)
+        assert result.kwargs == {}
+
+
 class TestCleanText(object):
     def test_clean_text(self):
         text = """
@@ -214,7 +329,6 @@ class TestScriptAdaptor(object):
         assert sa.description == 'description'
         assert sa.epilog is None
         assert sa.formatter_class == argparse.HelpFormatter
-        assert sa._subcmd_attr == '_script_adaptor_%x' % id(sa)
         assert not mock_isclass.called
 
     def test_init_isclass(self, mocker):
@@ -240,7 +354,6 @@ class TestScriptAdaptor(object):
         assert sa.description == 'description'
         assert sa.epilog is None
         assert sa.formatter_class == argparse.HelpFormatter
-        assert sa._subcmd_attr == '_script_adaptor_%x' % id(sa)
         assert not mock_isclass.called
 
     def test_init_discoverclass_false(self, mocker):
@@ -266,7 +379,6 @@ class TestScriptAdaptor(object):
         assert sa.description == 'description'
         assert sa.epilog is None
         assert sa.formatter_class == argparse.HelpFormatter
-        assert sa._subcmd_attr == '_script_adaptor_%x' % id(sa)
         mock_isclass.assert_called_once_with(func)
 
     def test_init_discoverclass_true(self, mocker):
@@ -292,7 +404,6 @@ class TestScriptAdaptor(object):
         assert sa.description == 'description'
         assert sa.epilog is None
         assert sa.formatter_class == argparse.HelpFormatter
-        assert sa._subcmd_attr == '_script_adaptor_%x' % id(sa)
         mock_isclass.assert_called_once_with(func)
 
     def test_add_argument(self, mocker):
@@ -308,7 +419,7 @@ class TestScriptAdaptor(object):
             ('argument', (4, 5, 6), dict(a=1, b=2, c=3)),
             ('argument', (1, 2, 3), dict(a=4, b=5, c=6)),
         ]
-        assert sa._groups == dict(group=dict(arguments=[
+        assert sa._groups == dict(group=cli_tools._GroupSpec(None, [
             ((6, 5, 4), dict(a=3, b=2, c=1)),
             ((3, 2, 1), dict(a=6, b=5, c=4)),
         ]))
@@ -321,8 +432,8 @@ class TestScriptAdaptor(object):
         sa._add_group('group2', 'exclusive', dict(a=3, b=2, c=1))
 
         assert sa._groups == dict(
-            group1=dict(arguments=[], type='group'),
-            group2=dict(arguments=[], type='exclusive'),
+            group1=cli_tools._GroupSpec('group', []),
+            group2=cli_tools._GroupSpec('exclusive', []),
         )
         assert sa._arguments == [
             ('group', 'group2', dict(a=3, b=2, c=1)),
@@ -332,7 +443,7 @@ class TestScriptAdaptor(object):
     def test_add_group_oldgroup(self, mocker):
         func = mocker.Mock(__doc__='')
         sa = cli_tools.ScriptAdaptor(func, False)
-        sa._groups['group'] = dict(type=None)
+        sa._groups['group'] = cli_tools._GroupSpec('group', [])
 
         with pytest.raises(argparse.ArgumentError):
             sa._add_group('group', 'group', dict(a=1, b=2, c=3))
@@ -341,11 +452,122 @@ class TestScriptAdaptor(object):
         func = mocker.Mock(__doc__='')
         sa = cli_tools.ScriptAdaptor(func, False)
 
-        sa._add_subcommand('cmd', 'adaptor')
-        sa._add_subcommand('dmc', 'rotpada')
+        adaptor = mocker.Mock()
+        rotpada = mocker.Mock()
 
-        assert sa._subcommands == dict(cmd='adaptor', dmc='rotpada')
+        sa._add_subcommand('cmd', adaptor)
+        sa._add_subcommand('dmc', rotpada)
+
+        assert sa._subcommands == dict(cmd=adaptor, dmc=rotpada)
         assert sa.do_subs is True
+        assert adaptor._parent is sa
+        assert rotpada._parent is sa
+
+    def test_add_option(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+
+        sa._add_option('common', (1, 2, 3), dict(a=4, b=5, c=6))
+        sa._add_option('common', (2, 3, 4), dict(a=5, b=6, c=7))
+        sa._add_option('other', (3, 4, 5), dict(a=6, b=7, c=8))
+
+        assert sa._option_sets == {
+            'common': [
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+            ],
+            'other': [
+                ((3, 4, 5), dict(a=6, b=7, c=8)),
+            ],
+        }
+        assert isinstance(sa._option_sets['common'][0], cli_tools._ArgSpec)
+        assert sa._arguments == []
+
+    def test_use_options(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+
+        sa._use_options('common', {})
+        sa._use_options('other', dict(title='title'))
+
+        assert sa._arguments == [
+            ('options', 'other', dict(title='title')),
+            ('options', 'common', {}),
+        ]
+
+    def test_find_options(self, mocker):
+        sa1 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa2 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa3 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa1._add_subcommand('sa2', sa2)
+        sa2._add_subcommand('sa3', sa3)
+        sa1._option_sets = {'common': 'outer', 'other': 'other'}
+        sa2._option_sets = {'common': 'inner'}
+
+        assert sa3._find_options('common') == 'inner'
+        assert sa3._find_options('other') == 'other'
+        assert sa1._find_options('common') == 'outer'
+
+    def test_find_options_undefined(self, mocker):
+        sa1 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa2 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa1._add_subcommand('sa2', sa2)
+        sa2._option_sets = {'common': 'inner'}
+
+        with pytest.raises(argparse.ArgumentError):
+            sa1._find_options('common')
+
+    def test_lineage(self, mocker):
+        sa1 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa2 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa3 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa1._add_subcommand('sa2', sa2)
+        sa2._add_subcommand('sa3', sa3)
+
+        assert sa1._lineage() == [sa1]
+        assert sa3._lineage() == [sa1, sa2, sa3]
+
+    def test_slots(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        assert not hasattr(sa, '__dict__')
+        assert weakref.ref(sa)() is sa
+        assert sa._args_hook is cli_tools._noop
+        assert sa._processor is cli_tools._noop
+        with pytest.raises(AttributeError):
+            sa.unknown = 'value'
+
+    def test_add_subcommand_intern(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        name = ''.join(['sub', 'cmd'])
+
+        sa._add_subcommand(name, mocker.Mock())
+
+        key, = sa._subcommands.keys()
+        assert key is cli_tools._intern('subcmd')
+
+    def test_stages(self, mocker):
+        sa1 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa2 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa1._add_subcommand('sa2', sa2)
+        sa1._middleware = [
+            (mocker.Mock(__name__='mw1'), True),
+            (mocker.Mock(__name__='mw2'), False),
+        ]
+        sa2._middleware = [
+            (mocker.Mock(__name__='mw3'), False),
+        ]
+
+        assert sa1._stages() == [
+            ('processor', sa1._processor),
+            ('mw1', sa1._middleware[0][0]),
+            ('mw2', sa1._middleware[1][0]),
+        ]
+        assert sa2._stages() == [
+            ('processor', sa2._processor),
+            ('mw1', sa1._middleware[0][0]),
+            ('mw3', sa2._middleware[0][0]),
+        ]
 
     def test_add_extensions(self, mocker):
         func = mocker.Mock(__doc__='')
@@ -374,16 +596,24 @@ class TestScriptAdaptor(object):
             'ep3': mocker.Mock(**{
                 'load.return_value': mocker.Mock(cli_tools='adaptor3'),
             }),
+            'db.up': mocker.Mock(),
         }
         for name, ep in eps.items():
             ep.name = name
+        mock_add_nested_entrypoint = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_add_nested_entrypoint',
+            return_value=None,
+        )
+        errors = [
+            mocker.Mock(**{'load.side_effect': ImportError}),
+            mocker.Mock(**{'load.side_effect': pkg_resources.UnknownExtra}),
+            mocker.Mock(**{'load.side_effect': AttributeError}),
+        ]
+        for idx, ep in enumerate(errors):
+            ep.name = 'err%d' % idx
         ep_groups = {
-            'group1': [
-                mocker.Mock(**{'load.side_effect': ImportError}),
-                mocker.Mock(**{
-                    'load.side_effect': pkg_resources.UnknownExtra,
-                }),
-                mocker.Mock(**{'load.side_effect': AttributeError}),
+            'group1': errors + [
+                eps['db.up'],
                 eps['ep1'],
                 eps['ep2'],
             ],
@@ -406,7 +636,232 @@ class TestScriptAdaptor(object):
             mocker.call('ep2', 'adaptor2'),
             mocker.call('ep3', 'adaptor3'),
         ], any_order=True)
+        assert mock_add_subcommand.call_count == 3
+        mock_add_nested_entrypoint.assert_called_once_with(
+            'group1', eps['db.up'])
+        assert not eps['db.up'].load.called
         assert sa._entrypoints == set()
+        assert sa._loaded_groups == set(['group1', 'group2'])
+        loads = dict((load.name, load) for load in sa.get_plugin_loads())
+        assert sorted(loads) == ['ep1', 'ep2', 'ep3', 'err0', 'err1', 'err2']
+        assert loads['ep3'].group == 'group2'
+        assert loads['ep1'].error is None
+        assert loads['ep1'].seconds >= 0
+        assert loads['err0'].error.startswith('ImportError')
+        assert loads['err2'].error.startswith('AttributeError')
+
+    def make_entrypoint(self, mocker, tmpdir, **kwargs):
+        ep = mocker.Mock(
+            dist=mocker.Mock(egg_info=str(tmpdir.join('dist.egg-info')),
+                             __str__=lambda self: 'dist 1.0'),
+            __str__=lambda self: 'plugin = mod:func',
+            **kwargs
+        )
+        ep.name = 'plugin'
+        return ep
+
+    def test_load_entrypoint_quarantine(self, mocker, tmpdir):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._quarantine = cli_tools.ResultCache(str(tmpdir.join('cache')))
+        tmpdir.join('dist.egg-info').write('1.0')
+        ep = self.make_entrypoint(mocker, tmpdir, **{
+            'load.side_effect': ImportError('no module named mod'),
+        })
+
+        first = sa._load_entrypoint('group', ep)
+        second = sa._load_entrypoint('group', ep)
+
+        assert first.error == 'ImportError: no module named mod'
+        assert first.seconds >= 0
+        assert second == ('group', 'plugin', 'dist 1.0', None, first.error)
+        assert ep.load.call_count == 1
+
+        # Reinstalling the distribution releases the entrypoint
+        tmpdir.join('dist.egg-info').write('1.0.1')
+        ep.load.side_effect = None
+        ep.load.return_value = mocker.Mock(cli_tools='adaptor')
+        mock_add_subcommand = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_add_subcommand'
+        )
+
+        third = sa._load_entrypoint('group', ep)
+
+        assert third.error is None
+        mock_add_subcommand.assert_called_once_with('plugin', 'adaptor')
+
+    def test_load_entrypoint_quarantine_unwritable(self, mocker, tmpdir):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._quarantine = cli_tools.ResultCache(str(tmpdir.join('cache')))
+        mocker.patch.object(cli_tools.ResultCache, 'put', side_effect=OSError)
+        ep = self.make_entrypoint(mocker, tmpdir, **{
+            'load.side_effect': AttributeError('cli_tools'),
+        })
+
+        result = sa._load_entrypoint('group', ep)
+
+        assert result.error == 'AttributeError: cli_tools'
+
+    def test_load_entrypoint_no_quarantine(self, mocker, tmpdir):
+        mock_ResultCache = mocker.patch.object(cli_tools, 'ResultCache')
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        ep = self.make_entrypoint(mocker, tmpdir, **{
+            'load.side_effect': ImportError('no module named mod'),
+        })
+
+        sa._load_entrypoint('group', ep)
+        result = sa._load_entrypoint('group', ep)
+
+        assert result.seconds is not None
+        assert ep.load.call_count == 2
+        assert not mock_ResultCache.called
+
+    def test_add_nested_entrypoint(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        ep1 = mocker.Mock()
+        ep1.name = 'db.migrate.up'
+        ep2 = mocker.Mock()
+        ep2.name = 'db.migrate.down'
+        ep3 = mocker.Mock()
+        ep3.name = 'db.backup'
+
+        for ep in (ep1, ep2, ep3):
+            assert sa._add_nested_entrypoint('group', ep) is None
+
+        assert list(sa._subcommands.keys()) == ['db']
+        db = sa._subcommands['db']
+        assert isinstance(db, cli_tools.ScriptAdaptor)
+        assert db._func is cli_tools._subcommand_group
+        assert db.description is None
+        assert db._parent is sa
+        assert db.do_subs is True
+        assert sorted(db._subcommands.keys()) == ['backup', 'migrate']
+        migrate = db._subcommands['migrate']
+        assert isinstance(migrate, cli_tools.ScriptAdaptor)
+        assert migrate._parent is db
+        assert sorted(migrate._subcommands.keys()) == ['down', 'up']
+        for adaptor, name, ep in ((migrate, 'up', ep1),
+                                  (migrate, 'down', ep2),
+                                  (db, 'backup', ep3)):
+            placeholder = adaptor._subcommands[name]
+            assert isinstance(placeholder, cli_tools._LazySubcommand)
+            assert placeholder._name == name
+            assert placeholder._target._ep is ep
+            assert placeholder._target._owner is sa
+            assert placeholder._target._group == 'group'
+            assert placeholder._parent is adaptor
+        assert not ep1.load.called
+
+    def test_add_nested_entrypoint_existing(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        db = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._add_subcommand('db', db)
+        ep = mocker.Mock()
+        ep.name = 'db.up'
+
+        sa._add_nested_entrypoint('group', ep)
+
+        assert sa._subcommands['db'] is db
+        assert isinstance(db._subcommands['up'], cli_tools._LazySubcommand)
+
+    def test_add_nested_entrypoint_lazy(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        db = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa.lazy_subcommand('db', 'module:db')
+        mock_import_target = mocker.patch.object(
+            cli_tools, '_import_target',
+            return_value=mocker.Mock(cli_tools=db),
+        )
+        ep = mocker.Mock()
+        ep.name = 'db.up'
+
+        result = sa._add_nested_entrypoint('group', ep)
+
+        assert result is None
+        mock_import_target.assert_called_once_with('module:db')
+        assert sa._subcommands['db'] is db
+        assert isinstance(db._subcommands['up'], cli_tools._LazySubcommand)
+
+    def test_add_nested_entrypoint_lazy_broken(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa.lazy_subcommand('db', 'module:db')
+        mocker.patch.object(
+            cli_tools, '_import_target', side_effect=ImportError('gone'))
+        ep = mocker.Mock(dist='dist 1.0')
+        ep.name = 'db.up'
+
+        result = sa._add_nested_entrypoint('group', ep)
+
+        assert result[:3] == ('group', 'db.up', 'dist 1.0')
+        assert result.error == (
+            'cannot extend subcommand db: unable to load module:db: gone')
+        assert isinstance(sa._subcommands['db'], cli_tools._LazySubcommand)
+
+    def test_console_nested_entrypoints(self, mocker):
+        def up(steps=None):
+            return 'up %s' % steps
+        cli_tools.argument('--steps')(up)
+
+        mock_iter_entry_points = mocker.patch.object(
+            pkg_resources, 'iter_entry_points'
+        )
+        up_ep = mocker.Mock(**{'load.return_value': up})
+        up_ep.name = 'db.migrate.up'
+        down_ep = mocker.Mock()
+        down_ep.name = 'db.migrate.down'
+        other_ep = mocker.Mock()
+        other_ep.name = 'queue.purge'
+        mock_iter_entry_points.return_value = [up_ep, down_ep, other_ep]
+
+        @cli_tools.load_subcommands('group')
+        def main():
+            pass
+
+        result = main.console(argv=['db', 'migrate', 'up', '--steps', '2'])
+
+        assert result == 'up 2'
+        up_ep.load.assert_called_once_with()
+        assert not down_ep.load.called
+        assert not other_ep.load.called
+        loads = main.get_plugin_loads()
+        assert [(load.group, load.name, load.error) for load in loads] == [
+            ('group', 'db.migrate.up', None),
+        ]
+
+    def test_console_nested_entrypoint_broken(self, mocker, tmpdir):
+        tmpdir.join('dist.egg-info').write('1.0')
+        ep = self.make_entrypoint(mocker, tmpdir, **{
+            'load.side_effect': ImportError('no module named mod'),
+        })
+        ep.name = 'db.up'
+        mocker.patch.object(
+            pkg_resources, 'iter_entry_points', return_value=[ep])
+
+        def make_main():
+            @cli_tools.quarantine_plugins(str(tmpdir.join('cache')))
+            @cli_tools.load_subcommands('group')
+            def main():
+                pass
+            return main
+
+        main = make_main()
+        with pytest.raises(SystemExit):
+            main.console(argv=['db', 'up'])
+
+        loads = main.get_plugin_loads()
+        assert len(loads) == 1
+        assert loads[0][:3] == ('group', 'db.up', 'dist 1.0')
+        assert loads[0].seconds >= 0
+        assert loads[0].error == 'ImportError: no module named mod'
+
+        # The next run skips the quarantined entrypoint
+        main = make_main()
+        with pytest.raises(SystemExit):
+            main.console(argv=['db', 'up'])
+
+        assert ep.load.call_count == 1
+        assert main.get_plugin_loads() == [
+            ('group', 'db.up', 'dist 1.0', None, loads[0].error),
+        ]
 
     def test_args_hook(self, mocker):
         func = mocker.Mock(__doc__='')
@@ -487,6 +942,130 @@ class TestScriptAdaptor(object):
         mock_get_adaptor.assert_called_once_with(subcmd)
         mock_add_subcommand.assert_called_once_with('subcmd', 'adaptor')
 
+    def test_add_arguments(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._add_argument((0, 1, 2), dict(a=3), None)
+        sa._add_argument((9, 0, 1), dict(a=2), 'group')
+        group_kwargs = dict(a=5, group='group')
+
+        sa.add_arguments([
+            ((1, 2, 3), dict(a=4)),
+            ((2, 3, 4), group_kwargs),
+            ((3, 4, 5), dict(a=6, group=None)),
+            ((4, 5, 6), dict(a=7, group='other')),
+            ((5, 6, 7), dict(a=8, group='group')),
+        ])
+
+        assert sa._arguments == [
+            ('argument', (1, 2, 3), dict(a=4)),
+            ('argument', (3, 4, 5), dict(a=6)),
+            ('argument', (0, 1, 2), dict(a=3)),
+        ]
+        assert sa._groups == {
+            'group': (None, [
+                ((2, 3, 4), dict(a=5)),
+                ((5, 6, 7), dict(a=8)),
+                ((9, 0, 1), dict(a=2)),
+            ]),
+            'other': (None, [
+                ((4, 5, 6), dict(a=7)),
+            ]),
+        }
+        assert isinstance(sa._arguments[0], cli_tools._Spec)
+        assert isinstance(sa._groups['group'].arguments[0],
+                          cli_tools._ArgSpec)
+        assert group_kwargs == dict(a=5, group='group')
+
+    def test_add_arguments_decorators(self, mocker):
+        @cli_tools.argument(1, a=1)
+        @cli_tools.argument(2, a=2, group='group')
+        @cli_tools.argument(3, a=3)
+        def func1():
+            pass
+
+        def func2():
+            pass
+        cli_tools.ScriptAdaptor._get_adaptor(func2).add_arguments([
+            ((1,), dict(a=1)),
+            ((2,), dict(a=2, group='group')),
+            ((3,), dict(a=3)),
+        ])
+
+        assert func1.cli_tools._arguments == func2.cli_tools._arguments
+        assert func1.cli_tools._groups == func2.cli_tools._groups
+
+    def test_add_groups(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._add_group('old', 'group', dict(a=1))
+        sa._add_argument((1, 2, 3), dict(a=4), 'group2')
+
+        sa.add_groups(iter([
+            ('group1', 'group', dict(a=2)),
+            ('group2', 'exclusive', dict(a=3)),
+        ]))
+
+        assert sa._arguments == [
+            ('group', 'group1', dict(a=2)),
+            ('group', 'group2', dict(a=3)),
+            ('group', 'old', dict(a=1)),
+        ]
+        assert sa._groups == {
+            'old': ('group', []),
+            'group1': ('group', []),
+            'group2': ('exclusive', [((1, 2, 3), dict(a=4))]),
+        }
+
+    def test_add_groups_oldgroup(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._add_group('old', 'group', dict(a=1))
+
+        with pytest.raises(argparse.ArgumentError):
+            sa.add_groups([
+                ('group1', 'group', dict(a=2)),
+                ('old', 'exclusive', dict(a=3)),
+            ])
+        assert sa._arguments == [('group', 'old', dict(a=1))]
+        assert list(sa._groups.keys()) == ['old']
+
+    def test_add_groups_duplicate(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+
+        with pytest.raises(argparse.ArgumentError):
+            sa.add_groups([
+                ('group1', 'group', dict(a=2)),
+                ('group1', 'exclusive', dict(a=3)),
+            ])
+        assert sa._arguments == []
+        assert sa._groups == {}
+
+    def test_add_subcommands(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor',
+            side_effect=lambda func: 'adaptor_%s' % func,
+        )
+        mock_add_subcommand = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_add_subcommand'
+        )
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        sa.add_subcommands({'cmd': 'func1'})
+        sa.add_subcommands([('dmc', 'func2'), ('mdc', 'func3')])
+
+        mock_get_adaptor.assert_has_calls([
+            mocker.call('func1'),
+            mocker.call('func2'),
+            mocker.call('func3'),
+        ])
+        mock_add_subcommand.assert_has_calls([
+            mocker.call('cmd', 'adaptor_func1'),
+            mocker.call('dmc', 'adaptor_func2'),
+            mocker.call('mdc', 'adaptor_func3'),
+        ])
+
     def test_setup_args(self, mocker):
         mock_process_entrypoints = mocker.patch.object(
             cli_tools.ScriptAdaptor, '_process_entrypoints'
@@ -497,27 +1076,18 @@ class TestScriptAdaptor(object):
         func = mocker.Mock(__doc__='')
         sa = cli_tools.ScriptAdaptor(func, False)
         sa._groups = {
-            'group_key': {
-                'type': 'group',
-                'arguments': [
-                    ((1, 2, 3), dict(a=4, b=5, c=6)),
-                    ((2, 3, 4), dict(a=5, b=6, c=7)),
-                ],
-            },
-            'exclusive_key': {
-                'type': 'exclusive',
-                'arguments': [
-                    ((3, 4, 5), dict(a=6, b=7, c=8)),
-                    ((4, 5, 6), dict(a=7, b=8, c=9)),
-                ],
-            },
-            'other_key': {
-                'type': 'other',
-                'arguments': [
-                    ((5, 6, 7), dict(a=8, b=9, c=0)),
-                    ((6, 7, 8), dict(a=9, b=0, c=1)),
-                ],
-            },
+            'group_key': cli_tools._GroupSpec('group', [
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+            ]),
+            'exclusive_key': cli_tools._GroupSpec('exclusive', [
+                ((3, 4, 5), dict(a=6, b=7, c=8)),
+                ((4, 5, 6), dict(a=7, b=8, c=9)),
+            ]),
+            'other_key': cli_tools._GroupSpec('other', [
+                ((5, 6, 7), dict(a=8, b=9, c=0)),
+                ((6, 7, 8), dict(a=9, b=0, c=1)),
+            ]),
         }
         sa._arguments = [
             ('argument', (7, 8, 9), dict(a=0, b=1, c=2)),
@@ -565,27 +1135,18 @@ class TestScriptAdaptor(object):
         sa = cli_tools.ScriptAdaptor(func, False)
         sa._args_hook = mocker.Mock(side_effect=hook)
         sa._groups = {
-            'group_key': {
-                'type': 'group',
-                'arguments': [
-                    ((1, 2, 3), dict(a=4, b=5, c=6)),
-                    ((2, 3, 4), dict(a=5, b=6, c=7)),
-                ],
-            },
-            'exclusive_key': {
-                'type': 'exclusive',
-                'arguments': [
-                    ((3, 4, 5), dict(a=6, b=7, c=8)),
-                    ((4, 5, 6), dict(a=7, b=8, c=9)),
-                ],
-            },
-            'other_key': {
-                'type': 'other',
-                'arguments': [
-                    ((5, 6, 7), dict(a=8, b=9, c=0)),
-                    ((6, 7, 8), dict(a=9, b=0, c=1)),
-                ],
-            },
+            'group_key': cli_tools._GroupSpec('group', [
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+            ]),
+            'exclusive_key': cli_tools._GroupSpec('exclusive', [
+                ((3, 4, 5), dict(a=6, b=7, c=8)),
+                ((4, 5, 6), dict(a=7, b=8, c=9)),
+            ]),
+            'other_key': cli_tools._GroupSpec('other', [
+                ((5, 6, 7), dict(a=8, b=9, c=0)),
+                ((6, 7, 8), dict(a=9, b=0, c=1)),
+            ]),
         }
         sa._arguments = [
             ('argument', (7, 8, 9), dict(a=0, b=1, c=2)),
@@ -637,27 +1198,18 @@ class TestScriptAdaptor(object):
         sa = cli_tools.ScriptAdaptor(func, False)
         sa._args_hook = MockGenFunc(gen)
         sa._groups = {
-            'group_key': {
-                'type': 'group',
-                'arguments': [
-                    ((1, 2, 3), dict(a=4, b=5, c=6)),
-                    ((2, 3, 4), dict(a=5, b=6, c=7)),
-                ],
-            },
-            'exclusive_key': {
-                'type': 'exclusive',
-                'arguments': [
-                    ((3, 4, 5), dict(a=6, b=7, c=8)),
-                    ((4, 5, 6), dict(a=7, b=8, c=9)),
-                ],
-            },
-            'other_key': {
-                'type': 'other',
-                'arguments': [
-                    ((5, 6, 7), dict(a=8, b=9, c=0)),
-                    ((6, 7, 8), dict(a=9, b=0, c=1)),
-                ],
-            },
+            'group_key': cli_tools._GroupSpec('group', [
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+            ]),
+            'exclusive_key': cli_tools._GroupSpec('exclusive', [
+                ((3, 4, 5), dict(a=6, b=7, c=8)),
+                ((4, 5, 6), dict(a=7, b=8, c=9)),
+            ]),
+            'other_key': cli_tools._GroupSpec('other', [
+                ((5, 6, 7), dict(a=8, b=9, c=0)),
+                ((6, 7, 8), dict(a=9, b=0, c=1)),
+            ]),
         }
         sa._arguments = [
             ('argument', (7, 8, 9), dict(a=0, b=1, c=2)),
@@ -720,27 +1272,18 @@ class TestScriptAdaptor(object):
         sa = cli_tools.ScriptAdaptor(func, False)
         sa._args_hook = MockGenFunc(gen)
         sa._groups = {
-            'group_key': {
-                'type': 'group',
-                'arguments': [
-                    ((1, 2, 3), dict(a=4, b=5, c=6)),
-                    ((2, 3, 4), dict(a=5, b=6, c=7)),
-                ],
-            },
-            'exclusive_key': {
-                'type': 'exclusive',
-                'arguments': [
-                    ((3, 4, 5), dict(a=6, b=7, c=8)),
-                    ((4, 5, 6), dict(a=7, b=8, c=9)),
-                ],
-            },
-            'other_key': {
-                'type': 'other',
-                'arguments': [
-                    ((5, 6, 7), dict(a=8, b=9, c=0)),
-                    ((6, 7, 8), dict(a=9, b=0, c=1)),
-                ],
-            },
+            'group_key': cli_tools._GroupSpec('group', [
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+            ]),
+            'exclusive_key': cli_tools._GroupSpec('exclusive', [
+                ((3, 4, 5), dict(a=6, b=7, c=8)),
+                ((4, 5, 6), dict(a=7, b=8, c=9)),
+            ]),
+            'other_key': cli_tools._GroupSpec('other', [
+                ((5, 6, 7), dict(a=8, b=9, c=0)),
+                ((6, 7, 8), dict(a=9, b=0, c=1)),
+            ]),
         }
         sa._arguments = [
             ('argument', (7, 8, 9), dict(a=0, b=1, c=2)),
@@ -803,27 +1346,18 @@ class TestScriptAdaptor(object):
         sa = cli_tools.ScriptAdaptor(func, False)
         sa._args_hook = MockGenFunc(gen)
         sa._groups = {
-            'group_key': {
-                'type': 'group',
-                'arguments': [
-                    ((1, 2, 3), dict(a=4, b=5, c=6)),
-                    ((2, 3, 4), dict(a=5, b=6, c=7)),
-                ],
-            },
-            'exclusive_key': {
-                'type': 'exclusive',
-                'arguments': [
-                    ((3, 4, 5), dict(a=6, b=7, c=8)),
-                    ((4, 5, 6), dict(a=7, b=8, c=9)),
-                ],
-            },
-            'other_key': {
-                'type': 'other',
-                'arguments': [
-                    ((5, 6, 7), dict(a=8, b=9, c=0)),
-                    ((6, 7, 8), dict(a=9, b=0, c=1)),
-                ],
-            },
+            'group_key': cli_tools._GroupSpec('group', [
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+            ]),
+            'exclusive_key': cli_tools._GroupSpec('exclusive', [
+                ((3, 4, 5), dict(a=6, b=7, c=8)),
+                ((4, 5, 6), dict(a=7, b=8, c=9)),
+            ]),
+            'other_key': cli_tools._GroupSpec('other', [
+                ((5, 6, 7), dict(a=8, b=9, c=0)),
+                ((6, 7, 8), dict(a=9, b=0, c=1)),
+            ]),
         }
         sa._arguments = [
             ('argument', (7, 8, 9), dict(a=0, b=1, c=2)),
@@ -881,27 +1415,18 @@ class TestScriptAdaptor(object):
         func = mocker.Mock(__doc__='')
         sa = cli_tools.ScriptAdaptor(func, False)
         sa._groups = {
-            'group_key': {
-                'type': 'group',
-                'arguments': [
-                    ((1, 2, 3), dict(a=4, b=5, c=6)),
-                    ((2, 3, 4), dict(a=5, b=6, c=7)),
-                ],
-            },
-            'exclusive_key': {
-                'type': 'exclusive',
-                'arguments': [
-                    ((3, 4, 5), dict(a=6, b=7, c=8)),
-                    ((4, 5, 6), dict(a=7, b=8, c=9)),
-                ],
-            },
-            'other_key': {
-                'type': 'other',
-                'arguments': [
-                    ((5, 6, 7), dict(a=8, b=9, c=0)),
-                    ((6, 7, 8), dict(a=9, b=0, c=1)),
-                ],
-            },
+            'group_key': cli_tools._GroupSpec('group', [
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+            ]),
+            'exclusive_key': cli_tools._GroupSpec('exclusive', [
+                ((3, 4, 5), dict(a=6, b=7, c=8)),
+                ((4, 5, 6), dict(a=7, b=8, c=9)),
+            ]),
+            'other_key': cli_tools._GroupSpec('other', [
+                ((5, 6, 7), dict(a=8, b=9, c=0)),
+                ((6, 7, 8), dict(a=9, b=0, c=1)),
+            ]),
         }
         sa._arguments = [
             ('argument', (7, 8, 9), dict(a=0, b=1, c=2)),
@@ -951,7 +1476,8 @@ class TestScriptAdaptor(object):
             mocker.call.add_mutually_exclusive_group()
             .add_argument(4, 5, 6, a=7, b=8, c=9),
             mocker.call.add_argument(0, 1, 2, a=3, b=4, c=5),
-            mocker.call.add_subparsers(a=1, b=2, c=3),
+            mocker.call.add_subparsers(
+                action=cli_tools._LazySubParsersAction, a=1, b=2, c=3),
             mocker.call.add_subparsers().add_parser(
                 'cmd',
                 prog='cmd_prog',
@@ -960,6 +1486,7 @@ class TestScriptAdaptor(object):
                 epilog='cmd_epilog',
                 formatter_class='cmd_formatter_class',
             ),
+            mocker.call.add_subparsers().bind(cmd_parser, cmd_adaptor),
             mocker.call.add_subparsers().add_parser(
                 'dmc',
                 prog='dmc_prog',
@@ -968,17 +1495,85 @@ class TestScriptAdaptor(object):
                 epilog='dmc_epilog',
                 formatter_class='dmc_formatter_class',
             ),
+            mocker.call.add_subparsers().bind(dmc_parser, dmc_adaptor),
         ])
-        cmd_adaptor.setup_args.assert_called_once_with(cmd_parser)
-        dmc_adaptor.setup_args.assert_called_once_with(dmc_parser)
-        cmd_parser.set_defaults.assert_called_once_with(**{
-            sa._subcmd_attr: cmd_adaptor,
-        })
-        dmc_parser.set_defaults.assert_called_once_with(**{
-            sa._subcmd_attr: dmc_adaptor,
-        })
+        assert not cmd_adaptor.setup_args.called
+        assert not dmc_adaptor.setup_args.called
         mock_process_entrypoints.assert_called_once_with()
 
+    def test_setup_args_options(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(inspect, 'isgenerator', return_value=False)
+        parser = mocker.Mock()
+        sa1 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa2 = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa1._add_subcommand('sa2', sa2)
+        sa1._option_sets = {
+            'common': [
+                ((1, 2, 3), dict(a=4, b=5, c=6)),
+                ((2, 3, 4), dict(a=5, b=6, c=7)),
+            ],
+        }
+        sa2._arguments = [
+            ('argument', (7, 8, 9), dict(a=0, b=1, c=2)),
+            ('options', 'common', {}),
+            ('options', 'common', dict(title='title')),
+        ]
+
+        sa2.setup_args(parser)
+
+        parser.assert_has_calls([
+            mocker.call.add_argument(7, 8, 9, a=0, b=1, c=2),
+            mocker.call.add_argument(1, 2, 3, a=4, b=5, c=6),
+            mocker.call.add_argument(2, 3, 4, a=5, b=6, c=7),
+            mocker.call.add_argument_group(title='title'),
+            mocker.call.add_argument_group()
+            .add_argument(1, 2, 3, a=4, b=5, c=6),
+            mocker.call.add_argument_group()
+            .add_argument(2, 3, 4, a=5, b=6, c=7),
+        ])
+
+    def test_setup_args_lazy(self, mocker):
+        def cmd(debug, region):
+            return 'cmd'
+
+        def dmc(debug):
+            return 'dmc'
+
+        mock_cmd_setup = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'setup_args',
+            side_effect=cli_tools.ScriptAdaptor.setup_args,
+            autospec=True,
+        )
+        parser = argparse.ArgumentParser()
+        sa = cli_tools.ScriptAdaptor(lambda: None, False)
+        sa._add_option('common', ('--region',), dict(default='us'))
+        sa._add_option('common', ('--debug',), dict(action='store_true'))
+        cmd_sa = cli_tools.ScriptAdaptor._get_adaptor(cmd)
+        cmd_sa._use_options('common', {})
+        dmc_sa = cli_tools.ScriptAdaptor._get_adaptor(dmc)
+        dmc_sa._use_options('common', {})
+        sa._add_subcommand('cmd', cmd_sa)
+        sa._add_subcommand('dmc', dmc_sa)
+
+        sa.setup_args(parser)
+
+        mock_cmd_setup.assert_called_once_with(sa, parser)
+
+        args = parser.parse_args(['cmd', '--debug', '--region', 'eu'])
+
+        assert args.debug is True
+        assert args.region == 'eu'
+        assert sa._select(args) is cmd_sa
+        assert mock_cmd_setup.call_count == 2
+        mock_cmd_setup.assert_called_with(cmd_sa, mocker.ANY)
+
+        args = parser.parse_args(['cmd'])
+
+        assert args.debug is False
+        assert args.region == 'us'
+        assert mock_cmd_setup.call_count == 2
+
     def test_get_kwargs(self, mocker):
         mock_isclass = mocker.patch.object(
             inspect, 'isclass', return_value=False
@@ -1150,6 +1745,23 @@ class TestScriptAdaptor(object):
         mock_getargspec.assert_called_once_with(func2)
         mock_ismethod.assert_called_once_with(func2)
 
+    def test_get_kwargs_extra_path(self, mocker):
+        mocker.patch.object(inspect, 'isclass', return_value=False)
+        mocker.patch.object(inspect, 'ismethod', return_value=False)
+        mocker.patch.object(
+            inspect, 'getargspec',
+            return_value=inspect.ArgSpec(('a',), None, 'kwargs', None)
+        )
+        func1 = mocker.Mock(__doc__='')
+        func2 = mocker.Mock()
+        sa = cli_tools.ScriptAdaptor(func1, False)
+        args = argparse.Namespace(a=1, d=4)
+        setattr(args, cli_tools._path_attr, collections.deque())
+
+        result = sa.get_kwargs(func2, args)
+
+        assert result == dict(a=1, d=4)
+
     def test_get_kwargs_required(self, mocker):
         mock_isclass = mocker.patch.object(
             inspect, 'isclass', return_value=False
@@ -1448,17 +2060,19 @@ class TestScriptAdaptor(object):
         func.assert_called_once_with(a=1, b=2, c=3)
 
     def test_safe_call_proc_gen_post_exc_replace(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=True)
+        mock_get_kwargs = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs',
+            return_value=dict(a=1, b=2, c=3)
+        )
+        # Patched last, so it's restored first: stopping the other
+        # patches calls sys.exc_info(), which would exhaust the values
         mocker.patch(
             'sys.exc_info', side_effect=[
                 ('type', 'exception', 'tb'),
                 ('otype', 'something', 'bt'),
             ]
         )
-        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=True)
-        mock_get_kwargs = mocker.patch.object(
-            cli_tools.ScriptAdaptor, 'get_kwargs',
-            return_value=dict(a=1, b=2, c=3)
-        )
         func = mocker.Mock(__doc__='', side_effect=ExceptionForTest)
         gen = mocker.Mock(**{
             'throw.side_effect': ExceptionForTest(),
@@ -1557,7 +2171,9 @@ class TestScriptAdaptor(object):
         sa = cli_tools.ScriptAdaptor(func, False)
         sa.do_subs = True
         adaptor = mocker.Mock(**{'safe_call.return_value': ('tluser', None)})
-        args = mocker.Mock(**{sa._subcmd_attr: adaptor})
+        args = argparse.Namespace(**{
+            cli_tools._path_attr: collections.deque([mocker.Mock(), adaptor]),
+        })
 
         result = sa.console(args=args)
 
@@ -1567,50 +2183,3578 @@ class TestScriptAdaptor(object):
         adaptor.safe_call.assert_called_once_with(args)
         assert result == 'tluser'
 
-    def test_get_subcommands_nosubs(self, mocker):
-        mock_process_entrypoints = mocker.patch.object(
-            cli_tools.ScriptAdaptor, '_process_entrypoints'
+    def test_console_low_memory(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args', return_value='parsed args'
         )
-        func = mocker.Mock(__doc__='')
-        sa = cli_tools.ScriptAdaptor(func, False)
-        sa._subcommands = mocker.Mock(**{'items.return_value': [
-            ('cmd', mocker.Mock(_func='subcmd')),
-            ('dmc', mocker.Mock(_func='subdmc')),
-        ]})
+        mock_release = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_release'
+        )
+        mock_safe_call = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call', return_value=('result', None)
+        )
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._low_memory = False
 
-        result = sa.get_subcommands()
+        result = sa.console(argv='argument vector')
 
-        assert result == {}
-        assert not mock_process_entrypoints.called
+        mock_release.assert_called_once_with('parsed args')
+        mock_safe_call.assert_called_once_with('parsed args')
+        assert result == 'result'
 
-    def test_get_subcommands(self, mocker):
-        mock_process_entrypoints = mocker.patch.object(
-            cli_tools.ScriptAdaptor, '_process_entrypoints'
-        )
-        func = mocker.Mock(__doc__='')
-        sa = cli_tools.ScriptAdaptor(func, False)
-        sa._subcommands = mocker.Mock(**{'items.return_value': [
-            ('cmd', mocker.Mock(_func='subcmd')),
-            ('dmc', mocker.Mock(_func='subdmc')),
-        ]})
-        sa.do_subs = True
+    def make_tree(self):
+        @cli_tools.argument('--debug', action='store_true')
+        def main():
+            pass
 
-        result = sa.get_subcommands()
+        @main.subcommand
+        @cli_tools.argument('--steps')
+        def db():
+            pass
 
-        assert result == dict(cmd='subcmd', dmc='subdmc')
-        mock_process_entrypoints.assert_called_once_with()
+        @db.subcommand
+        def up():
+            pass
 
+        @db.subcommand
+        def down():
+            pass
 
-class TestDecorators(object):
-    def test_console(self, mocker):
-        mock_get_adaptor = mocker.patch.object(
-            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
-        )
-        func = mocker.Mock()
-        result = cli_tools.console(func)
+        @main.subcommand
+        def serve():
+            pass
 
-        mock_get_adaptor.assert_called_once_with(func)
-        assert result == func
+        return [f.cli_tools for f in (main, db, up, down, serve)]
+
+    def test_release(self, mocker):
+        mock_collect = mocker.patch.object(cli_tools.gc, 'collect')
+        mock_freeze = mocker.patch.object(cli_tools.gc, 'freeze', create=True)
+        main, db, up, down, serve = self.make_tree()
+        main._low_memory = True
+        args = argparse.Namespace(**{
+            cli_tools._path_attr: collections.deque([db, up]),
+        })
+
+        main._release(args)
+
+        assert main._subcommands == {'db': db}
+        assert db._subcommands == {'up': up}
+        assert up._subcommands == {}
+        assert main._arguments == [] and db._arguments == []
+        assert down._parent is db and serve._subcommands == {}
+        mock_collect.assert_called_once_with()
+        mock_freeze.assert_called_once_with()
+
+    def test_release_subtree(self, mocker):
+        mocker.patch.object(cli_tools.gc, 'collect')
+        main, db, up, down, serve = self.make_tree()
+        db._low_memory = False
+        args = argparse.Namespace(**{
+            cli_tools._path_attr: collections.deque([up]),
+        })
+
+        db._release(args)
+
+        assert db._subcommands == {'up': up}
+        assert db._arguments == []
+        assert sorted(main._subcommands) == ['db', 'serve']
+        assert main._arguments != []
+
+    def test_release_no_freeze(self, mocker):
+        mock_collect = mocker.patch.object(cli_tools.gc, 'collect')
+        mock_freeze = mocker.patch.object(cli_tools.gc, 'freeze', create=True)
+        main, db, up, down, serve = self.make_tree()
+        main._low_memory = False
+
+        main._release(argparse.Namespace())
+
+        assert main._subcommands == {}
+        assert main._arguments == []
+        assert db._subcommands == {'up': up, 'down': down}
+        mock_collect.assert_called_once_with()
+        assert not mock_freeze.called
+
+    def test_console_release(self, mocker):
+        mocker.patch.object(cli_tools.gc, 'collect')
+        main, db, up, down, serve = self.make_tree()
+        main._low_memory = False
+        mock_safe_call = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call', return_value=('result', None)
+        )
+
+        result = main.console(argv=['--debug', 'db', 'down'])
+
+        assert result == 'result'
+        assert main._subcommands == {'db': db}
+        assert db._subcommands == {'down': down}
+        args = mock_safe_call.call_args[0][0]
+        assert args.debug is True
+        assert list(getattr(args, cli_tools._path_attr)) == [db, down]
+
+    def test_select_nosubs(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        args = argparse.Namespace(**{
+            cli_tools._path_attr: collections.deque(['adaptor']),
+        })
+
+        assert sa._select(args) is sa
+
+    def test_select_nopath(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa.do_subs = True
+
+        assert sa._select(argparse.Namespace()) is sa
+
+    def test_select_path(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa.do_subs = True
+        args = argparse.Namespace(**{
+            cli_tools._path_attr: collections.deque(['outer', 'inner']),
+        })
+
+        assert sa._select(args) == 'inner'
+
+    def test_console_deep(self):
+        @cli_tools.console
+        def main():
+            return 'main'
+
+        @main.subcommand
+        def a():
+            return 'a'
+
+        @a.subcommand
+        def b():
+            return 'b'
+
+        @b.subcommand
+        @cli_tools.argument('--x')
+        def c(x):
+            return 'c %s' % x
+
+        assert main.console(argv=['a', 'b', 'c', '--x', '1']) == 'c 1'
+
+    def test_console_custom_action(self, tmpdir, monkeypatch):
+        class CustomAction(argparse._SubParsersAction):
+            pass
+
+        tmpdir.join('custom_action_mod.py').write(
+            'import cli_tools\n'
+            '\n'
+            '@cli_tools.argument("--y")\n'
+            'def d(y):\n'
+            '    return "d %s" % y\n'
+        )
+        monkeypatch.syspath_prepend(str(tmpdir))
+
+        @cli_tools.console
+        @cli_tools.subparsers(action=CustomAction)
+        def main():
+            return 'main'
+
+        @main.subcommand
+        @cli_tools.argument('--x')
+        def a(x):
+            return 'a %s' % x
+
+        @main.subcommand
+        @cli_tools.subparsers(action=CustomAction)
+        def b():
+            return 'b'
+        b.lazy_subcommand('e', 'custom_action_mod:d')
+
+        @main.subcommand
+        def c():
+            return 'c'
+        c.lazy_subcommand('d', 'custom_action_mod:d')
+
+        parser = main.cli_tools._make_parser()
+
+        # Subcommands are set up eagerly by the custom action
+        action = parser._subparsers._group_actions[0]
+        assert type(action) is CustomAction
+        assert '--x' in action.choices['a']._option_string_actions
+        assert main.console(argv=['a', '--x', '1']) == 'a 1'
+        assert main.console(argv=['b', 'e', '--y', '1']) == 'd 1'
+        assert main.console(argv=['c', 'd', '--y', '2']) == 'd 2'
+        assert main.console(argv=['c', 'd', '--y', '3']) == 'd 3'
+        assert main.console(argv=['a', '--x', '4']) == 'a 4'
+
+    def test_get_subcommands_nosubs(self, mocker):
+        mock_process_entrypoints = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_process_entrypoints'
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._subcommands = mocker.Mock(**{'items.return_value': [
+            ('cmd', mocker.Mock(_func='subcmd')),
+            ('dmc', mocker.Mock(_func='subdmc')),
+        ]})
+
+        result = sa.get_subcommands()
+
+        assert result == {}
+        assert not mock_process_entrypoints.called
+
+    def test_get_subcommands(self, mocker):
+        mock_process_entrypoints = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_process_entrypoints'
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._subcommands = mocker.Mock(**{'items.return_value': [
+            ('cmd', mocker.Mock(_func='subcmd')),
+            ('dmc', mocker.Mock(_func='subdmc')),
+        ]})
+        sa.do_subs = True
+
+        result = sa.get_subcommands()
+
+        assert result == dict(cmd='subcmd', dmc='subdmc')
+        mock_process_entrypoints.assert_called_once_with()
+
+    def test_get_subcommands_lazy(self, mocker):
+        mocker.patch.object(cli_tools.ScriptAdaptor, '_process_entrypoints')
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        adaptor = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa.lazy_subcommand('cmd', 'module:func')
+        mock_load = mocker.patch.object(
+            cli_tools._LazySubcommand, 'load',
+            side_effect=lambda: sa._add_subcommand('cmd', adaptor),
+        )
+
+        result = sa.get_subcommands()
+
+        assert result == dict(cmd=adaptor._func)
+        mock_load.assert_called_once_with()
+
+    def test_get_subcommands_lazy_broken(self, tmpdir, mocker):
+        tmpdir.join('lazy_ok_mod.py').write(
+            'def good():\n'
+            '    return "good"\n'
+        )
+        mocker.patch.object(sys, 'path', [str(tmpdir)] + sys.path)
+        mocker.patch.dict(sys.modules)
+        mocker.patch.object(cli_tools.ScriptAdaptor, '_process_entrypoints')
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa.lazy_subcommand('good', 'lazy_ok_mod:good')
+        sa.lazy_subcommand('bad', 'lazy_missing_mod:bad')
+
+        result = sa.get_subcommands()
+
+        assert list(result) == ['good']
+        placeholder = sa._subcommands['bad']
+        assert isinstance(placeholder, cli_tools._LazySubcommand)
+        assert placeholder.error.split(':')[0] in (
+            'ImportError', 'ModuleNotFoundError')
+        assert 'lazy_missing_mod' in placeholder.error
+
+        # The error is reported when the subcommand is selected
+        with pytest.raises(SystemExit):
+            sa._make_parser().parse_args(['bad'])
+        assert sa._make_parser().parse_args(['good']) is not None
+
+    def make_bundle_tree(self, tmpdir, mocker):
+        tmpdir.join('bundle_tool', '__init__.py').write('', ensure=True)
+        tmpdir.join('bundle_tool', 'cli.py').write(
+            'import cli_tools\n'
+            '\n'
+            '@cli_tools.load_subcommands("bundle.commands")\n'
+            'def main():\n'
+            '    pass\n'
+        )
+        tmpdir.join('bundle_plugin.py').write(
+            'import sys\n'
+            'import cli_tools\n'
+            '\n'
+            '@cli_tools.argument("--n", type=int)\n'
+            'def plug(n):\n'
+            '    sys.stdout.write("plug %d %s\\n" % (\n'
+            '        n, "pkg_resources" in sys.modules))\n'
+        )
+        mocker.patch.object(sys, 'path', [str(tmpdir)] + sys.path)
+        mocker.patch.dict(sys.modules)
+        eps = []
+        for name, module, attrs in [('plug', 'bundle_plugin', ['plug']),
+                                    ('broken', 'bundle_missing', [])]:
+            ep = mocker.Mock(module_name=module, attrs=attrs, dist='dist 1.0')
+            ep.name = name
+            eps.append(ep)
+        mocker.patch.object(pkg_resources, 'iter_entry_points',
+                            return_value=eps)
+
+        return importlib.import_module('bundle_tool.cli').main
+
+    def test_bundle(self, tmpdir, mocker):
+        main = self.make_bundle_tree(tmpdir, mocker)
+        path = str(tmpdir.join('tool.pyz'))
+
+        main.bundle(path, interpreter='/usr/bin/env python')
+
+        with open(path, 'rb') as f:
+            assert f.readline() == b'#!/usr/bin/env python\n'
+        assert os.stat(path).st_mode & 0o777 == 0o755
+        names = zipfile.ZipFile(path).namelist()
+        assert sorted(names) == [
+            '__main__.py',
+            'bundle_plugin.py', 'bundle_plugin.pyc',
+            'bundle_tool/__init__.py', 'bundle_tool/__init__.pyc',
+            'bundle_tool/cli.py', 'bundle_tool/cli.pyc',
+            'cli_tools.py', 'cli_tools.pyc', 'six.py', 'six.pyc',
+        ]
+
+        # The bundle runs on its own
+        output = subprocess.check_output(
+            [sys.executable, '-S', path, 'plug', '--n', '3'])
+        assert output == b'plug 3 False\n'
+
+    def test_bundle_loaded(self, tmpdir, mocker):
+        main = self.make_bundle_tree(tmpdir, mocker)
+        main.get_subcommands()
+        path = str(tmpdir.join('tool.pyz'))
+
+        main.bundle(path, compiled=False)
+
+        with open(path, 'rb') as f:
+            assert f.read(2) == b'PK'
+        assert os.stat(path).st_mode & 0o777 == 0o644
+        archive = zipfile.ZipFile(path)
+        assert 'bundle_plugin.pyc' not in archive.namelist()
+        main_source = archive.read('__main__.py').decode('ascii')
+        assert "'bundle_tool.cli:main'" in main_source
+        assert "'bundle_plugin:plug'" in main_source
+        assert "'bundle_missing'" in main_source
+
+    def test_bundle_bad_module(self, tmpdir, mocker):
+        main = self.make_bundle_tree(tmpdir, mocker)
+
+        with pytest.raises(ValueError):
+            main.bundle(str(tmpdir.join('tool.pyz')), modules=['no_such'])
+
+        assert not tmpdir.join('tool.pyz').exists()
+
+    def test_bundle_main(self, mocker):
+        sa = cli_tools.ScriptAdaptor(
+            mocker.Mock(__doc__='', __module__='__main__'), False)
+
+        with pytest.raises(ValueError):
+            sa.bundle('tool.pyz')
+
+    def test_lazy_subcommand(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        sa.lazy_subcommand('cmd', 'module:func', help='Do a thing.')
+
+        placeholder = sa._subcommands['cmd']
+        assert isinstance(placeholder, cli_tools._LazySubcommand)
+        assert placeholder._name == 'cmd'
+        assert placeholder._target == 'module:func'
+        assert placeholder._parent is sa
+        assert placeholder.description == 'Do a thing.'
+        assert sa.do_subs is True
+
+    def test_console_lazy(self, tmpdir, monkeypatch):
+        tmpdir.join('lazy_cmd_mod.py').write(
+            'import cli_tools\n'
+            '\n'
+            '@cli_tools.argument("--x")\n'
+            'def cmd(x):\n'
+            '    "Run cmd."\n'
+            '    return "cmd %s" % x\n'
+        )
+        tmpdir.join('lazy_dmc_mod.py').write('raise ImportError("dmc")\n')
+        monkeypatch.syspath_prepend(str(tmpdir))
+
+        @cli_tools.console
+        def main():
+            pass
+        main.lazy_subcommand('cmd', 'lazy_cmd_mod:cmd')
+        main.lazy_subcommand('dmc', 'lazy_dmc_mod:dmc')
+
+        try:
+            result = main.console(argv=['cmd', '--x', '1'])
+
+            assert result == 'cmd 1'
+            assert 'lazy_dmc_mod' not in sys.modules
+            cmd = sys.modules['lazy_cmd_mod'].cmd
+            assert main.cli_tools._subcommands['cmd'] is cmd.cli_tools
+            assert cmd.cli_tools._parent is main.cli_tools
+            with pytest.raises(SystemExit):
+                main.console(argv=['dmc'])
+        finally:
+            sys.modules.pop('lazy_cmd_mod', None)
+
+    def test_safe_call_pipe_input(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa.pipe_input = 'records'
+        args = argparse.Namespace(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('result', None)
+        assert args.records is None
+
+    def test_safe_call_pipe_input_set(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa.pipe_input = 'records'
+        args = argparse.Namespace(debug=False, records='upstream')
+
+        sa.safe_call(args)
+
+        assert args.records == 'upstream'
+
+    def test_console_pipeline(self, mocker):
+        args = [argparse.Namespace(stage=i) for i in range(3)]
+        parser = mocker.Mock(**{'parse_args.side_effect': args})
+        mock_make_parser = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', return_value=parser
+        )
+        stages = [
+            mocker.Mock(**{
+                'pipe_input': None,
+                'safe_call.return_value': ('res0', None),
+            }),
+            mocker.Mock(**{
+                'pipe_input': 'records',
+                'safe_call.return_value': ('res1', None),
+            }),
+            mocker.Mock(**{
+                'pipe_input': 'items',
+                'safe_call.return_value': ('res2', None),
+            }),
+        ]
+        mocker.patch.object(cli_tools.ScriptAdaptor, '_select',
+                            side_effect=lambda args: stages[args.stage])
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa.pipe_separator = '--'
+        sa._subcommands = dict(
+            (name, cli_tools._LazySubcommand(name, 'mod:' + name))
+            for name in 'abc')
+
+        result = sa.console(argv=['a', '1', '--', 'b', '--', 'c', '-x'])
+
+        assert result == 'res2'
+        mock_make_parser.assert_called_once_with()
+        parser.parse_args.assert_has_calls([
+            mocker.call(args=['a', '1']),
+            mocker.call(args=['b']),
+            mocker.call(args=['c', '-x']),
+        ])
+        assert args[1].records == 'res0'
+        assert args[2].items == 'res1'
+        for stage_args, stage in zip(args, stages):
+            stage.safe_call.assert_called_once_with(stage_args)
+
+    def test_console_pipeline_exception(self, mocker):
+        parser = mocker.Mock(**{'parse_args.side_effect': [
+            'args1', 'args2',
+        ]})
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', return_value=parser
+        )
+        stage1 = mocker.Mock(**{
+            'pipe_input': None,
+            'safe_call.return_value': (None, ('type', 'exception', 'tb')),
+        })
+        stage2 = mocker.Mock()
+        mocker.patch.object(cli_tools.ScriptAdaptor, '_select',
+                            side_effect=[stage1, stage2])
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa.pipe_separator = '--'
+        sa._subcommands = dict(
+            (name, cli_tools._LazySubcommand(name, 'mod:' + name))
+            for name in 'ab')
+
+        result = sa.console(argv=['a', '--', 'b'])
+
+        assert result == 'exception'
+        assert not stage2.safe_call.called
+
+    def test_console_pipeline_no_input(self, mocker):
+        parser = mocker.Mock(**{'parse_args.side_effect': [
+            'args1', 'args2',
+        ]})
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', return_value=parser
+        )
+        stage1 = mocker.Mock(**{
+            'pipe_input': None,
+            'safe_call.return_value': ('res1', None),
+        })
+        stage2 = mocker.Mock(pipe_input=None)
+        mocker.patch.object(cli_tools.ScriptAdaptor, '_select',
+                            side_effect=[stage1, stage2])
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa.pipe_separator = '--'
+        sa._subcommands = dict(
+            (name, cli_tools._LazySubcommand(name, 'mod:' + name))
+            for name in 'ab')
+
+        result = sa.console(argv=['a', '--', 'b'])
+
+        assert result == 'stage 2 does not accept piped input'
+        assert not stage2.safe_call.called
+
+    def test_console_pipeline_single(self, mocker):
+        mock_pipeline = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_pipeline')
+        mock_parse_args = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args', return_value='parsed args'
+        )
+        mock_safe_call = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call', return_value=('result', None)
+        )
+        mocker.patch.object(cli_tools.sys, 'argv', ['prog', 'a', '1'])
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa.pipe_separator = '--'
+
+        result = sa.console()
+
+        assert result == 'result'
+        assert not mock_pipeline.called
+        mock_parse_args.assert_called_once_with(['a', '1'])
+        mock_safe_call.assert_called_once_with('parsed args')
+
+    def test_console_pipeline_end_of_options(self, mocker):
+        @cli_tools.pipeline()
+        def tool():
+            pass
+
+        @tool.subcommand
+        @cli_tools.argument('pattern')
+        def grep(pattern):
+            return 'grep %s' % pattern
+
+        result = tool.console(argv=['grep', '--', '-v'])
+
+        assert result == 'grep -v'
+        assert tool.cli_tools._pipe_stages(
+            ['grep', '--', '-v', '--', 'grep', 'x']) == [
+                ['grep', '--', '-v'], ['grep', 'x']]
+
+    def test_shell(self, mocker):
+        parser = mocker.Mock(**{'parse_args.side_effect': [
+            'args1', SystemExit(2), 'args3', 'args4', 'args5',
+        ]})
+        parser.prog = 'prog'
+        mock_make_parser = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', return_value=parser
+        )
+        adaptor = mocker.Mock(**{'safe_call.side_effect': [
+            ('result1', None),
+            (None, ('type', 'exception', 'tb')),
+            (None, None),
+            ExceptionForTest('debug'),
+        ]})
+        mock_select = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_select', return_value=adaptor
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        stdin = six.StringIO(
+            'cmd1 "a b"\nbad\n\ncmd3\n"unbalanced\ncmd4\ncmd5\n'
+            'exit\ncmd6\n'
+        )
+        stdout = six.StringIO()
+        stderr = six.StringIO()
+
+        result = sa.shell(stdin=stdin, stdout=stdout, stderr=stderr)
+
+        assert result is None
+        mock_make_parser.assert_called_once_with()
+        parser.parse_args.assert_has_calls([
+            mocker.call(args=['cmd1', 'a b']),
+            mocker.call(args=['bad']),
+            mocker.call(args=['cmd3']),
+            mocker.call(args=['cmd4']),
+            mocker.call(args=['cmd5']),
+        ])
+        assert parser.parse_args.call_count == 5
+        mock_select.assert_has_calls([
+            mocker.call('args1'),
+            mocker.call('args3'),
+            mocker.call('args4'),
+            mocker.call('args5'),
+        ])
+        assert stdout.getvalue() == 'result1\n'
+        errors = stderr.getvalue().split('\n')
+        assert errors[0] == 'exception'
+        assert errors[1] == 'No closing quotation'
+        assert errors[2] == 'Traceback (most recent call last):'
+        assert errors[-2].endswith('ExceptionForTest: debug')
+
+    def test_shell_eof(self, mocker):
+        parser = mocker.Mock(prog='prog')
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', return_value=parser
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        stdout = six.StringIO()
+
+        sa.shell(stdin=six.StringIO(''), stdout=stdout)
+
+        assert not parser.parse_args.called
+        assert stdout.getvalue() == ''
+
+    def test_shell_interactive(self, mocker):
+        parser = mocker.Mock(**{'parse_args.return_value': 'args'})
+        parser.prog = 'prog'
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', return_value=parser
+        )
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_select', return_value=mocker.Mock(**{
+                'safe_call.return_value': ('result', None),
+            })
+        )
+        stdin = mocker.patch.object(cli_tools.sys, 'stdin', **{
+            'isatty.return_value': True,
+        })
+        mock_input = mocker.patch.object(
+            cli_tools.six.moves, 'input',
+            side_effect=['cmd', KeyboardInterrupt(), EOFError()],
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        stdout = six.StringIO()
+
+        sa.shell(stdout=stdout)
+
+        assert not stdin.readline.called
+        mock_input.assert_has_calls([mocker.call('prog> ')] * 3)
+        parser.parse_args.assert_called_once_with(args=['cmd'])
+        assert stdout.getvalue() == 'result\n\n\n'
+
+    def test_shell_pipeline(self, mocker):
+        parser = mocker.Mock(prog='prog')
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', return_value=parser
+        )
+        mock_pipeline = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_pipeline', return_value='result'
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa.pipe_separator = '--'
+        sa._subcommands = dict(
+            (name, cli_tools._LazySubcommand(name, 'mod:' + name))
+            for name in 'ab')
+        stdout = six.StringIO()
+
+        sa.shell(prompt='> ', stdin=six.StringIO('a -- b\n'), stdout=stdout)
+
+        mock_pipeline.assert_called_once_with(['a', '--', 'b'], parser)
+        assert not parser.parse_args.called
+        assert stdout.getvalue() == 'result\n'
+
+    def test_middleware(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+
+        result1 = sa.middleware('func1')
+        result2 = sa.middleware('func2', inherit=False)
+
+        assert result1 == 'func1'
+        assert result2 == 'func2'
+        assert sa._middleware == (('func1', True), ('func2', False))
+
+    def test_get_timings(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._timings = [('processor', 1.0)]
+
+        result = sa.get_timings()
+
+        assert result == [('processor', 1.0)]
+        assert result is not sa._timings
+
+    def test_get_plugin_loads(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._plugin_loads = (('group', 'name', 'dist', 1.0, None),)
+
+        result = sa.get_plugin_loads()
+
+        assert result == [('group', 'name', 'dist', 1.0, None)]
+
+    def test_safe_call_middleware(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        mocker.patch.object(
+            cli_tools.time, 'time', side_effect=[1.0, 2.0, 3.0, 5.0, 8.0,
+                                                 13.0, 21.0, 34.0],
+        )
+        order = []
+
+        def outer(args):
+            order.append('outer pre')
+            result = yield
+            order.append(('outer post', result))
+            yield 'replaced'
+
+        def inner(args):
+            order.append('inner pre')
+
+        def func():
+            order.append('call')
+            return 'result'
+
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._middleware = [(outer, True), (inner, True)]
+        args = argparse.Namespace(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('replaced', None)
+        assert order == [
+            'outer pre', 'inner pre', 'call', ('outer post', 'result'),
+        ]
+        assert sa._timings == (
+            ('processor', 1.0), ('outer', 2.0 + 13.0), ('inner', 5.0),
+        )
+
+    def test_safe_call_middleware_short_circuit(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        order = []
+
+        def outer(args):
+            result = yield
+            order.append(('outer post', result))
+
+        def short(args):
+            return cli_tools.ShortCircuit('cached')
+
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        inner = mocker.Mock(__name__='inner')
+        sa._middleware = [(outer, True), (short, True), (inner, True)]
+        args = argparse.Namespace(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('cached', None)
+        assert order == [('outer post', 'cached')]
+        assert not inner.called
+        assert not func.called
+        assert [name for name, _ in sa._timings] == [
+            'processor', 'outer', 'short',
+        ]
+
+    def test_safe_call_middleware_short_circuit_gen(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        order = []
+
+        def short(args):
+            try:
+                yield cli_tools.ShortCircuit('cached')
+                order.append('post')  # pragma: no cover
+            finally:
+                order.append('closed')
+
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._middleware = [(short, True)]
+        args = argparse.Namespace(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('cached', None)
+        assert order == ['closed']
+        assert not func.called
+
+    def test_safe_call_middleware_exc(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        order = []
+
+        def outer(args):
+            try:
+                yield
+            except ExceptionForTest:
+                order.append('outer caught')
+                yield 'recovered'
+
+        def failing(args):
+            raise ExceptionForTest('failed')
+
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._middleware = [(outer, True), (failing, True)]
+        args = argparse.Namespace(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('recovered', None)
+        assert order == ['outer caught']
+        assert not func.called
+
+    def test_safe_call_middleware_exc_debug(self, mocker):
+        def failing(args):
+            raise ExceptionForTest('failed')
+
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._middleware = [(failing, True)]
+        args = argparse.Namespace(debug=True)
+
+        with pytest.raises(ExceptionForTest):
+            sa.safe_call(args)
+        assert not func.called
+
+    def test_safe_call_class_exc_norun(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', side_effect=ExceptionForTest('init'))
+        sa = cli_tools.ScriptAdaptor(func, True)
+        args = argparse.Namespace(debug=False)
+
+        result, exc_info = sa.safe_call(args)
+
+        assert result is None
+        assert isinstance(exc_info[1], ExceptionForTest)
+
+    def test_safe_call_lazy_default(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs',
+            side_effect=lambda func, args: {'a': args.a},
+        )
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._processor = mocker.Mock()
+        lazy = cli_tools.LazyDefault(mocker.Mock(return_value='value'))
+        args = argparse.Namespace(debug=False, a=lazy)
+
+        result = sa.safe_call(args)
+
+        assert result == ('result', None)
+        assert args.a == 'value'
+        sa._processor.assert_called_once_with(args)
+        func.assert_called_once_with(a='value')
+
+    def test_safe_call_lazy_default_exc(self, mocker):
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        lazy = cli_tools.LazyDefault(
+            mocker.Mock(side_effect=ExceptionForTest('failed')))
+        args = argparse.Namespace(debug=False, a=lazy)
+
+        result, exc_info = sa.safe_call(args)
+
+        assert result is None
+        assert isinstance(exc_info[1], ExceptionForTest)
+        assert not func.called
+
+    def test_safe_call_lazy_default_exc_debug(self, mocker):
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        lazy = cli_tools.LazyDefault(
+            mocker.Mock(side_effect=ExceptionForTest('failed')))
+        args = argparse.Namespace(debug=True, a=lazy)
+
+        with pytest.raises(ExceptionForTest):
+            sa.safe_call(args)
+        assert not func.called
+
+    def test_session_processor(self, mocker):
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+
+        result = sa.session_processor('func')
+
+        assert result == 'func'
+        assert sa._session_processor == 'func'
+
+    def test_safe_call_session_func(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._session_processor = mocker.Mock(return_value={'conn': 'db'})
+        args1 = argparse.Namespace(debug=False)
+        args2 = argparse.Namespace(debug=False)
+
+        assert sa.safe_call(args1) == ('result', None)
+        assert sa.safe_call(args2) == ('result', None)
+
+        sa._session_processor.assert_called_once_with(args1)
+        assert args1.conn == 'db'
+        assert args2.conn == 'db'
+        assert sa._session.post is None
+
+    def test_safe_call_session_gen(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        calls = []
+
+        def session_proc(args):
+            calls.append(('pre', args))
+            yield {'conn': 'db'}
+            calls.append('post')
+
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._session_processor = session_proc
+        args1 = argparse.Namespace(debug=False)
+        args2 = argparse.Namespace(debug=False)
+
+        sa.safe_call(args1)
+        sa.safe_call(args2)
+
+        assert calls == [('pre', args1)]
+        assert args2.conn == 'db'
+
+        sa.close_session()
+
+        assert calls == [('pre', args1), 'post']
+        assert sa._session is None
+
+    def test_safe_call_session_gen_nopost(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+
+        def session_proc(args):
+            return
+            yield  # pragma: no cover
+
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._session_processor = session_proc
+        args = argparse.Namespace(debug=False)
+
+        assert sa.safe_call(args) == ('result', None)
+        assert sa._session.values == {}
+        assert sa._session.post is None
+
+    def test_safe_call_session_parent(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        parent = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        parent._session_processor = mocker.Mock(return_value={
+            'conn': 'parent', 'other': 'value',
+        })
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._session_processor = mocker.Mock(return_value={'conn': 'child'})
+        parent._add_subcommand('sub', sa)
+        args = argparse.Namespace(debug=False)
+
+        sa.safe_call(args)
+
+        assert args.conn == 'child'
+        assert args.other == 'value'
+        assert parent._session is not None
+
+    def test_close_session(self, mocker):
+        order = []
+        gen = mocker.Mock(**{
+            'next.side_effect': lambda: order.append('parent'),
+        })
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._session = cli_tools._Session({}, MockGen(gen), False)
+        sub_gen = mocker.Mock(**{
+            'next.side_effect': lambda: order.append('sub'),
+        })
+        sub = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sub._session = cli_tools._Session({}, MockGen(sub_gen), False)
+        sa._subcommands = {'sub': sub}
+
+        sa.close_session()
+
+        assert order == ['sub', 'parent']
+        gen.close.assert_called_once_with()
+        sub_gen.close.assert_called_once_with()
+        assert sa._session is None
+        assert sub._session is None
+
+    def test_close_session_stop(self, mocker):
+        gen = mocker.Mock(**{'next.side_effect': StopIteration()})
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._session = cli_tools._Session({}, MockGen(gen), False)
+
+        sa.close_session()
+
+        gen.close.assert_called_once_with()
+
+    def test_close_session_none(self, mocker):
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        sa.close_session()
+
+        assert sa._session is None
+
+    def test_session(self, mocker):
+        mock_close_session = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'close_session'
+        )
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        with sa.session() as result:
+            assert result is sa
+            with sa.session():
+                assert sa._session_depth == 2
+            assert not mock_close_session.called
+
+        mock_close_session.assert_called_once_with()
+        assert sa._session_depth == 0
+
+    def test_console_session(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args', return_value='args')
+        mock_close_session = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'close_session'
+        )
+
+        def safe_call(args):
+            assert sa._session_depth == 1
+            return ('result', None)
+
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call', side_effect=safe_call)
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        result = sa.console(argv=[])
+
+        assert result == 'result'
+        mock_close_session.assert_called_once_with()
+
+    def test_console_session_running(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args', return_value='args')
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call', return_value=('res', None))
+        mock_close_session = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'close_session'
+        )
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        with sa.session():
+            sa.console(argv=[])
+            sa.console(argv=[])
+            assert not mock_close_session.called
+
+        mock_close_session.assert_called_once_with()
+
+    def test_shell_session(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser',
+            return_value=mocker.Mock(prog='prog'),
+        )
+        mock_close_session = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'close_session'
+        )
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+
+        sa.shell(stdin=six.StringIO(''))
+
+        mock_close_session.assert_called_once_with()
+
+    def test_safe_call_mapper(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mock_get_kwargs = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs'
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._mapper = mocker.Mock(return_value=None)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == (None, None)
+        sa._mapper.assert_called_once_with(sa, args)
+        assert not mock_get_kwargs.called
+        assert not func.called
+
+
+@requires_asyncio
+class TestScriptAdaptorAsync(object):
+    def test_safe_call(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mock_get_kwargs = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs',
+            return_value=dict(a=1, b=2, c=3)
+        )
+        func = mocker.Mock(__doc__='',
+                           return_value=AwaitableForTest('result'))
+        sa = cli_tools.ScriptAdaptor(func, False)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('result', None)
+        mock_get_kwargs.assert_called_once_with(func, args)
+        func.assert_called_once_with(a=1, b=2, c=3)
+
+    def test_safe_call_exc(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        exc = ExceptionForTest('failed')
+        func = mocker.Mock(__doc__='',
+                           return_value=AwaitableForTest(exc=exc))
+        sa = cli_tools.ScriptAdaptor(func, False)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result[0] is None
+        assert result[1][1] is exc
+
+    def test_safe_call_exc_debug(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(
+            __doc__='',
+            return_value=AwaitableForTest(exc=ExceptionForTest('failed')),
+        )
+        sa = cli_tools.ScriptAdaptor(func, False)
+        args = mocker.Mock(debug=True)
+
+        with pytest.raises(ExceptionForTest):
+            sa.safe_call(args)
+
+    def test_safe_call_class(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        obj = mocker.Mock(**{
+            'run.return_value': AwaitableForTest('result'),
+        })
+        func = mocker.Mock(__doc__='', return_value=obj)
+        sa = cli_tools.ScriptAdaptor(func, True)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('result', None)
+        obj.run.assert_called_once_with()
+
+    def test_safe_call_proc_coroutine(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        pre = AwaitableForTest()
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._processor = mocker.Mock(return_value=pre)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('result', None)
+        sa._processor.assert_called_once_with(args)
+        assert pre.suspended is True
+
+    def test_safe_call_middleware_short_circuit(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        short = mocker.Mock(
+            __name__='short',
+            return_value=AwaitableForTest(cli_tools.ShortCircuit('cached')),
+        )
+        sa._middleware = [(short, True)]
+        args = argparse.Namespace(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('cached', None)
+        assert not func.called
+
+    def test_safe_call_middleware_short_circuit_asyncgen(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools, '_isasyncgenfunction',
+            side_effect=lambda func: func is short,
+        )
+        gen = mocker.Mock(**{
+            'anext.return_value': AwaitableForTest(
+                cli_tools.ShortCircuit('cached')),
+            'aclose.return_value': AwaitableForTest(),
+        })
+        short = MockAsyncGenFunc(gen)
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._middleware = [(short, True)]
+        args = argparse.Namespace(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('cached', None)
+        assert not func.called
+        gen.assert_has_calls([
+            mocker.call.call(args),
+            mocker.call.anext(),
+            mocker.call.aclose(),
+        ])
+
+    def test_safe_call_proc_asyncgen_nopost(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(cli_tools, '_isasyncgenfunction',
+                            return_value=True)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        gen = mocker.Mock(**{
+            'anext.return_value': AwaitableForTest(
+                exc=cli_tools._StopAsyncIteration()),
+        })
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._processor = MockAsyncGenFunc(gen)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('result', None)
+        gen.assert_has_calls([
+            mocker.call.call(args),
+            mocker.call.anext(),
+        ])
+        assert len(gen.method_calls) == 2
+
+    def test_safe_call_proc_asyncgen_post_res_noreplace(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(cli_tools, '_isasyncgenfunction',
+                            return_value=True)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        gen = mocker.Mock(**{
+            'anext.return_value': AwaitableForTest(),
+            'asend.return_value': AwaitableForTest(
+                exc=cli_tools._StopAsyncIteration()),
+            'aclose.return_value': AwaitableForTest(),
+        })
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._processor = MockAsyncGenFunc(gen)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('result', None)
+        gen.assert_has_calls([
+            mocker.call.call(args),
+            mocker.call.anext(),
+            mocker.call.asend('result'),
+            mocker.call.aclose(),
+        ])
+        assert len(gen.method_calls) == 4
+
+    def test_safe_call_proc_asyncgen_post_res_replace(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(cli_tools, '_isasyncgenfunction',
+                            return_value=True)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        gen = mocker.Mock(**{
+            'anext.return_value': AwaitableForTest(),
+            'asend.return_value': AwaitableForTest('replaced'),
+            'aclose.return_value': AwaitableForTest(),
+        })
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._processor = MockAsyncGenFunc(gen)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('replaced', None)
+
+    def test_safe_call_proc_asyncgen_post_exc_replace(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(cli_tools, '_isasyncgenfunction',
+                            return_value=True)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        exc = ExceptionForTest('failed')
+        func = mocker.Mock(__doc__='', side_effect=exc)
+        gen = mocker.Mock(**{
+            'anext.return_value': AwaitableForTest(),
+            'athrow.return_value': AwaitableForTest('replaced'),
+            'aclose.return_value': AwaitableForTest(),
+        })
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._processor = MockAsyncGenFunc(gen)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result == ('replaced', None)
+        gen.athrow.assert_called_once_with(
+            ExceptionForTest, exc, mocker.ANY)
+
+    def test_safe_call_proc_asyncgen_post_exc_raise(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(cli_tools, '_isasyncgenfunction',
+                            return_value=True)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        exc = ExceptionForTest('failed')
+        func = mocker.Mock(__doc__='', return_value='result')
+        gen = mocker.Mock(**{
+            'anext.return_value': AwaitableForTest(),
+            'asend.return_value': AwaitableForTest(exc=exc),
+            'aclose.return_value': AwaitableForTest(),
+        })
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._processor = MockAsyncGenFunc(gen)
+        args = mocker.Mock(debug=False)
+
+        result = sa.safe_call(args)
+
+        assert result[0] is None
+        assert result[1][1] is exc
+
+    def test_safe_call_async(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='',
+                           return_value=AwaitableForTest('result'))
+        sa = cli_tools.ScriptAdaptor(func, False)
+        args = mocker.Mock(debug=False)
+        loop = cli_tools._event_loop()
+
+        result = loop.run_until_complete(sa.safe_call_async(args))
+
+        assert result == ('result', None)
+
+    def test_safe_call_async_exc_debug(self, mocker):
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(
+            __doc__='',
+            return_value=AwaitableForTest(exc=ExceptionForTest('failed')),
+        )
+        sa = cli_tools.ScriptAdaptor(func, False)
+        args = mocker.Mock(debug=True)
+        loop = cli_tools._event_loop()
+
+        with pytest.raises(ExceptionForTest):
+            loop.run_until_complete(sa.safe_call_async(args))
+
+    def test_safe_call_session_asyncgen(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools, '_isasyncgenfunction',
+            side_effect=lambda func: func is sa._session_processor,
+        )
+        func = mocker.Mock(__doc__='', return_value='result')
+        gen = mocker.Mock(**{
+            'anext.side_effect': [
+                AwaitableForTest({'conn': 'db'}),
+                AwaitableForTest(exc=cli_tools._StopAsyncIteration()),
+            ],
+            'aclose.return_value': AwaitableForTest(),
+        })
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._session_processor = MockAsyncGenFunc(gen)
+        args = argparse.Namespace(debug=False)
+
+        sa.safe_call(args)
+
+        assert args.conn == 'db'
+        assert sa._session.post_async is True
+
+        sa.close_session()
+
+        gen.assert_has_calls([
+            mocker.call.call(args),
+            mocker.call.anext(),
+            mocker.call.anext(),
+            mocker.call.aclose(),
+        ])
+
+    def test_safe_call_session_coroutine(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        func = mocker.Mock(__doc__='', return_value='result')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        sa._session_processor = mocker.Mock(
+            return_value=AwaitableForTest({'conn': 'db'}))
+        args = argparse.Namespace(debug=False)
+
+        sa.safe_call(args)
+
+        assert args.conn == 'db'
+
+    def test_console_async(self, mocker):
+        mock_parse_args = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args', return_value='parsed args'
+        )
+        future = cli_tools.asyncio.Future(loop=cli_tools._event_loop())
+        future.set_result((None, ('type', 'exception', 'tb')))
+        mock_safe_call_async = mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call_async', return_value=future
+        )
+        func = mocker.Mock(__doc__='')
+        sa = cli_tools.ScriptAdaptor(func, False)
+        loop = cli_tools._event_loop()
+
+        result = loop.run_until_complete(
+            sa.console_async(argv='argument vector'))
+
+        assert result == 'exception'
+        mock_parse_args.assert_called_once_with('argument vector')
+        mock_safe_call_async.assert_called_once_with('parsed args')
+
+    def test_console_async_session(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args',
+            return_value=argparse.Namespace(debug=False),
+        )
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'get_kwargs', return_value={})
+        mocker.patch.object(inspect, 'isgeneratorfunction', return_value=False)
+        mocker.patch.object(
+            cli_tools, '_isasyncgenfunction',
+            side_effect=lambda func: func is sa._session_processor,
+        )
+        gen = mocker.Mock(**{
+            'anext.side_effect': [
+                AwaitableForTest({'conn': 'db'}),
+                AwaitableForTest(exc=cli_tools._StopAsyncIteration()),
+            ],
+            'aclose.return_value': AwaitableForTest(),
+        })
+        sa = cli_tools.ScriptAdaptor(
+            mocker.Mock(__doc__='', return_value='result'), False)
+        sa._session_processor = MockAsyncGenFunc(gen)
+        loop = cli_tools._event_loop()
+
+        result = loop.run_until_complete(sa.console_async())
+
+        assert result == 'result'
+        assert sa._session is None
+        assert sa._session_depth == 0
+        gen.assert_has_calls([
+            mocker.call.anext(),
+            mocker.call.anext(),
+            mocker.call.aclose(),
+        ])
+
+    def test_console_async_session_running(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args', return_value='args')
+        mock_close_steps = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_close_steps'
+        )
+        future = cli_tools.asyncio.Future(loop=cli_tools._event_loop())
+        future.set_result(('result', None))
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call_async', return_value=future
+        )
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        loop = cli_tools._event_loop()
+
+        with sa.session():
+            mock_close = mocker.patch.object(
+                cli_tools.ScriptAdaptor, 'close_session')
+            result = loop.run_until_complete(sa.console_async())
+
+            assert result == 'result'
+            assert sa._session_depth == 1
+            assert not mock_close_steps.called
+
+        mock_close.assert_called_once_with()
+
+    def test_console_async_low_memory(self, mocker):
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_parse_args', return_value='parsed args'
+        )
+        mock_release = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_release'
+        )
+        future = cli_tools.asyncio.Future(loop=cli_tools._event_loop())
+        future.set_result(('result', None))
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, 'safe_call_async', return_value=future
+        )
+        sa = cli_tools.ScriptAdaptor(mocker.Mock(__doc__=''), False)
+        sa._low_memory = True
+        loop = cli_tools._event_loop()
+
+        result = loop.run_until_complete(sa.console_async())
+
+        assert result == 'result'
+        mock_release.assert_called_once_with('parsed args')
+
+
+@requires_asyncio
+class TestEventLoop(object):
+    def test_reused(self):
+        loop = cli_tools._event_loop()
+
+        assert cli_tools._event_loop() is loop
+
+    def test_closed(self):
+        loop = cli_tools._event_loop()
+        loop.close()
+
+        result = cli_tools._event_loop()
+
+        assert result is not loop
+        assert not result.is_closed()
+
+
+class TestRunSteps(object):
+    def test_sync(self, mocker):
+        steps = mocker.Mock(**{'send.return_value': cli_tools._Done('res')})
+
+        result = cli_tools._run_steps(steps)
+
+        assert result == 'res'
+        steps.send.assert_called_once_with(None)
+        steps.close.assert_called_once_with()
+
+    @requires_asyncio
+    def test_awaitable(self, mocker):
+        steps = mocker.Mock(**{'send.side_effect': [
+            AwaitableForTest('value'), cli_tools._Done('res'),
+        ]})
+
+        result = cli_tools._run_steps(steps)
+
+        assert result == 'res'
+        steps.send.assert_has_calls([mocker.call(None), mocker.call('value')])
+
+    @requires_asyncio
+    def test_awaitable_exc(self, mocker):
+        exc = ExceptionForTest('failed')
+        steps = mocker.Mock(**{
+            'send.return_value': AwaitableForTest(exc=exc),
+            'throw.return_value': cli_tools._Done('res'),
+        })
+
+        result = cli_tools._run_steps(steps)
+
+        assert result == 'res'
+        steps.throw.assert_called_once_with(ExceptionForTest, exc, mocker.ANY)
+
+
+@requires_asyncio
+class TestScheduleSteps(object):
+    def test_schedule(self, mocker):
+        steps = mocker.Mock(**{'send.side_effect': [
+            AwaitableForTest('value'), cli_tools._Done('res'),
+        ]})
+        loop = cli_tools._event_loop()
+
+        result = loop.run_until_complete(cli_tools._schedule_steps(steps))
+
+        assert result == 'res'
+        steps.send.assert_has_calls([mocker.call(None), mocker.call('value')])
+        steps.close.assert_called_once_with()
+
+    def test_schedule_exc(self, mocker):
+        exc = ExceptionForTest('failed')
+        steps = mocker.Mock(**{
+            'send.return_value': AwaitableForTest(exc=exc),
+            'throw.side_effect': ExceptionForTest('other'),
+        })
+        loop = cli_tools._event_loop()
+
+        with pytest.raises(ExceptionForTest):
+            loop.run_until_complete(cli_tools._schedule_steps(steps))
+        steps.throw.assert_called_once_with(ExceptionForTest, exc, mocker.ANY)
+
+    def test_then(self):
+        loop = cli_tools._event_loop()
+        future = cli_tools.asyncio.Future(loop=loop)
+        future.set_result(('result', None))
+
+        result = loop.run_until_complete(
+            cli_tools._then(future, cli_tools._console_result))
+
+        assert result == 'result'
+
+
+class TestSuggest(object):
+    words = ['deploy', 'delete', 'describe', 'list', 'logs', 'login']
+
+    def test_suggest(self):
+        assert cli_tools._suggest('deplyo', self.words) == ['deploy']
+        assert cli_tools._suggest('lgos', self.words) == ['logs']
+        assert cli_tools._suggest('logz', self.words) == ['logs', 'login']
+        assert cli_tools._suggest('logz', self.words, limit=1) == ['logs']
+        assert cli_tools._suggest('lst', self.words) == ['list']
+        assert cli_tools._suggest('xyzzy', self.words) == []
+        assert cli_tools._suggest('word', []) == []
+
+    def test_suggest_exhaustive(self):
+        words = ['cmd%d' % i for i in range(200)] + self.words
+
+        for word in ('cmd7', 'cnd42', 'delte', 'lgin', 'xyz', 'a'):
+            max_distance = max(1, len(word) // 2)
+            expected = sorted(
+                (cli_tools._edit_distance(word, w), w) for w in words
+                if cli_tools._edit_distance(word, w) <= max_distance
+            )
+            assert cli_tools._suggest(word, words, limit=1000) == [
+                w for _d, w in expected
+            ]
+
+    def test_suggest_prefilter(self, mocker):
+        words = ['a' * length for length in range(1, 101)]
+        mock_edit_distance = mocker.patch.object(
+            cli_tools, '_edit_distance', side_effect=cli_tools._edit_distance
+        )
+
+        result = cli_tools._suggest('aaaa', words)
+
+        assert result == ['aaaa', 'aaa', 'aaaaa']
+        # Only the words of 2 to 6 characters are compared
+        assert mock_edit_distance.call_count == 5
+
+
+class TestSubcommandChoices(object):
+    def test_mapping(self):
+        parsers = {'cmd': 'parser1', 'dmc': 'parser2'}
+
+        choices = cli_tools._SubcommandChoices(parsers)
+
+        assert 'cmd' in choices
+        assert 'other' in choices
+        assert sorted(choices) == ['cmd', 'dmc']
+        assert len(choices) == 2
+        assert choices['cmd'] == 'parser1'
+        assert sorted(choices.items()) == [
+            ('cmd', 'parser1'), ('dmc', 'parser2'),
+        ]
+        parsers['mdc'] = 'parser3'
+        assert len(choices) == 3
+
+
+class TestLazySubParsersAction(object):
+    def test_init(self):
+        parser = argparse.ArgumentParser()
+
+        result = parser.add_subparsers(action=cli_tools._LazySubParsersAction)
+
+        assert isinstance(result, cli_tools._LazySubParsersAction)
+        assert isinstance(result.choices, cli_tools._SubcommandChoices)
+        assert result.choices._parsers is result._name_parser_map
+        assert result._adaptors == {}
+        assert result._deferred == set()
+
+    def test_unknown(self):
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(
+            action=cli_tools._LazySubParsersAction)
+        for name in ('deploy', 'delete', 'list', 'logs', 'login'):
+            subparsers.add_parser(name)
+
+        assert subparsers.unknown('deplyo') == (
+            "invalid choice: 'deplyo' (did you mean 'deploy'?)"
+        )
+        assert subparsers.unknown('logz') == (
+            "invalid choice: 'logz' (did you mean 'logs' or 'login'?)"
+        )
+        assert subparsers.unknown('xyzzy') == "invalid choice: 'xyzzy'"
+
+    def test_bind(self, mocker):
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(
+            action=cli_tools._LazySubParsersAction)
+        cmd_parser = subparsers.add_parser('cmd')
+        adaptor = mocker.Mock()
+
+        subparsers.bind(cmd_parser, adaptor)
+
+        assert subparsers._adaptors == {cmd_parser: adaptor}
+        assert subparsers._deferred == set([cmd_parser])
+        assert not adaptor.setup_args.called
+
+    def test_materialize(self, mocker):
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(
+            action=cli_tools._LazySubParsersAction)
+        cmd_parser = subparsers.add_parser('cmd')
+        adaptor = mocker.Mock()
+        subparsers.bind(cmd_parser, adaptor)
+
+        assert subparsers.materialize(cmd_parser) is cmd_parser
+        assert subparsers.materialize(cmd_parser) is cmd_parser
+
+        adaptor.setup_args.assert_called_once_with(cmd_parser)
+        assert subparsers._deferred == set()
+
+    def test_materialize_lazy(self, mocker):
+        adaptor = mocker.Mock()
+        mock_load = mocker.patch.object(
+            cli_tools._LazySubcommand, 'load', return_value=adaptor
+        )
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(
+            action=cli_tools._LazySubParsersAction)
+        cmd_parser = subparsers.add_parser('cmd')
+        subparsers.bind(cmd_parser,
+                        cli_tools._LazySubcommand('cmd', 'module:func'))
+
+        subparsers.materialize(cmd_parser)
+
+        mock_load.assert_called_once_with(cmd_parser)
+        adaptor.setup_args.assert_called_once_with(cmd_parser)
+        assert subparsers._adaptors == {cmd_parser: adaptor}
+
+    def test_call(self, mocker):
+        cmd_adaptor = mocker.Mock(**{
+            'setup_args.side_effect': lambda p: p.add_argument('--opt'),
+        })
+        dmc_adaptor = mocker.Mock()
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(
+            action=cli_tools._LazySubParsersAction)
+        cmd_parser = subparsers.add_parser('cmd')
+        dmc_parser = subparsers.add_parser('dmc')
+        subparsers.bind(cmd_parser, cmd_adaptor)
+        subparsers.bind(dmc_parser, dmc_adaptor)
+
+        result = parser.parse_args(['cmd', '--opt', 'value'])
+
+        assert result.opt == 'value'
+        assert list(getattr(result, cli_tools._path_attr)) == [cmd_adaptor]
+        assert subparsers._deferred == set([dmc_parser])
+        assert not dmc_adaptor.setup_args.called
+
+    def test_call_nested(self, mocker):
+        def setup_cmd(parser):
+            subparsers = parser.add_subparsers(
+                action=cli_tools._LazySubParsersAction)
+            subparsers.bind(subparsers.add_parser('sub'), sub_adaptor)
+
+        cmd_adaptor = mocker.Mock(**{'setup_args.side_effect': setup_cmd})
+        sub_adaptor = mocker.Mock(**{
+            'setup_args.side_effect': lambda p: p.add_argument('--opt'),
+        })
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(
+            action=cli_tools._LazySubParsersAction)
+        subparsers.bind(subparsers.add_parser('cmd'), cmd_adaptor)
+
+        result = parser.parse_args(['cmd', 'sub', '--opt', 'value'])
+
+        assert result.opt == 'value'
+        assert list(getattr(result, cli_tools._path_attr)) == [
+            cmd_adaptor, sub_adaptor,
+        ]
+
+    def test_call_unknown(self, capsys):
+        parser = argparse.ArgumentParser(prog='prog')
+        subparsers = parser.add_subparsers(
+            action=cli_tools._LazySubParsersAction)
+        for idx in range(100):
+            subparsers.add_parser('cmd%d' % idx)
+
+        with pytest.raises(SystemExit):
+            parser.parse_args(['cmd7x'])
+
+        out, err = capsys.readouterr()
+        assert err.splitlines()[-1] == (
+            "prog: error: invalid choice: 'cmd7x' (did you mean 'cmd7' or "
+            "'cmd70' or 'cmd71'?)"
+        )
+
+
+class TestFrozenEntryPoint(object):
+    def test_init(self):
+        result = cli_tools._FrozenEntryPoint('cmd', 'pkg.mod:cls.func', 'd')
+
+        assert result.name == 'cmd'
+        assert result.module_name == 'pkg.mod'
+        assert result.attrs == ('cls', 'func')
+        assert result.dist == 'd'
+        assert str(result) == 'cmd = pkg.mod:cls.func'
+
+    def test_init_module(self):
+        result = cli_tools._FrozenEntryPoint('cmd', 'pkg.mod', 'd')
+
+        assert result.attrs == ()
+        assert str(result) == 'cmd = pkg.mod'
+
+    def test_load(self, mocker):
+        mock_import_target = mocker.patch.object(cli_tools, '_import_target')
+        ep = cli_tools._FrozenEntryPoint('cmd', 'pkg.mod:cls.func', 'd')
+
+        result = ep.load()
+
+        assert result == mock_import_target.return_value
+        mock_import_target.assert_called_once_with('pkg.mod:cls.func')
+
+
+class TestLazySubcommand(object):
+    def test_init(self):
+        result = cli_tools._LazySubcommand('cmd', 'module:func', 'help')
+
+        assert result._name == 'cmd'
+        assert result._target == 'module:func'
+        assert result._parent is None
+        assert result.prog is None
+        assert result.usage is None
+        assert result.description == 'help'
+        assert result.epilog is None
+        assert result.formatter_class is argparse.HelpFormatter
+        assert result.error is None
+
+    def test_close_session(self):
+        placeholder = cli_tools._LazySubcommand('cmd', 'module:func')
+
+        placeholder.close_session()
+
+    def test_load(self, mocker):
+        func = mocker.Mock()
+        mock_import_module = mocker.patch.object(
+            cli_tools.importlib, 'import_module',
+            return_value=mocker.Mock(**{'cls.func': func}),
+        )
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor'
+        )
+        placeholder = cli_tools._LazySubcommand('cmd', 'pkg.module:cls.func')
+        placeholder._parent = mocker.Mock()
+
+        result = placeholder.load()
+
+        assert result is mock_get_adaptor.return_value
+        mock_import_module.assert_called_once_with('pkg.module')
+        mock_get_adaptor.assert_called_once_with(func)
+        placeholder._parent._add_subcommand.assert_called_once_with(
+            'cmd', result)
+
+    def test_load_parser(self, mocker):
+        mocker.patch.object(cli_tools.importlib, 'import_module')
+        adaptor = mocker.Mock(
+            prog='prog', usage='usage', description='description',
+            epilog='epilog', formatter_class='formatter_class',
+        )
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=adaptor
+        )
+        placeholder = cli_tools._LazySubcommand('cmd', 'module:func', 'help')
+        placeholder._parent = mocker.Mock()
+        parser = argparse.ArgumentParser(prog='cmd', description='help')
+
+        result = placeholder.load(parser)
+
+        assert result is adaptor
+        assert parser.prog == 'prog'
+        assert parser.usage == 'usage'
+        assert parser.description == 'description'
+        assert parser.epilog == 'epilog'
+        assert parser.formatter_class == 'formatter_class'
+
+    def test_load_parser_undescribed(self, mocker):
+        mocker.patch.object(cli_tools.importlib, 'import_module')
+        adaptor = mocker.Mock(
+            prog=None, usage=None, description='', epilog=None,
+            formatter_class=argparse.HelpFormatter,
+        )
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=adaptor
+        )
+        placeholder = cli_tools._LazySubcommand('cmd', 'module:func', 'help')
+        placeholder._parent = mocker.Mock()
+        parser = argparse.ArgumentParser(prog='tool cmd', description='help')
+
+        placeholder.load(parser)
+
+        assert parser.prog == 'tool cmd'
+        assert parser.description == 'help'
+
+    def test_load_import_error(self, mocker):
+        mocker.patch.object(
+            cli_tools.importlib, 'import_module',
+            side_effect=ImportError('no module'),
+        )
+        placeholder = cli_tools._LazySubcommand('cmd', 'module:func')
+        placeholder._parent = mocker.Mock()
+
+        with pytest.raises(argparse.ArgumentError):
+            placeholder.load()
+        assert not placeholder._parent._add_subcommand.called
+        assert placeholder.error == 'ImportError: no module'
+
+    def test_load_attribute_error(self, mocker):
+        mocker.patch.object(
+            cli_tools.importlib, 'import_module',
+            return_value=mocker.Mock(spec=[]),
+        )
+        placeholder = cli_tools._LazySubcommand('cmd', 'module:func')
+        placeholder._parent = mocker.Mock()
+
+        with pytest.raises(argparse.ArgumentError):
+            placeholder.load()
+        assert not placeholder._parent._add_subcommand.called
+
+
+class TestLazyDefault(object):
+    def test_init(self, mocker):
+        func = mocker.Mock(__name__='func')
+
+        result = cli_tools.LazyDefault(func, 'description')
+
+        assert result.func is func
+        assert result.description == 'description'
+        assert result._computed is False
+        assert not func.called
+
+    def test_init_default(self, mocker):
+        func = mocker.Mock(__name__='func')
+
+        result = cli_tools.LazyDefault(func)
+
+        assert result.description == '<func>'
+        assert str(result) == '<func>'
+        assert repr(result) == '<func>'
+
+    def test_value(self, mocker):
+        func = mocker.Mock(__name__='func', return_value='value')
+        lazy = cli_tools.LazyDefault(func)
+
+        assert lazy.value == 'value'
+        assert lazy.value == 'value'
+        func.assert_called_once_with()
+
+    def test_resolve(self, mocker):
+        lazy = cli_tools.LazyDefault(mocker.Mock(return_value='value'))
+        args = argparse.Namespace(a=lazy, b='given')
+
+        cli_tools.LazyDefault.resolve(args)
+
+        assert args == argparse.Namespace(a='value', b='given')
+
+
+class TestLazyValue(object):
+    def test_init(self, mocker):
+        converter = mocker.Mock()
+
+        result = cli_tools.LazyValue(converter, 'text')
+
+        assert result.converter is converter
+        assert result.text == 'text'
+        assert repr(result) == "LazyValue('text')"
+        assert not converter.called
+
+    def test_call(self, mocker):
+        converter = mocker.Mock(return_value='value')
+        lazy = cli_tools.LazyValue(converter, 'text')
+
+        assert lazy() == 'value'
+        assert lazy() == 'value'
+        converter.assert_called_once_with('text')
+
+    def test_call_invalid(self):
+        lazy = cli_tools.LazyValue(int, 'text')
+
+        with pytest.raises(ValueError) as exc_info:
+            lazy()
+        assert str(exc_info.value) == "invalid int value: 'text'"
+
+    def test_call_type_error(self, mocker):
+        lazy = cli_tools.LazyValue(
+            mocker.Mock(__name__='conv', side_effect=TypeError()), 'text')
+
+        with pytest.raises(ValueError) as exc_info:
+            lazy()
+        assert str(exc_info.value) == "invalid conv value: 'text'"
+
+    def test_call_argument_type_error(self, mocker):
+        lazy = cli_tools.LazyValue(mocker.Mock(
+            side_effect=argparse.ArgumentTypeError('bad value')), 'text')
+
+        with pytest.raises(ValueError) as exc_info:
+            lazy()
+        assert str(exc_info.value) == 'bad value'
+
+    def test_call_other_error(self, mocker):
+        lazy = cli_tools.LazyValue(
+            mocker.Mock(side_effect=ExceptionForTest()), 'text')
+
+        with pytest.raises(ExceptionForTest):
+            lazy()
+
+        assert lazy._converted is False
+
+
+class TestLazyType(object):
+    def test_lazy_type(self):
+        convert = cli_tools.lazy_type(int)
+
+        result = convert('42')
+
+        assert convert.__name__ == 'int'
+        assert isinstance(result, cli_tools.LazyValue)
+        assert result.converter is int
+        assert result() == 42
+
+    def test_parse(self, mocker):
+        converter = mocker.Mock(__name__='conv', return_value='value')
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--opt', type=cli_tools.lazy_type(converter))
+
+        args = parser.parse_args(['--opt', 'text'])
+
+        assert not converter.called
+        assert args.opt() == 'value'
+        converter.assert_called_once_with('text')
+
+
+class TestShortCircuit(object):
+    def test_init(self):
+        result = cli_tools.ShortCircuit('result')
+
+        assert result.result == 'result'
+
+    def test_init_default(self):
+        result = cli_tools.ShortCircuit()
+
+        assert result.result is None
+
+    def test_repr(self):
+        result = cli_tools.ShortCircuit('result')
+
+        assert repr(result) == "ShortCircuit('result')"
+
+
+class TestConsoleResult(object):
+    def test_result(self):
+        assert cli_tools._console_result(('result', None)) == 'result'
+
+    def test_exception(self):
+        result = cli_tools._console_result((None, ('t', 'exc', 'tb')))
+
+        assert result == 'exc'
+
+
+class TestMapChunk(object):
+    def test_success(self):
+        result = cli_tools._map_chunk(
+            map_record, 'record', {'factor': 2}, 5, ['1', '2', '3'])
+
+        assert result[0] == 5
+        assert result[1] == [2, 4, 6]
+        assert result[2] >= 0
+        assert result[3] is None
+
+    def test_exception(self):
+        result = cli_tools._map_chunk(
+            map_record, 'record', {}, 5, ['1', 'boom', '3'])
+
+        assert result[0] == 5
+        assert result[1] is None
+        assert isinstance(result[3], ExceptionForTest)
+
+
+class TestRecordMapper(object):
+    def test_init_defaults(self, mocker):
+        mocker.patch.object(
+            cli_tools.multiprocessing, 'cpu_count', return_value=4)
+
+        result = cli_tools.RecordMapper()
+
+        assert result.record == 'record'
+        assert result.inputs == 'files'
+        assert result.ordered is True
+        assert result.processes == 4
+        assert result.max_inflight == 8
+        assert result.target == 0.1
+        assert result.max_chunksize == 1024
+
+    def test_init_inline(self):
+        result = cli_tools.RecordMapper(processes=0)
+
+        assert result.processes == 0
+        assert result.max_inflight == 2
+
+    def test_call(self, mocker):
+        mocker.patch.object(
+            cli_tools.RecordMapper, '_read', return_value=iter(['a', 'b']))
+        mock_map = mocker.patch.object(
+            cli_tools.RecordMapper, 'map', return_value=iter(['x', None, 'y'])
+        )
+        mock_stdout = mocker.patch.object(cli_tools.sys, 'stdout')
+        adaptor = mocker.Mock(**{
+            'get_kwargs.return_value': {'record': None, 'factor': 2},
+        })
+        args = argparse.Namespace(files=['f1'], factor=2)
+        mapper = cli_tools.RecordMapper(processes=0)
+
+        result = mapper(adaptor, args)
+
+        assert result is None
+        ns = adaptor.get_kwargs.call_args[0][1]
+        assert ns.record is None
+        assert not hasattr(args, 'record')
+        mapper._read.assert_called_once_with(['f1'])
+        mock_map.assert_called_once_with(
+            adaptor._func, {'factor': 2}, mapper._read.return_value)
+        mock_stdout.assert_has_calls([
+            mocker.call.write('x\n'),
+            mocker.call.write('y\n'),
+            mocker.call.flush(),
+        ])
+
+    def test_read_files(self, tmpdir):
+        f1 = tmpdir.join('f1')
+        f1.write('a\nb\r\n')
+        f2 = tmpdir.join('f2')
+        f2.write('c')
+        mapper = cli_tools.RecordMapper(processes=0)
+
+        result = list(mapper._read([str(f1), str(f2)]))
+
+        assert result == ['a', 'b', 'c']
+
+    def test_read_stdin(self, mocker):
+        mocker.patch.object(
+            cli_tools.sys, 'stdin', six.StringIO('a\nb\n'))
+        mapper = cli_tools.RecordMapper(processes=0)
+
+        result = list(mapper._read([]))
+
+        assert result == ['a', 'b']
+
+    def test_tune_first(self):
+        mapper = cli_tools.RecordMapper(processes=0, target=0.1)
+
+        result = mapper._tune(1, None, 1, 0.01)
+
+        assert result == (10, 0.01)
+
+    def test_tune_average(self):
+        mapper = cli_tools.RecordMapper(processes=0, target=0.1)
+
+        result = mapper._tune(10, 0.01, 10, 0.3)
+
+        assert result == (5, 0.02)
+
+    def test_tune_bounds(self):
+        mapper = cli_tools.RecordMapper(
+            processes=0, target=0.1, max_chunksize=50)
+
+        assert mapper._tune(1, None, 1, 0.0) == (50, 0.0)
+        assert mapper._tune(1, None, 1, 0.001) == (50, 0.001)
+        assert mapper._tune(1, None, 1, 10.0) == (1, 10.0)
+
+    def test_map_inline(self):
+        mapper = cli_tools.RecordMapper(processes=0)
+
+        result = list(mapper.map(map_record, {'factor': 3}, ['1', '2']))
+
+        assert result == [3, 6]
+
+    def test_map_ordered(self):
+        mapper = cli_tools.RecordMapper(processes=2, max_inflight=3)
+        records = [str(i) for i in range(200)]
+
+        result = list(mapper.map(map_record, {'factor': 2}, records))
+
+        assert result == [i * 2 for i in range(200)]
+
+    def test_map_unordered(self):
+        mapper = cli_tools.RecordMapper(processes=2, ordered=False)
+        records = [str(i) for i in range(200)]
+
+        result = list(mapper.map(map_record, {}, records))
+
+        assert sorted(result) == list(range(200))
+
+    def test_map_exception(self):
+        mapper = cli_tools.RecordMapper(processes=2)
+
+        with pytest.raises(ExceptionForTest):
+            list(mapper.map(map_record, {}, ['1', 'boom', '3']))
+
+
+class TestShard(object):
+    def test_init(self):
+        result = cli_tools.Shard(2, 4)
+
+        assert result.index == 2
+        assert result.count == 4
+
+    def test_init_default(self):
+        result = cli_tools.Shard()
+
+        assert result.index == 0
+        assert result.count == 1
+
+    @pytest.mark.parametrize('index,count', [(4, 4), (-1, 4), (0, 0)])
+    def test_init_invalid(self, index, count):
+        with pytest.raises(ValueError):
+            cli_tools.Shard(index, count)
+
+    def test_parse(self):
+        result = cli_tools.Shard.parse('1/3')
+
+        assert result == cli_tools.Shard(1, 3)
+
+    @pytest.mark.parametrize('text', ['1', '1/2/3', 'a/b', '3/3', '0/0'])
+    def test_parse_invalid(self, text):
+        with pytest.raises(argparse.ArgumentTypeError):
+            cli_tools.Shard.parse(text)
+
+    def test_repr(self):
+        assert repr(cli_tools.Shard(1, 3)) == '1/3'
+
+    def test_eq(self):
+        assert cli_tools.Shard(1, 3) == cli_tools.Shard(1, 3)
+        assert cli_tools.Shard(1, 3) != cli_tools.Shard(2, 3)
+        assert cli_tools.Shard(1, 3) != '1/3'
+        assert hash(cli_tools.Shard(1, 3)) == hash(cli_tools.Shard(1, 3))
+
+    def test_owns_single(self):
+        shard = cli_tools.Shard()
+
+        assert shard.owns('anything') is True
+
+    def test_owns(self):
+        expected = (zlib.crc32(b'item-1') & 0xffffffff) % 5
+        shards = [cli_tools.Shard(i, 5) for i in range(5)]
+
+        result = [s for s in shards if s.owns('item-1')]
+
+        assert result == [shards[expected]]
+        assert shards[expected]('item-1') is True
+        assert 'item-1' in shards[expected]
+        assert shards[expected].owns(b'item-1') is True
+        assert shards[expected].owns(u'item-1') is True
+
+    def test_owns_nontext(self):
+        expected = (zlib.crc32(b'12345') & 0xffffffff) % 3
+
+        assert cli_tools.Shard(expected, 3).owns(12345) is True
+
+    def test_filter(self):
+        items = ['item-%d' % i for i in range(100)]
+        shards = [cli_tools.Shard(i, 4) for i in range(4)]
+
+        result = [list(s.filter(items)) for s in shards]
+
+        assert sorted(sum(result, [])) == sorted(items)
+        assert all(result)
+
+    def test_filter_key(self):
+        items = [('item-%d' % i, i) for i in range(20)]
+        shard = cli_tools.Shard(1, 2)
+
+        result = list(shard.filter(items, key=lambda x: x[0]))
+
+        assert result == [x for x in items if shard.owns(x[0])]
+
+    def test_range(self):
+        shards = [cli_tools.Shard(i, 3) for i in range(3)]
+
+        result = [s.range(10) for s in shards]
+
+        assert result == [(0, 3), (3, 6), (6, 10)]
+
+    def test_slice(self):
+        shard = cli_tools.Shard(1, 3)
+
+        result = shard.slice(list(range(10)))
+
+        assert result == [3, 4, 5]
+
+
+class TestEditDistance(object):
+    @pytest.mark.parametrize('a,b,expected', [
+        ('', '', 0),
+        ('deploy', 'deploy', 0),
+        ('', 'abc', 3),
+        ('abc', '', 3),
+        ('deploy', 'deplyo', 2),
+        ('deploy', 'deploys', 1),
+        ('list', 'lst', 1),
+        ('kitten', 'sitting', 3),
+    ])
+    def test_edit_distance(self, a, b, expected):
+        assert cli_tools._edit_distance(a, b) == expected
+        assert cli_tools._edit_distance(b, a) == expected
+
+
+class TestKeyBytes(object):
+    def test_bytes(self):
+        assert cli_tools._key_bytes(b'key') == b'key'
+
+    def test_text(self):
+        assert cli_tools._key_bytes(u'k\xe9y') == b'k\xc3\xa9y'
+
+    def test_other(self):
+        assert cli_tools._key_bytes(123) == b'123'
+
+
+class TestCacheDir(object):
+    def test_xdg(self, mocker):
+        mocker.patch.dict(os.environ, {'XDG_CACHE_HOME': '/xdg'})
+
+        result = cli_tools._cache_dir('name')
+
+        assert result == os.path.join('/xdg', 'cli_tools', 'name')
+
+    def test_home(self, mocker):
+        mocker.patch.dict(os.environ, {'XDG_CACHE_HOME': ''})
+        mocker.patch.object(os.path, 'expanduser', return_value='/home')
+
+        result = cli_tools._cache_dir('name')
+
+        assert result == os.path.join('/home', '.cache', 'cli_tools', 'name')
+
+
+class TestFingerprint(object):
+    def test_stat(self, tmpdir):
+        tmpdir.join('file').write_binary(b'data')
+        path = str(tmpdir.join('file'))
+
+        result = cli_tools._fingerprint(path)
+
+        assert result == '4:%r' % os.stat(path).st_mtime
+
+    def test_content(self, tmpdir):
+        tmpdir.join('file').write_binary(b'data')
+
+        result = cli_tools._fingerprint(str(tmpdir.join('file')), True)
+
+        assert result == hashlib.sha256(b'data').hexdigest()
+
+    def test_missing(self, tmpdir):
+        path = str(tmpdir.join('file'))
+
+        assert cli_tools._fingerprint(path) == '-'
+        assert cli_tools._fingerprint(path, True) == '-'
+
+
+class TestImportTarget(object):
+    def test_attribute(self):
+        assert cli_tools._import_target('os.path:join.__name__') == 'join'
+
+    def test_module(self):
+        assert cli_tools._import_target('os.path') is os.path
+
+
+class TestUnknownExtra(object):
+    def test_imported(self):
+        assert cli_tools._unknown_extra() is pkg_resources.UnknownExtra
+
+    def test_not_imported(self, mocker):
+        mocker.patch.dict(sys.modules, {'pkg_resources': None})
+
+        assert cli_tools._unknown_extra() is ImportError
+
+
+class TestIterEntryPoints(object):
+    def test_installed(self, mocker):
+        mock_iter_entry_points = mocker.patch.object(
+            pkg_resources, 'iter_entry_points', return_value=['ep']
+        )
+
+        result = cli_tools._iter_entry_points('group')
+
+        assert result == ['ep']
+        mock_iter_entry_points.assert_called_once_with('group')
+
+    def test_frozen(self, mocker):
+        mock_iter_entry_points = mocker.patch.object(
+            pkg_resources, 'iter_entry_points'
+        )
+        mocker.patch.object(cli_tools, '_frozen_entrypoints', {
+            'group': [('cmd', 'module:func', 'dist 1.0')],
+        })
+
+        result = cli_tools._iter_entry_points('group')
+
+        assert [str(ep) for ep in result] == ['cmd = module:func']
+        assert result[0].dist == 'dist 1.0'
+        assert cli_tools._iter_entry_points('other') == []
+        assert not mock_iter_entry_points.called
+
+
+class TestModuleFiles(object):
+    def test_package(self, tmpdir, mocker):
+        mocker.patch.object(sys, 'path', [str(tmpdir)] + sys.path)
+        mocker.patch.dict(sys.modules)
+        tmpdir.join('files_pkg', '__init__.py').write('', ensure=True)
+        tmpdir.join('files_pkg', 'sub', '__init__.py').write('', ensure=True)
+        tmpdir.join('files_pkg', 'sub', 'mod.py').write('', ensure=True)
+        tmpdir.join('files_pkg', '__pycache__', 'x.py').write('', ensure=True)
+        tmpdir.join('files_pkg', 'data.txt').write('')
+
+        result = cli_tools._module_files('files_pkg.sub.mod')
+
+        assert result == [
+            (str(tmpdir.join('files_pkg', '__init__.py')),
+             'files_pkg/__init__.py'),
+            (str(tmpdir.join('files_pkg', 'sub', '__init__.py')),
+             'files_pkg/sub/__init__.py'),
+            (str(tmpdir.join('files_pkg', 'sub', 'mod.py')),
+             'files_pkg/sub/mod.py'),
+        ]
+
+    @pytest.mark.parametrize('filename', ['mod.py', 'mod.pyc'])
+    def test_module(self, mocker, filename):
+        mocker.patch.dict(sys.modules, {
+            'files_mod': mocker.Mock(__file__='/lib/' + filename, __path__=[]),
+        })
+
+        result = cli_tools._module_files('files_mod')
+
+        assert result == [('/lib/mod.py', 'mod.py')]
+
+    @pytest.mark.parametrize('path', [None, '/lib/mod.so'])
+    def test_not_source(self, mocker, path):
+        mocker.patch.dict(sys.modules, {
+            'files_mod': mocker.Mock(__file__=path),
+        })
+
+        with pytest.raises(ValueError):
+            cli_tools._module_files('files_mod')
+
+
+class TestCompileSource(object):
+    def test_compile(self, tmpdir):
+        tmpdir.join('mod.py').write('x = 1\n')
+
+        result = cli_tools._compile_source(str(tmpdir.join('mod.py')),
+                                           'mod.py')
+
+        assert result
+        assert tmpdir.listdir() == [tmpdir.join('mod.py')]
+
+    def test_error(self, tmpdir):
+        tmpdir.join('mod.py').write('x = (\n')
+
+        with pytest.raises(py_compile.PyCompileError):
+            cli_tools._compile_source(str(tmpdir.join('mod.py')), 'mod.py')
+
+
+class TestRunBundle(object):
+    def test_run(self, mocker):
+        mocker.patch.object(cli_tools, '_frozen_entrypoints', None)
+        mock_import_target = mocker.patch.object(cli_tools, '_import_target')
+        console = mock_import_target.return_value.cli_tools.console
+
+        result = cli_tools._run_bundle({'group': []}, 'module:func')
+
+        assert result == console.return_value
+        assert cli_tools._frozen_entrypoints == {'group': []}
+        mock_import_target.assert_called_once_with('module:func')
+        console.assert_called_once_with()
+
+
+class TestFuncIdent(object):
+    def test_ident(self):
+        assert cli_tools._func_ident(map_record) == 'test_cli_tools.map_record'
+
+
+class TestDigestCall(object):
+    def test_digest(self, mocker):
+        mocker.patch.object(
+            cli_tools, '_fingerprint', side_effect=lambda p, c: 'fp:%s' % p)
+
+        result = cli_tools._digest_call('func', {'a': 1}, ['p1'], True)
+
+        assert len(result) == 64
+        assert result == cli_tools._digest_call('func', {'a': 1}, ['p1'])
+        assert result != cli_tools._digest_call('func', {'a': 1})
+        cli_tools._fingerprint.assert_any_call('p1', True)
+
+
+class TestMakedirs(object):
+    def test_create(self, tmpdir):
+        path = str(tmpdir.join('a', 'b'))
+
+        cli_tools._makedirs(path)
+        cli_tools._makedirs(path)
+
+        assert os.path.isdir(path)
+
+    def test_error(self, tmpdir):
+        tmpdir.join('a').write('file')
+
+        with pytest.raises(OSError):
+            cli_tools._makedirs(str(tmpdir.join('a', 'b')))
+
+
+class TestWriteAtomic(object):
+    def test_write(self, tmpdir):
+        tmpdir.join('file').write_binary(b'old')
+
+        cli_tools._write_atomic(str(tmpdir.join('file')), b'new')
+
+        assert tmpdir.join('file').read_binary() == b'new'
+        assert tmpdir.listdir() == [tmpdir.join('file')]
+
+    def test_error(self, tmpdir, mocker):
+        mocker.patch.object(os, 'rename', side_effect=OSError('failed'))
+
+        with pytest.raises(OSError):
+            cli_tools._write_atomic(str(tmpdir.join('file')), b'new')
+
+        assert tmpdir.listdir() == []
+
+
+@requires_fcntl
+class TestAcquire(object):
+    def test_blocking(self, tmpdir):
+        with open(str(tmpdir.join('lock')), 'ab') as lock:
+            assert cli_tools._acquire(lock) is True
+
+    def test_try(self, tmpdir):
+        path = str(tmpdir.join('lock'))
+        with open(path, 'ab') as lock1, open(path, 'ab') as lock2:
+            assert cli_tools._acquire(lock1, 0) is True
+            assert cli_tools._acquire(lock2, 0) is False
+
+    def test_timeout(self, tmpdir, mocker):
+        path = str(tmpdir.join('lock'))
+        with open(path, 'ab') as lock1, open(path, 'ab') as lock2:
+            cli_tools._acquire(lock1)
+            mocker.patch.object(
+                cli_tools.time, 'time',
+                side_effect=itertools.chain([100.0, 100.0, 100.15],
+                                            itertools.repeat(100.3)),
+            )
+            mock_sleep = mocker.patch.object(cli_tools.time, 'sleep')
+
+            assert cli_tools._acquire(lock2, 0.2) is False
+
+        assert mock_sleep.call_args_list == [
+            mocker.call(0.1),
+            mocker.call(pytest.approx(0.05)),
+        ]
+
+    def test_error(self, mocker):
+        mocker.patch.object(
+            cli_tools.fcntl, 'flock', side_effect=IOError(errno.EBADF, 'bad'))
+        lock = mocker.Mock(**{'fileno.return_value': 3})
+
+        with pytest.raises(IOError):
+            cli_tools._acquire(lock, 0)
+
+
+@requires_fcntl
+class TestAcquireSlot(object):
+    def test_free(self, tmpdir):
+        directory = str(tmpdir.join('slots'))
+
+        lock1 = cli_tools._acquire_slot(directory, 'name', 2, 0)
+        lock2 = cli_tools._acquire_slot(directory, 'name', 2, 0)
+
+        assert lock1.name == os.path.join(directory, 'name.0.lock')
+        assert lock2.name == os.path.join(directory, 'name.1.lock')
+        lock1.close()
+        lock2.close()
+
+    def test_fail_fast(self, tmpdir, mocker):
+        mock_sleep = mocker.patch.object(cli_tools.time, 'sleep')
+        lock = cli_tools._acquire_slot(str(tmpdir), 'name', 1, 0)
+
+        assert cli_tools._acquire_slot(str(tmpdir), 'name', 1, 0) is None
+        assert not mock_sleep.called
+        lock.close()
+
+    def test_timeout(self, tmpdir, mocker):
+        lock = cli_tools._acquire_slot(str(tmpdir), 'name', 1)
+        clock = [100.0]
+
+        def sleep(delay):
+            clock[0] += delay
+
+        mocker.patch.object(
+            cli_tools.time, 'time', side_effect=lambda: clock[0])
+        mock_sleep = mocker.patch.object(
+            cli_tools.time, 'sleep', side_effect=sleep)
+
+        assert cli_tools._acquire_slot(str(tmpdir), 'name', 1, 0.25) is None
+        assert mock_sleep.call_args_list == [
+            mocker.call(0.1),
+            mocker.call(0.1),
+            mocker.call(pytest.approx(0.05)),
+        ]
+        lock.close()
+
+    def test_wait(self, tmpdir, mocker):
+        mocker.patch.object(
+            cli_tools, '_acquire', side_effect=[False, False, False, True])
+        mock_sleep = mocker.patch.object(cli_tools.time, 'sleep')
+
+        lock = cli_tools._acquire_slot(str(tmpdir), 'name', 2)
+
+        assert lock.name == str(tmpdir.join('name.1.lock'))
+        mock_sleep.assert_called_once_with(0.1)
+        lock.close()
+
+
+class TestJournal(object):
+    def test_init(self):
+        result = cli_tools.Journal('path', True, 10, 2.0)
+
+        assert result.path == 'path'
+        assert result.resume is True
+        assert result.batch == 10
+        assert result.interval == 2.0
+        assert result._file is None
+        assert result._done == set()
+        assert result._pending == []
+
+    def test_nopath(self):
+        journal = cli_tools.Journal()
+
+        journal.done('key')
+        journal.flush()
+        journal.close()
+
+        assert journal.is_done('key') is False
+        assert journal._file is None
+
+    def test_done(self, tmpdir):
+        path = str(tmpdir.join('journal'))
+        journal = cli_tools.Journal(path, batch=2)
+
+        journal.done('key1')
+        assert tmpdir.join('journal').size() == 0
+        journal.done('key1')
+        journal.done('key2')
+
+        assert tmpdir.join('journal').size() == 16
+        assert journal.is_done('key1') is True
+        assert 'key2' in journal
+        assert 'key3' not in journal
+        journal.close()
+
+    def test_done_interval(self, tmpdir, mocker):
+        mocker.patch.object(
+            cli_tools.time, 'time',
+            side_effect=itertools.chain([100.0, 100.5],
+                                        itertools.repeat(101.5)),
+        )
+        path = str(tmpdir.join('journal'))
+        journal = cli_tools.Journal(path, interval=1.0)
+
+        journal.done('key1')
+        assert tmpdir.join('journal').size() == 0
+        journal.done('key2')
+
+        assert tmpdir.join('journal').size() == 16
+
+    def test_truncate(self, tmpdir):
+        tmpdir.join('journal').write_binary(b'x' * 24)
+        path = str(tmpdir.join('journal'))
+
+        with cli_tools.Journal(path) as journal:
+            journal.done('key1')
+
+        assert tmpdir.join('journal').size() == 8
+
+    def test_resume(self, tmpdir):
+        path = str(tmpdir.join('journal'))
+        with cli_tools.Journal(path) as journal:
+            journal.done('key1')
+            journal.done('key2')
+        with open(path, 'ab') as f:
+            f.write(b'part')
+
+        with cli_tools.Journal(path, resume=True) as journal:
+            assert journal.is_done('key1') is True
+            assert journal.is_done('key2') is True
+            assert journal.is_done('key3') is False
+            journal.done('key3')
+
+        assert tmpdir.join('journal').size() == 24
+
+    def test_resume_missing(self, tmpdir):
+        path = str(tmpdir.join('journal'))
+
+        with cli_tools.Journal(path, resume=True) as journal:
+            assert journal.is_done('key1') is False
+
+        assert tmpdir.join('journal').size() == 0
+
+    def test_iterate(self, tmpdir):
+        path = str(tmpdir.join('journal'))
+        with cli_tools.Journal(path) as journal:
+            with pytest.raises(ExceptionForTest):
+                for item in journal.iterate(range(10)):
+                    if item == 4:
+                        raise ExceptionForTest()
+
+        with cli_tools.Journal(path, resume=True) as journal:
+            result = list(journal.iterate(range(10)))
+
+        assert result == [4, 5, 6, 7, 8, 9]
+
+    def test_iterate_key(self, tmpdir):
+        path = str(tmpdir.join('journal'))
+        items = [('a', 1), ('b', 2), ('c', 3)]
+        with cli_tools.Journal(path) as journal:
+            journal.done('b')
+
+            result = list(journal.iterate(items, key=lambda x: x[0]))
+
+        assert result == [('a', 1), ('c', 3)]
+
+
+class TestJournalAction(object):
+    def make_parser(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--resume', dest='journal', resume=True,
+                            action=cli_tools._JournalAction, batch=5)
+        parser.add_argument('--journal', dest='journal', batch=5,
+                            action=cli_tools._JournalAction)
+        return parser
+
+    def test_default(self):
+        result = self.make_parser().parse_args([])
+
+        assert isinstance(result.journal, cli_tools.Journal)
+        assert result.journal.path is None
+        assert result.journal.resume is False
+        assert result.journal.batch == 5
+
+    def test_journal(self):
+        result = self.make_parser().parse_args(['--journal', 'path'])
+
+        assert result.journal.path == 'path'
+        assert result.journal.resume is False
+        assert result.journal.batch == 5
+
+    @pytest.mark.parametrize('argv', [
+        ['--journal', 'path', '--resume'],
+        ['--resume', '--journal', 'path'],
+    ])
+    def test_resume(self, argv):
+        result = self.make_parser().parse_args(argv)
+
+        assert result.journal.path == 'path'
+        assert result.journal.resume is True
+        assert result.journal.batch == 5
+        assert result.journal._file is None
+
+
+class TestPluginReportAction(object):
+    def make_parser(self, mocker, loads):
+        adaptor = mocker.Mock(**{
+            'get_plugin_loads.return_value': [
+                cli_tools._PluginLoad(*load) for load in loads
+            ],
+        })
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--plugin-report', adaptor=adaptor,
+                            action=cli_tools._PluginReportAction)
+        return parser
+
+    def test_default(self, mocker):
+        result = self.make_parser(mocker, []).parse_args([])
+
+        assert not hasattr(result, 'plugin_report')
+
+    def test_report(self, mocker, capsys):
+        parser = self.make_parser(mocker, [
+            ('group', 'good', 'dist 1.0', 0.25, None),
+            ('group', 'bad', 'dist 1.0', 1.5, 'ImportError: mod'),
+            ('group', 'worse', 'other 2.0', None, 'AttributeError: x'),
+        ])
+
+        with pytest.raises(SystemExit) as exc_info:
+            parser.parse_args(['--plugin-report'])
+        out, err = capsys.readouterr()
+
+        assert exc_info.value.code == 0
+        assert err == (
+            'group good (dist 1.0): loaded in 0.250s\n'
+            'group bad (dist 1.0): failed in 1.500s: ImportError: mod\n'
+            'group worse (other 2.0): quarantined: AttributeError: x\n'
+        )
+
+    def test_report_empty(self, mocker, capsys):
+        parser = self.make_parser(mocker, [])
+
+        with pytest.raises(SystemExit):
+            parser.parse_args(['--plugin-report'])
+        out, err = capsys.readouterr()
+
+        assert err == 'no plugins loaded\n'
+
+
+class TestResultCache(object):
+    def test_init(self):
+        result = cli_tools.ResultCache('dir', 10, 5.0)
+
+        assert result.directory == 'dir'
+        assert result.max_size == 10
+        assert result.ttl == 5.0
+
+    def test_init_default(self, mocker):
+        mocker.patch.object(cli_tools, '_cache_dir', return_value='cache')
+
+        result = cli_tools.ResultCache()
+
+        assert result.directory == 'cache'
+        assert result.max_size == 100 * 1024 * 1024
+        assert result.ttl is None
+        cli_tools._cache_dir.assert_called_once_with('results')
+
+    def test_key(self, mocker):
+        mocker.patch.object(
+            cli_tools, '_fingerprint', side_effect=lambda p, c: 'fp:%s' % p)
+        cache = cli_tools.ResultCache('dir')
+
+        result = cache.key('mod.func', {'b': 2, 'a': 1}, ['p1'], True)
+
+        assert result == cache.key('mod.func', {'a': 1, 'b': 2}, ['p1'])
+        assert result != cache.key('mod.func', {'a': 1, 'b': 3}, ['p1'])
+        assert result != cache.key('mod.other', {'a': 1, 'b': 2}, ['p1'])
+        assert result != cache.key('mod.func', {'a': 1, 'b': 2})
+        cli_tools._fingerprint.assert_any_call('p1', True)
+
+    def test_put_get(self, tmpdir):
+        cache = cli_tools.ResultCache(str(tmpdir.join('cache')))
+
+        assert cache.get('key') == (False, None)
+        assert cache.put('key', ['result']) is True
+        assert cache.get('key') == (True, ['result'])
+        assert tmpdir.join('cache').listdir() == [
+            tmpdir.join('cache', 'key.pickle'),
+        ]
+
+    def test_put_unpicklable(self, tmpdir):
+        cache = cli_tools.ResultCache(str(tmpdir))
+
+        assert cache.put('key', lambda: None) is False
+        assert tmpdir.listdir() == []
+
+    def test_get_corrupt(self, tmpdir):
+        tmpdir.join('key.pickle').write_binary(b'garbage')
+        cache = cli_tools.ResultCache(str(tmpdir))
+
+        assert cache.get('key') == (False, None)
+
+    def test_get_expired(self, tmpdir, mocker):
+        mock_time = mocker.patch.object(
+            cli_tools.time, 'time', return_value=100.0)
+        cache = cli_tools.ResultCache(str(tmpdir), ttl=10.0)
+        cache.put('key', 'result')
+
+        mock_time.return_value = 109.0
+        assert cache.get('key') == (True, 'result')
+        mock_time.return_value = 110.0
+        assert cache.get('key') == (False, None)
+        assert tmpdir.listdir() == []
+
+    def test_evict(self, tmpdir):
+        for name, mtime in (('a', 300), ('b', 100), ('c', 200)):
+            tmpdir.join(name + '.pickle').write_binary(b'x' * 10)
+            tmpdir.join(name + '.pickle').setmtime(mtime)
+        tmpdir.join('other').write_binary(b'x' * 100)
+        cache = cli_tools.ResultCache(str(tmpdir), max_size=20)
+
+        cache.evict()
+
+        assert sorted(p.basename for p in tmpdir.listdir()) == [
+            'a.pickle', 'c.pickle', 'other',
+        ]
+
+    def test_get_touches(self, tmpdir):
+        cache = cli_tools.ResultCache(str(tmpdir))
+        cache.put('b', 'result')
+        size = tmpdir.join('b.pickle').size()
+        tmpdir.join('b.pickle').setmtime(50)
+        tmpdir.join('a.pickle').write_binary(b'x' * size)
+        tmpdir.join('a.pickle').setmtime(100)
+        cache.max_size = size * 2
+
+        cache.get('b')
+        cache.put('c', 'result')
+
+        assert sorted(p.basename for p in tmpdir.listdir()) == [
+            'b.pickle', 'c.pickle',
+        ]
+
+
+class TestCached(object):
+    def make_func(self, tmpdir, calls, **kwargs):
+        @cli_tools.cached(directory=str(tmpdir), files=['paths'], **kwargs)
+        def func(paths, n=1, no_cache=False, refresh_cache=False):
+            calls.append(n)
+            return n * 2
+
+        return func
+
+    def test_cache(self, tmpdir):
+        calls = []
+        func = self.make_func(tmpdir.join('cache'), calls)
+        tmpdir.join('input').write('data')
+        path = str(tmpdir.join('input'))
+
+        results = [
+            func.safe_call(argparse.Namespace(paths=[path], n=1)),
+            func.safe_call(argparse.Namespace(paths=[path], n=1)),
+            func.safe_call(argparse.Namespace(paths=[path], n=2)),
+            func.safe_call(argparse.Namespace(paths=None, n=1)),
+        ]
+
+        assert results == [(2, None), (2, None), (4, None), (2, None)]
+        assert calls == [1, 2, 1]
+
+    def test_cache_file_changed(self, tmpdir):
+        calls = []
+        func = self.make_func(tmpdir.join('cache'), calls, content=True)
+        tmpdir.join('input').write('data')
+        path = str(tmpdir.join('input'))
+
+        func.safe_call(argparse.Namespace(paths=path))
+        tmpdir.join('input').write('changed')
+        func.safe_call(argparse.Namespace(paths=path))
+
+        assert calls == [1, 1]
+
+    def test_cache_flags(self, tmpdir):
+        calls = []
+        func = self.make_func(tmpdir.join('cache'), calls)
+
+        func.safe_call(argparse.Namespace(paths=None, no_cache=True))
+        func.safe_call(argparse.Namespace(paths=None))
+        func.safe_call(argparse.Namespace(paths=None, refresh_cache=True))
+        func.safe_call(argparse.Namespace(paths=None))
+        func.safe_call(argparse.Namespace(paths=None, no_cache=True))
+
+        assert calls == [1, 1, 1, 1]
+
+    def test_cache_exc(self, tmpdir):
+        @cli_tools.cached(directory=str(tmpdir))
+        def func():
+            raise ExceptionForTest('failed')
+
+        args = argparse.Namespace(debug=False)
+
+        result, exc_info = func.safe_call(args)
+
+        assert isinstance(exc_info[1], ExceptionForTest)
+        assert tmpdir.listdir() == []
+
+    def test_cache_unwritable(self, tmpdir):
+        calls = []
+        tmpdir.join('file').write('not a directory')
+        func = self.make_func(tmpdir.join('file', 'cache'), calls)
+
+        results = [
+            func.safe_call(argparse.Namespace(paths=None, n=3)),
+            func.safe_call(argparse.Namespace(paths=None, n=3)),
+        ]
+
+        assert results == [(6, None), (6, None)]
+        assert calls == [3, 3]
+
+
+@requires_fcntl
+class TestCachedHelp(object):
+    def make_func(self, tmpdir, mocker):
+        tmpdir.join('help_sub_mod.py').write(
+            'import cli_tools\n'
+            '\n'
+            '@cli_tools.argument("--steps", help="Number of steps.")\n'
+            'def up(steps):\n'
+            '    "Migrate up."\n'
+        )
+        mocker.patch.object(sys, 'path', [str(tmpdir)] + sys.path)
+        mocker.patch.object(sys, 'argv', ['tool'])
+        mocker.patch.object(cli_tools, '_terminal_width', return_value=80)
+
+        return self.make_main(tmpdir)
+
+    def make_main(self, tmpdir):
+        @cli_tools.cache_help(directory=str(tmpdir.join('cache')))
+        @cli_tools.argument('--debug', action='store_true')
+        def main():
+            pass
+        main.lazy_subcommand('up', 'help_sub_mod:up')
+
+        return main
+
+    def call(self, func, argv, capsys):
+        sys.modules.pop('help_sub_mod', None)
+        with pytest.raises(SystemExit) as exc_info:
+            func.console(argv=argv)
+        out, err = capsys.readouterr()
+        assert exc_info.value.code == 0
+        return out
+
+    def test_help(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+
+        miss = self.call(func, ['--help'], capsys)
+        mock_make_parser = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser'
+        )
+        hit = self.call(func, ['-h'], capsys)
+
+        assert miss.startswith('usage: tool [-h] [--debug] {up} ...')
+        assert hit == miss
+        assert not mock_make_parser.called
+
+    def test_help_subcommand(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+
+        miss = self.call(func, ['up', '--help'], capsys)
+        mock_make_parser = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser'
+        )
+        hit = self.call(self.make_main(tmpdir), ['up', '--help'], capsys)
+
+        assert miss.startswith('usage: tool up [-h] [--steps STEPS]')
+        assert 'Migrate up.' in miss
+        assert hit == miss
+        assert not mock_make_parser.called
+        assert 'help_sub_mod' not in sys.modules
+
+    def test_help_broken_subcommand(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+        func.lazy_subcommand('gone', 'help_missing_mod:gone')
+
+        with pytest.raises(SystemExit) as exc_info:
+            func.console(argv=['gone', '--help'])
+
+        out, err = capsys.readouterr()
+        assert exc_info.value.code == 2
+        assert 'subcommand gone: unable to load' in err
+
+    def test_help_changed(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+        self.call(func, ['up', '--help'], capsys)
+        module = tmpdir.join('help_sub_mod.py')
+        module.write(module.read().replace('Migrate up.', 'Go up.'))
+        os.utime(str(module), (0, 0))
+
+        # A fresh command, as in a new process
+        result = self.call(self.make_main(tmpdir), ['up', '--help'], capsys)
+
+        assert 'Go up.' in result
+
+    def test_help_tree_changed(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+        self.call(func, ['--help'], capsys)
+
+        # Another module adds a subcommand
+        tmpdir.join('help_other_mod.py').write(
+            'def beta():\n'
+            '    "Go beta."\n'
+        )
+        func = self.make_main(tmpdir)
+        func.subcommand(importlib.import_module('help_other_mod').beta)
+        miss = self.call(func, ['--help'], capsys)
+        mock_make_parser = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser'
+        )
+        hit = self.call(func, ['--help'], capsys)
+
+        assert miss.startswith('usage: tool [-h] [--debug] {')
+        assert 'beta' in miss.splitlines()[0]
+        assert hit == miss
+        assert not mock_make_parser.called
+
+    def test_help_width(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+        self.call(func, ['--help'], capsys)
+        mock_make_parser = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser',
+            side_effect=cli_tools.ScriptAdaptor._make_parser,
+            autospec=True,
+        )
+        cli_tools._terminal_width.return_value = 100
+
+        self.call(func, ['--help'], capsys)
+
+        mock_make_parser.assert_called_once_with(func.cli_tools)
+
+    def test_not_help(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+        mock_put = mocker.patch.object(cli_tools.ResultCache, 'put')
+
+        assert func.console(argv=['up']) is None
+        for argv in (['--debug', '--help'], ['other', '--help'],
+                     ['up', 'other', '--help']):
+            with pytest.raises(SystemExit):
+                func.console(argv=argv)
+
+        assert not mock_put.called
+
+    def test_help_flag_not_help(self, tmpdir, mocker, capsys):
+        mocker.patch.object(sys, 'argv', ['tool'])
+
+        @cli_tools.cache_help(directory=str(tmpdir))
+        @cli_tools.argument('-h', dest='host')
+        def main(host):
+            return host
+
+        def make_parser(adaptor):
+            parser = argparse.ArgumentParser(add_help=False)
+            adaptor.setup_args(parser)
+            return parser
+        mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_make_parser', autospec=True,
+            side_effect=make_parser,
+        )
+        mock_put = mocker.patch.object(cli_tools.ResultCache, 'put')
+
+        assert main.console(argv=['-h', 'host']) == 'host'
+        with pytest.raises(SystemExit):
+            main.console(argv=['-h'])
+        assert not mock_put.called
+
+    def test_help_unwritable(self, tmpdir, mocker, capsys):
+        func = self.make_func(tmpdir, mocker)
+        mocker.patch.object(cli_tools.ResultCache, 'put', side_effect=OSError)
+
+        result = self.call(func, ['--help'], capsys)
+
+        assert result.startswith('usage: tool')
+
+    def test_help_key(self, tmpdir, mocker):
+        func = self.make_func(tmpdir, mocker)
+        sa = func.cli_tools
+        mock_iter_entry_points = mocker.patch.object(
+            pkg_resources, 'iter_entry_points',
+            return_value=[mocker.Mock(__str__=lambda self: 'ep', dist='d')],
+        )
+
+        key1 = sa._help_key([])
+        key2 = sa._help_key(['up'])
+        sa._entrypoints = frozenset(['group'])
+        key3 = sa._help_key([])
+        sa.epilog = 'More help.'
+        key4 = sa._help_key([])
+
+        assert len(set([key1, key2, key3, key4])) == 4
+        mock_iter_entry_points.assert_called_with('group')
+        assert sa._help_key([]) == key4
+
+
+class TestTerminalWidth(object):
+    def test_get_terminal_size(self, mocker):
+        mocker.patch.object(
+            cli_tools.shutil, 'get_terminal_size', create=True,
+            return_value=mocker.Mock(columns=120),
+        )
+
+        assert cli_tools._terminal_width() == 120
+
+    def test_columns(self, mocker):
+        mocker.patch.object(cli_tools, 'shutil', mocker.Mock(spec=[]))
+        mocker.patch.dict(os.environ, {'COLUMNS': '100'})
+
+        assert cli_tools._terminal_width() == 100
+
+    def test_default(self, mocker):
+        mocker.patch.object(cli_tools, 'shutil', mocker.Mock(spec=[]))
+        mocker.patch.dict(os.environ, {'COLUMNS': 'wide'})
+
+        assert cli_tools._terminal_width() == 80
+
+
+class TestSingleflight(object):
+    def make_func(self, tmpdir, calls, **kwargs):
+        @cli_tools.singleflight(directory=str(tmpdir), **kwargs)
+        def func(n=1):
+            calls.append(n)
+            if n < 0:
+                raise ExceptionForTest('negative')
+            return n * 2
+
+        return func
+
+    def result_path(self, tmpdir, func, **kwargs):
+        key = cli_tools._digest_call(cli_tools._func_ident(func), kwargs)
+        return tmpdir.join(key + '.result')
+
+    def test_leader(self, tmpdir):
+        calls = []
+        func = self.make_func(tmpdir, calls)
+
+        result = func.safe_call(argparse.Namespace(n=1))
+
+        assert result == (2, None)
+        assert calls == [1]
+        finished, ok, value = pickle.loads(
+            self.result_path(tmpdir, func, n=1).read_binary())
+        assert (ok, value) == (True, 2)
+
+    def test_leader_exc(self, tmpdir):
+        calls = []
+        func = self.make_func(tmpdir, calls)
+
+        result, exc_info = func.safe_call(argparse.Namespace(n=-1))
+
+        assert isinstance(exc_info[1], ExceptionForTest)
+        finished, ok, value = pickle.loads(
+            self.result_path(tmpdir, func, n=-1).read_binary())
+        assert ok is False
+        assert isinstance(value, ExceptionForTest)
+
+    def test_leader_unpicklable(self, tmpdir):
+        @cli_tools.singleflight(directory=str(tmpdir))
+        def func():
+            return lambda: None
+
+        result, exc_info = func.safe_call(argparse.Namespace())
+
+        assert callable(result)
+        assert [p.ext for p in tmpdir.listdir()] == ['.lock']
+
+    def test_follower(self, tmpdir, mocker):
+        mocker.patch.object(cli_tools, '_acquire', side_effect=[False, True])
+        calls = []
+        func = self.make_func(tmpdir, calls)
+        self.result_path(tmpdir, func, n=1).write_binary(pickle.dumps(
+            (time.time() + 60, True, 'shared')))
+
+        result = func.safe_call(argparse.Namespace(n=1))
+
+        assert result == ('shared', None)
+        assert calls == []
+
+    def test_follower_exc(self, tmpdir, mocker):
+        mocker.patch.object(cli_tools, '_acquire', side_effect=[False, True])
+        calls = []
+        func = self.make_func(tmpdir, calls)
+        self.result_path(tmpdir, func, n=1).write_binary(pickle.dumps(
+            (time.time() + 60, False, ExceptionForTest('shared'))))
+
+        result, exc_info = func.safe_call(argparse.Namespace(n=1))
+
+        assert isinstance(exc_info[1], ExceptionForTest)
+        assert str(exc_info[1]) == 'shared'
+        assert calls == []
+
+    def test_follower_stale(self, tmpdir, mocker):
+        mocker.patch.object(cli_tools, '_acquire', side_effect=[False, True])
+        calls = []
+        func = self.make_func(tmpdir, calls)
+        self.result_path(tmpdir, func, n=1).write_binary(pickle.dumps(
+            (time.time() - 60, True, 'stale')))
+
+        result = func.safe_call(argparse.Namespace(n=1))
+
+        assert result == (2, None)
+        assert calls == [1]
+
+    def test_follower_timeout(self, tmpdir, mocker):
+        mock_acquire = mocker.patch.object(
+            cli_tools, '_acquire', return_value=False)
+        calls = []
+        func = self.make_func(tmpdir, calls, timeout=5)
+
+        result = func.safe_call(argparse.Namespace(n=1))
+
+        assert result == (2, None)
+        assert calls == [1]
+        assert mock_acquire.call_args_list[1][0][1] == 5
+        assert not self.result_path(tmpdir, func, n=1).exists()
+
+    def test_nofcntl(self, tmpdir, mocker):
+        mocker.patch.object(cli_tools, 'fcntl', None)
+        calls = []
+        func = self.make_func(tmpdir, calls)
+
+        result = func.safe_call(argparse.Namespace(n=1))
+
+        assert result == (2, None)
+        assert tmpdir.listdir() == []
+
+    def test_unwritable(self, tmpdir):
+        tmpdir.join('file').write('')
+        calls = []
+        func = self.make_func(tmpdir.join('file', 'flights'), calls)
+
+        result = func.safe_call(argparse.Namespace(n=1))
+
+        assert result == (2, None)
+        assert calls == [1]
+
+    def test_result_unwritable(self, tmpdir, mocker):
+        mocker.patch.object(cli_tools, '_write_atomic', side_effect=OSError)
+        calls = []
+        func = self.make_func(tmpdir, calls)
+
+        result = func.safe_call(argparse.Namespace(n=1))
+
+        assert result == (2, None)
+        assert calls == [1]
+
+    def test_expire(self, tmpdir):
+        old = time.time() - cli_tools._flight_expiry - 60
+        for name in ('old.lock', 'old.result', 'held.lock', 'other'):
+            tmpdir.join(name).write('')
+            os.utime(str(tmpdir.join(name)), (old, old))
+        tmpdir.join('new.result').write('')
+        calls = []
+        func = self.make_func(tmpdir, calls)
+
+        with open(str(tmpdir.join('held.lock')), 'ab') as held:
+            assert cli_tools._acquire(held, 0)
+            func.safe_call(argparse.Namespace(n=1))
+
+        key = cli_tools._digest_call(cli_tools._func_ident(func), {'n': 1})
+        assert sorted(p.basename for p in tmpdir.listdir()) == sorted([
+            'held.lock', 'new.result', 'other', key + '.lock', key + '.result',
+        ])
+
+
+@requires_fcntl
+class TestLimitConcurrency(object):
+    def test_invalid_slots(self):
+        for slots in (0, -1):
+            with pytest.raises(ValueError):
+                cli_tools.limit_concurrency(slots)
+
+    def test_slot(self, tmpdir, mocker):
+        held = []
+
+        @cli_tools.limit_concurrency(1, 'name', directory=str(tmpdir))
+        def func():
+            held.append(cli_tools._acquire_slot(str(tmpdir), 'name', 1, 0))
+            return 'result'
+
+        result = func.safe_call(argparse.Namespace())
+
+        assert result == ('result', None)
+        assert held == [None]
+        lock = cli_tools._acquire_slot(str(tmpdir), 'name', 1, 0)
+        assert lock is not None
+        lock.close()
+        assert [name for name, _ in func.get_timings()] == [
+            'processor', 'concurrency_limit',
+        ]
+
+    def test_slot_exc(self, tmpdir):
+        @cli_tools.limit_concurrency(1, 'name', directory=str(tmpdir))
+        def func():
+            raise ExceptionForTest('failed')
+
+        result, exc_info = func.safe_call(argparse.Namespace())
+
+        assert isinstance(exc_info[1], ExceptionForTest)
+        lock = cli_tools._acquire_slot(str(tmpdir), 'name', 1, 0)
+        assert lock is not None
+        lock.close()
+
+    def test_full(self, tmpdir, mocker):
+        mock_acquire_slot = mocker.patch.object(
+            cli_tools, '_acquire_slot', return_value=None)
+
+        @cli_tools.limit_concurrency(2, directory='dir', timeout=5)
+        def func():
+            pass  # pragma: no cover
+
+        result, exc_info = func.safe_call(argparse.Namespace())
+
+        assert isinstance(exc_info[1], RuntimeError)
+        assert str(exc_info[1]) == (
+            '2 instance(s) of test_cli_tools.func already running')
+        mock_acquire_slot.assert_called_once_with(
+            'dir', 'test_cli_tools.func', 2, 5)
+
+    def test_fail_fast(self, mocker):
+        mocker.patch.object(cli_tools, '_cache_dir', return_value='cache')
+        mock_acquire_slot = mocker.patch.object(
+            cli_tools, '_acquire_slot', return_value=mocker.Mock())
+
+        @cli_tools.limit_concurrency(2, 'a/b', timeout=5, fail_fast=True)
+        def func():
+            return 'result'
+
+        result = func.safe_call(argparse.Namespace())
+
+        assert result == ('result', None)
+        mock_acquire_slot.assert_called_once_with(
+            'cache', 'a/b'.replace(os.sep, '_'), 2, 0)
+        cli_tools._cache_dir.assert_called_once_with('slots')
+        mock_acquire_slot.return_value.close.assert_called_once_with()
+
+    def test_nofcntl(self, mocker):
+        mocker.patch.object(cli_tools, 'fcntl', None)
+        mock_acquire_slot = mocker.patch.object(cli_tools, '_acquire_slot')
+
+        @cli_tools.limit_concurrency(1)
+        def func():
+            return 'result'
+
+        assert func.safe_call(argparse.Namespace()) == ('result', None)
+        assert not mock_acquire_slot.called
+
+
+class TestConverterCache(object):
+    def test_init(self):
+        result = cli_tools.ConverterCache('path', 10, 5)
+
+        assert result.path == 'path'
+        assert result.ttl == 10
+        assert result.max_entries == 5
+        assert result._conn is None
+
+    def test_init_default(self, mocker):
+        mocker.patch.object(cli_tools, '_cache_dir', return_value='cache')
+
+        result = cli_tools.ConverterCache()
+
+        assert result.path == os.path.join('cache', 'converters.sqlite')
+        assert result.ttl == 3600
+        assert result.max_entries == 10000
+        cli_tools._cache_dir.assert_called_once_with('converters')
+
+    def test_put_get(self, tmpdir):
+        cache = cli_tools.ConverterCache(str(tmpdir.join('dir', 'db')))
+
+        assert cache.get('conv', 'text') == (False, None)
+        assert cache.put('conv', 'text', {'value': 1}) is True
+        assert cache.get('conv', 'text') == (True, {'value': 1})
+        assert cache.get('other', 'text') == (False, None)
+
+    def test_shared(self, tmpdir):
+        path = str(tmpdir.join('db'))
+        cli_tools.ConverterCache(path).put('conv', 'text', 'value')
+
+        result = cli_tools.ConverterCache(path).get('conv', 'text')
+
+        assert result == (True, 'value')
+
+    def test_reconnect(self, tmpdir, mocker):
+        cache = cli_tools.ConverterCache(str(tmpdir.join('db')))
+        conn = cache._connect()
+        mocker.patch.object(os, 'getpid', return_value=-1)
+
+        assert cache._connect() is not conn
+
+    def test_expired(self, tmpdir, mocker):
+        mock_time = mocker.patch.object(
+            cli_tools.time, 'time', return_value=100.0)
+        cache = cli_tools.ConverterCache(str(tmpdir.join('db')), ttl=10)
+        cache.put('conv', 'text', 'value')
+
+        mock_time.return_value = 109.0
+        assert cache.get('conv', 'text') == (True, 'value')
+        mock_time.return_value = 110.0
+        assert cache.get('conv', 'text') == (False, None)
+
+    def test_no_ttl(self, tmpdir, mocker):
+        mock_time = mocker.patch.object(
+            cli_tools.time, 'time', return_value=100.0)
+        cache = cli_tools.ConverterCache(str(tmpdir.join('db')), ttl=None)
+        cache.put('conv', 'text', 'value')
+
+        mock_time.return_value = 1e9
+        assert cache.get('conv', 'text') == (True, 'value')
+
+    def test_evict(self, tmpdir, mocker):
+        mock_time = mocker.patch.object(cli_tools.time, 'time')
+        cache = cli_tools.ConverterCache(str(tmpdir.join('db')),
+                                         max_entries=2)
+        for now, text in ((1.0, 'a'), (2.0, 'b')):
+            mock_time.return_value = now
+            cache.put('conv', text, text)
+        mock_time.return_value = 3.0
+        cache.get('conv', 'a')
+        mock_time.return_value = 4.0
+        cache.put('conv', 'c', 'c')
+
+        assert cache.get('conv', 'a') == (True, 'a')
+        assert cache.get('conv', 'b') == (False, None)
+        assert cache.get('conv', 'c') == (True, 'c')
+
+    def test_unpicklable(self, tmpdir):
+        cache = cli_tools.ConverterCache(str(tmpdir.join('db')))
+
+        assert cache.put('conv', 'text', lambda: None) is False
+        assert cache.get('conv', 'text') == (False, None)
+
+    def test_unusable(self, tmpdir):
+        tmpdir.join('db').write('not a database')
+        cache = cli_tools.ConverterCache(str(tmpdir.join('db')))
+
+        assert cache.put('conv', 'text', 'value') is False
+        assert cache.get('conv', 'text') == (False, None)
+
+    def test_nosqlite(self, tmpdir, mocker):
+        mocker.patch.object(cli_tools, 'sqlite3', None)
+        cache = cli_tools.ConverterCache(str(tmpdir.join('db')))
+
+        assert cache.put('conv', 'text', 'value') is False
+        assert cache.get('conv', 'text') == (False, None)
+        assert tmpdir.listdir() == []
+
+
+class TestCachedConverter(object):
+    def test_cached(self, tmpdir):
+        calls = []
+
+        @cli_tools.cached_converter(str(tmpdir.join('db')))
+        def endpoint(text):
+            calls.append(text)
+            return text.upper()
+
+        assert endpoint('a') == 'A'
+        assert endpoint('a') == 'A'
+        assert endpoint('b') == 'B'
+        assert calls == ['a', 'b']
+        assert endpoint.__name__ == 'endpoint'
+        assert endpoint.cache.path == str(tmpdir.join('db'))
+
+    def test_key(self, tmpdir):
+        calls = []
+
+        @cli_tools.cached_converter(str(tmpdir.join('db')),
+                                    key=lambda prefix, **kw: prefix)
+        def completer(prefix, parsed_args=None):
+            calls.append(prefix)
+            return [prefix + '1', prefix + '2']
+
+        assert completer('a', parsed_args=1) == ['a1', 'a2']
+        assert completer('a', parsed_args=2) == ['a1', 'a2']
+        assert calls == ['a']
+
+    def test_exc(self, tmpdir):
+        calls = []
+
+        @cli_tools.cached_converter(str(tmpdir.join('db')))
+        def convert(text):
+            calls.append(text)
+            raise ValueError('bad')
+
+        for _i in range(2):
+            with pytest.raises(ValueError):
+                convert('a')
+        assert calls == ['a', 'a']
+
+
+class TestDecorators(object):
+    def test_console(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        func = mocker.Mock()
+        result = cli_tools.console(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
 
     def test_prog(self, mocker):
         mock_get_adaptor = mocker.patch.object(
@@ -1726,6 +5870,40 @@ class TestDecorators(object):
         mock_get_adaptor.return_value._add_argument.assert_called_once_with(
             (1, 2, 3), dict(a=4, b=5, c=6), group='group')
 
+    def test_option_argument(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.option_argument('common', 1, 2, 3, a=4, b=5)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_get_adaptor.return_value._add_option.assert_called_once_with(
+            'common', (1, 2, 3), dict(a=4, b=5))
+
+    def test_use_options(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.use_options('common', title='title')
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_get_adaptor.return_value._use_options.assert_called_once_with(
+            'common', dict(title='title'))
+
     def test_argument_group(self, mocker):
         mock_get_adaptor = mocker.patch.object(
             cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
@@ -1793,3 +5971,286 @@ class TestDecorators(object):
         assert result == func
         mock_get_adaptor.return_value._add_extensions.assert_called_once_with(
             'entrypoint.group')
+
+    def test_quarantine_plugins(self, mocker):
+        mock_ResultCache = mocker.patch.object(cli_tools, 'ResultCache')
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.quarantine_plugins('dir', 3600)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_ResultCache.assert_called_once_with('dir', ttl=3600)
+        assert (mock_get_adaptor.return_value._quarantine ==
+                mock_ResultCache.return_value)
+
+    def test_quarantine_plugins_default(self, mocker):
+        mocker.patch.object(cli_tools, '_cache_dir', return_value='plugins')
+        mock_ResultCache = mocker.patch.object(cli_tools, 'ResultCache')
+        func = mocker.Mock(cli_tools=mocker.Mock())
+
+        cli_tools.quarantine_plugins()(func)
+
+        mock_ResultCache.assert_called_once_with('plugins', ttl=None)
+        cli_tools._cache_dir.assert_called_once_with('plugins')
+
+    def test_plugin_report(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.plugin_report('--plugins')
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        adaptor = mock_get_adaptor.return_value
+        adaptor._add_argument.assert_called_once_with(
+            ('--plugins',),
+            dict(action=cli_tools._PluginReportAction, adaptor=adaptor,
+                 help='Report the time taken to load each plugin, and '
+                 'why any failed to load, then exit.'),
+            group=None,
+        )
+
+    def test_record_mapper(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.record_mapper(inputs='inputs', processes=0)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        adaptor = mock_get_adaptor.return_value
+        assert isinstance(adaptor._mapper, cli_tools.RecordMapper)
+        assert adaptor._mapper.inputs == 'inputs'
+        assert adaptor._mapper.processes == 0
+        adaptor._add_argument.assert_called_once_with(
+            ('inputs',), mocker.ANY, group=None)
+
+    def test_shard(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.shard()
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_get_adaptor.return_value._add_argument.assert_called_once_with(
+            ('--shard',), dict(
+                dest='shard', type=cli_tools.Shard.parse,
+                default=cli_tools.Shard(), metavar='INDEX/COUNT',
+                help=mocker.ANY,
+            ), group=None)
+
+    def test_shard_flags(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.shard('--part', '-p', dest='part')
+
+        func = mocker.Mock()
+        decorator(func)
+
+        args, kwargs = mock_get_adaptor.return_value._add_argument.call_args
+        assert args[0] == ('--part', '-p')
+        assert args[1]['dest'] == 'part'
+        assert args[1]['type'] == cli_tools.Shard.parse
+
+    def test_checkpoint(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.checkpoint('jnl', batch=5, interval=2.0)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_get_adaptor.return_value._add_argument.assert_has_calls([
+            mocker.call(('--resume',), dict(
+                dest='jnl', action=cli_tools._JournalAction, resume=True,
+                batch=5, interval=2.0, help=mocker.ANY,
+            ), group=None),
+            mocker.call(('--journal',), dict(
+                dest='jnl', action=cli_tools._JournalAction, metavar='PATH',
+                batch=5, interval=2.0, help=mocker.ANY,
+            ), group=None),
+        ])
+
+    def test_pipeline(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.pipeline('::')
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        assert mock_get_adaptor.return_value.pipe_separator == '::'
+
+    def test_pipe_input(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.pipe_input('records')
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        assert mock_get_adaptor.return_value.pipe_input == 'records'
+
+    def test_low_memory(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.low_memory(freeze=False)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        assert mock_get_adaptor.return_value._low_memory is False
+
+    def test_cache_help(self, mocker):
+        mock_ResultCache = mocker.patch.object(cli_tools, 'ResultCache')
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.cache_help('dir', 10)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_ResultCache.assert_called_once_with('dir', 10)
+        assert (mock_get_adaptor.return_value._help_cache ==
+                mock_ResultCache.return_value)
+
+    def test_cache_help_default(self, mocker):
+        mocker.patch.object(cli_tools, '_cache_dir', return_value='help')
+        mock_ResultCache = mocker.patch.object(cli_tools, 'ResultCache')
+        func = mocker.Mock(cli_tools=mocker.Mock())
+
+        cli_tools.cache_help()(func)
+
+        mock_ResultCache.assert_called_once_with('help', 10 * 1024 * 1024)
+        cli_tools._cache_dir.assert_called_once_with('help')
+
+    def test_cached(self, mocker):
+        mock_ResultCache = mocker.patch.object(cli_tools, 'ResultCache')
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.cached('dir', 10, 5.0)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_ResultCache.assert_called_once_with('dir', 10, 5.0)
+        adaptor = mock_get_adaptor.return_value
+        adaptor.middleware.assert_called_once_with(mocker.ANY, inherit=False)
+        adaptor._add_argument.assert_has_calls([
+            mocker.call(('--refresh-cache',), dict(
+                action='store_true', help=mocker.ANY,
+            ), group=None),
+            mocker.call(('--no-cache',), dict(
+                action='store_true', help=mocker.ANY,
+            ), group=None),
+        ])
+
+    def test_cached_noflags(self, mocker):
+        mocker.patch.object(cli_tools, 'ResultCache')
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.cached(flags=False)
+
+        decorator(mocker.Mock())
+
+        assert mock_get_adaptor.return_value.middleware.called
+        assert not mock_get_adaptor.return_value._add_argument.called
+
+    def test_singleflight(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.singleflight('dir', 5)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_get_adaptor.return_value.middleware.assert_called_once_with(
+            mocker.ANY, inherit=False)
+
+    def test_limit_concurrency(self, mocker):
+        mock_get_adaptor = mocker.patch.object(
+            cli_tools.ScriptAdaptor, '_get_adaptor', return_value=mocker.Mock()
+        )
+        decorator = cli_tools.limit_concurrency(2)
+
+        assert callable(decorator)
+        assert not mock_get_adaptor.called
+
+        func = mocker.Mock()
+        result = decorator(func)
+
+        mock_get_adaptor.assert_called_once_with(func)
+        assert result == func
+        mock_get_adaptor.return_value.middleware.assert_called_once_with(
+            mocker.ANY, inherit=False)